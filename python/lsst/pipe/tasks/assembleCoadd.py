@@ -23,6 +23,14 @@ from builtins import range
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
 import os
+import json
+import shutil
+import hashlib
+import tempfile
+import queue
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy
 import lsst.pex.config as pexConfig
 import lsst.pex.exceptions as pexExceptions
@@ -39,8 +47,13 @@ import lsstDebug
 from .coaddBase import CoaddBaseTask, SelectDataIdContainer
 from .interpImage import InterpImageTask
 from .matchBackgrounds import MatchBackgroundsTask
-from .scaleZeroPoint import ScaleZeroPointTask
+from .scaleZeroPoint import ScaleZeroPointTask, ImageScaler
 from .coaddHelpers import groupPatchExposures, getGroupDataRef
+from .warpReader import WarpReaderCache
+from .coaddAccumulator import MeanCoaddAccumulator
+from .stackCube import stackCube, CUBE_STATISTICS
+from .coaddStaging import StagedStack
+from .makeCoaddTempExp import WARP_WEIGHT_KEYS
 from lsst.meas.algorithms import SourceDetectionTask
 
 __all__ = ["AssembleCoaddTask", "SafeClipAssembleCoaddTask", "CompareWarpAssembleCoaddTask"]
@@ -64,6 +77,90 @@ class AssembleCoaddConfig(CoaddBaseTask.ConfigClass):
         length=2,
         default=(2000, 2000),
     )
+    stackBackend = pexConfig.ChoiceField(
+        dtype=str,
+        doc="Implementation used to stack the warp subregions",
+        default="afw",
+        allowed={
+            "afw": "afw.math.statisticsStack on a list of MaskedImages",
+            "numpy": "vectorized reductions over cubes of the warp subregions (see stackCube); "
+                     "statistics other than MEAN, MEANCLIP and MEDIAN use afw",
+        },
+    )
+    stagingDir = pexConfig.Field(
+        dtype=str,
+        doc="Directory for the scratch files of the stacks staged to meet maxStackMemory; None for the "
+        "default temporary directory",
+        default=None,
+        optional=True,
+    )
+    maxMemoryBytes = pexConfig.RangeField(
+        dtype=int,
+        doc="Memory budget, in bytes, for assembling a patch; if non-zero, the subregion size is chosen "
+        "for each patch from its number of warps, the statistics computed, the alternate masks, "
+        "numWorkers and prefetchDepth so that the estimated peak fits, and subregionSize is ignored.",
+        default=0,
+        min=0,
+    )
+    maxStackMemory = pexConfig.RangeField(
+        dtype=int,
+        doc="Maximum memory, in bytes, for the stack of warp subregions held at once by each worker; "
+        "the warp subregions of a subregion whose stack would need more are read once into a scratch file "
+        "in stagingDir, and stacked from it in bands of rows. Every statistic is computed pixel by pixel, "
+        "so the coadd does not depend on it. Read-ahead (prefetchDepth) is not used for subregions that "
+        "are stacked in bands. 0 for no limit.",
+        default=0,
+        min=0,
+    )
+    numWorkers = pexConfig.RangeField(
+        dtype=int,
+        doc="Number of workers used to assemble independent subregions, and to interpolate independent "
+        "bands of rows of the coadd, concurrently; 1 works serially.",
+        default=1,
+        min=1,
+    )
+    parallelType = pexConfig.ChoiceField(
+        dtype=str,
+        doc="Type of worker pool used to assemble subregions; ignored if numWorkers is 1.",
+        default="process",
+        allowed={
+            "thread": "Assemble subregions in threads of this process",
+            "process": "Assemble subregions in forked worker processes",
+        },
+    )
+    prefetchDepth = pexConfig.RangeField(
+        dtype=int,
+        doc="Number of subregions whose warps are read ahead on background threads while the current "
+        "subregion is stacked; 0 disables read-ahead. Each prefetched subregion holds a full stack of "
+        "warp subregions in memory. Only used when numWorkers is 1.",
+        default=0,
+        min=0,
+    )
+    numIoThreads = pexConfig.RangeField(
+        dtype=int,
+        doc="Number of threads used to read warp subregions ahead; ignored if prefetchDepth is 0.",
+        default=4,
+        min=1,
+    )
+    useWarpReaderCache = pexConfig.Field(
+        dtype=bool,
+        doc="Read warps through a per-patch cache of WarpReaders, which open and parse each warp once and "
+        "memory-map its uncompressed planes, rather than through the butler for every subregion?",
+        default=False,
+    )
+    doSkipNonOverlappingWarps = pexConfig.Field(
+        dtype=bool,
+        doc="Skip reading and stacking the warps that have no valid pixels in a subregion? The valid region "
+        "of each warp is bounded from the bounding boxes (or valid polygons) of the CCDs in its CoaddInputs. "
+        "Only used when NO_DATA pixels are excluded from the stack, so the coadd is unchanged.",
+        default=False,
+    )
+    doWeightCache = pexConfig.Field(
+        dtype=bool,
+        doc="Cache the weight and photometric scaling of each warp in a sidecar file next to the warp, "
+        "and reuse it while the warp and the configuration used to compute it are unchanged?",
+        default=False,
+    )
     statistic = pexConfig.Field(
         dtype=str,
         doc="Main stacking statistic for aggregating over the epochs.",
@@ -122,6 +219,13 @@ class AssembleCoaddConfig(CoaddBaseTask.ConfigClass):
         dtype=bool,
         default=False,
     )
+    doIncremental = pexConfig.Field(
+        doc="Assemble the coadd incrementally? Accumulated sums of the warps are kept next to the coadd, "
+        "so that later runs only read the warps added to or removed from the inputs. "
+        "Requires statistic=MEAN and doMatchBackgrounds=False.",
+        dtype=bool,
+        default=False,
+    )
     doMatchBackgrounds = pexConfig.Field(
         doc="Match backgrounds of coadd temp exposures before coadding them? "
         "If False, the coadd temp expsosures must already have been background subtracted or matched",
@@ -181,6 +285,9 @@ class AssembleCoaddConfig(CoaddBaseTask.ConfigClass):
             raise ValueError("Must set doInterp=False for statistic=%s, which does not "
                              "compute and set a non-zero coadd variance estimate." % (self.statistic))
 
+        if self.doIncremental and (self.statistic != "MEAN" or self.doMatchBackgrounds):
+            raise ValueError("doIncremental requires statistic=MEAN and doMatchBackgrounds=False")
+
         unstackableStats = ['NOTHING', 'ERROR', 'ORMASK']
         if not hasattr(afwMath.Property, self.statistic) or self.statistic in unstackableStats:
             stackableStats = [str(k) for k in afwMath.Property.__members__.keys()
@@ -339,9 +446,10 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
             del mask
 
         self.warpType = self.config.warpType
+        self.warpReaderCache = WarpReaderCache() if self.config.useWarpReaderCache else None
 
     @pipeBase.timeMethod
-    def run(self, dataRef, selectDataList=[]):
+    def run(self, dataRef, selectDataList=[], skyInfo=None, calExpRefList=None):
         """!
         \brief Assemble a coadd from a set of Warps
 
@@ -359,48 +467,71 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
                         - [out] self.config.coaddName + "Coadd"
         \param[in] selectDataList[in]: List of data references to Warps. Data to be coadded will be
                                    selected from this list based on overlap with the patch defined by dataRef.
+        \param[in] skyInfo: geometry of the patch, as returned by getSkyInfo; looked up from dataRef if None
+        \param[in] calExpRefList: List of data references to the calexps already selected for the patch,
+                                  e.g. by a driver assembling several bands of the patch; if None, they
+                                  are selected from selectDataList
 
         \return a pipeBase.Struct with fields:
                  - coaddExposure: coadded exposure
                  - nImage: exposure count image
         """
-        skyInfo = self.getSkyInfo(dataRef)
-        calExpRefList = self.selectExposures(dataRef, skyInfo, selectDataList=selectDataList)
+        try:
+            return self._run(dataRef, selectDataList, skyInfo=skyInfo, calExpRefList=calExpRefList)
+        finally:
+            if self.warpReaderCache is not None:
+                # WarpReaders hold open files and metadata; they are only useful for this patch
+                self.warpReaderCache.clear()
+
+    def _run(self, dataRef, selectDataList, skyInfo=None, calExpRefList=None):
+        """!
+        \brief Assemble a coadd from a set of Warps; see \ref run
+        """
+        if skyInfo is None:
+            skyInfo = self.getSkyInfo(dataRef)
+        if calExpRefList is None:
+            calExpRefList = self.selectExposures(dataRef, skyInfo, selectDataList=selectDataList)
         if len(calExpRefList) == 0:
             self.log.warn("No exposures to coadd")
             return
         self.log.info("Coadding %d exposures", len(calExpRefList))
 
         tempExpRefList = self.getTempExpRefList(dataRef, calExpRefList)
-        inputData = self.prepareInputs(tempExpRefList)
-        self.log.info("Found %d %s", len(inputData.tempExpRefList),
-                      self.getTempExpDatasetName(self.warpType))
-        if len(inputData.tempExpRefList) == 0:
-            self.log.warn("No coadd temporary exposures found")
-            return
-        if self.config.doMatchBackgrounds:
-            refImageScaler = self.getBackgroundReferenceScaler(dataRef)
-            inputData = self.backgroundMatching(inputData, dataRef, refImageScaler)
+        if self.config.doIncremental:
+            retStruct = self.assembleIncremental(dataRef, skyInfo, tempExpRefList)
+            if retStruct is None:
+                self.log.warn("No coadd temporary exposures found")
+                return
+        else:
+            inputData = self.prepareInputs(tempExpRefList)
+            self.log.info("Found %d %s", len(inputData.tempExpRefList),
+                          self.getTempExpDatasetName(self.warpType))
             if len(inputData.tempExpRefList) == 0:
-                self.log.warn("No valid background models")
+                self.log.warn("No coadd temporary exposures found")
                 return
+            if self.config.doMatchBackgrounds:
+                refImageScaler = self.getBackgroundReferenceScaler(dataRef)
+                inputData = self.backgroundMatching(inputData, dataRef, refImageScaler)
+                if len(inputData.tempExpRefList) == 0:
+                    self.log.warn("No valid background models")
+                    return
 
-        supplementaryData = self.makeSupplementaryData(dataRef, selectDataList)
+            supplementaryData = self.makeSupplementaryData(dataRef, selectDataList)
 
-        retStruct = self.assemble(skyInfo, inputData.tempExpRefList, inputData.imageScalerList,
-                                  inputData.weightList,
-                                  inputData.backgroundInfoList if self.config.doMatchBackgrounds else None,
-                                  supplementaryData=supplementaryData)
+            bgInfoList = inputData.backgroundInfoList if self.config.doMatchBackgrounds else None
+            retStruct = self.assemble(skyInfo, inputData.tempExpRefList, inputData.imageScalerList,
+                                      inputData.weightList, bgInfoList, supplementaryData=supplementaryData)
 
-        if self.config.doMatchBackgrounds:
-            self.addBackgroundMatchingMetadata(retStruct.coaddExposure, inputData.tempExpRefList,
-                                               inputData.backgroundInfoList)
+            if self.config.doMatchBackgrounds:
+                self.addBackgroundMatchingMetadata(retStruct.coaddExposure, inputData.tempExpRefList,
+                                                   inputData.backgroundInfoList)
 
         if self.config.doInterp:
-            self.interpImage.run(retStruct.coaddExposure.getMaskedImage(), planeName="NO_DATA")
+            self.interpolateCoadd(retStruct.coaddExposure, planeName="NO_DATA")
             # The variance must be positive; work around for DM-3201.
             varArray = retStruct.coaddExposure.getMaskedImage().getVariance().getArray()
-            varArray[:] = numpy.where(varArray > 0, varArray, numpy.inf)
+            with numpy.errstate(invalid="ignore"):
+                varArray[numpy.logical_not(varArray > 0)] = numpy.inf
 
         if self.config.doMaskBrightObjects:
             brightObjectMasks = self.readBrightObjectMasks(dataRef)
@@ -501,36 +632,186 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
                 self.log.warn("Could not find %s %s; skipping it", tempExpName, tempExpRef.dataId)
                 continue
 
-            tempExp = tempExpRef.get(tempExpName, immediate=True)
-            maskedImage = tempExp.getMaskedImage()
-            imageScaler = self.scaleZeroPoint.computeImageScaler(
-                exposure=tempExp,
-                dataRef=tempExpRef,
-            )
-            try:
-                imageScaler.scaleMaskedImage(maskedImage)
-            except Exception as e:
-                self.log.warn("Scaling failed for %s (skipping it): %s", tempExpRef.dataId, e)
-                continue
-            statObj = afwMath.makeStatistics(maskedImage.getVariance(), maskedImage.getMask(),
-                                             afwMath.MEANCLIP, statsCtrl)
-            meanVar, meanVarErr = statObj.getResult(afwMath.MEANCLIP)
-            weight = 1.0 / float(meanVar)
-            if not numpy.isfinite(weight):
-                self.log.warn("Non-finite weight for %s: skipping", tempExpRef.dataId)
+            warpWeight = self.readWeightCache(tempExpRef) if self.config.doWeightCache else None
+            if warpWeight is None:
+                warpWeight = self.computeWarpWeight(tempExpRef, statsCtrl)
+                if self.config.doWeightCache and warpWeight.status == "ok":
+                    self.writeWeightCache(tempExpRef, warpWeight)
+            if warpWeight.status != "ok":
                 continue
-            self.log.info("Weight of %s %s = %0.3f", tempExpName, tempExpRef.dataId, weight)
-
-            del maskedImage
-            del tempExp
+            self.log.info("Weight of %s %s = %0.3f", tempExpName, tempExpRef.dataId, warpWeight.weight)
 
             tempExpRefList.append(tempExpRef)
-            weightList.append(weight)
-            imageScalerList.append(imageScaler)
+            weightList.append(warpWeight.weight)
+            imageScalerList.append(warpWeight.imageScaler)
 
         return pipeBase.Struct(tempExpRefList=tempExpRefList, weightList=weightList,
                                imageScalerList=imageScalerList)
 
+    def computeWarpWeight(self, tempExpRef, statsCtrl):
+        """!
+        \brief Measure the weight and photometric scaling of a warp
+
+        Read the warp, scale it to the photometric zero point and compute its weight as the inverse of
+        the clipped mean of its variance plane. If the clipped mean variance was measured when the warp
+        was made (see MakeCoaddTempExpTask.measureWeightStats) with our clipping parameters and bad mask
+        planes, only the metadata of the warp is read (see \ref computeWarpWeightFromMetadata).
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \param[in] statsCtrl: Statistics control object for the clipped mean of the variance
+        \return Struct:
+        - status: "ok", or why the warp cannot be coadded ("scalingFailed" or "nonFiniteWeight")
+        - weight: weight of the warp, or None
+        - imageScaler: image scaler of the warp, or None
+        """
+        warpWeight = self.computeWarpWeightFromMetadata(tempExpRef)
+        if warpWeight is not None:
+            return warpWeight
+        tempExp = self.readWarp(tempExpRef)
+        maskedImage = tempExp.getMaskedImage()
+        imageScaler = self.scaleZeroPoint.computeImageScaler(
+            exposure=tempExp,
+            dataRef=tempExpRef,
+        )
+        try:
+            imageScaler.scaleMaskedImage(maskedImage)
+        except Exception as e:
+            self.log.warn("Scaling failed for %s (skipping it): %s", tempExpRef.dataId, e)
+            return pipeBase.Struct(status="scalingFailed", weight=None, imageScaler=None)
+        statObj = afwMath.makeStatistics(maskedImage.getVariance(), maskedImage.getMask(),
+                                         afwMath.MEANCLIP, statsCtrl)
+        meanVar, meanVarErr = statObj.getResult(afwMath.MEANCLIP)
+        weight = 1.0 / float(meanVar)
+        if not numpy.isfinite(weight):
+            self.log.warn("Non-finite weight for %s: skipping", tempExpRef.dataId)
+            return pipeBase.Struct(status="nonFiniteWeight", weight=None, imageScaler=None)
+        return pipeBase.Struct(status="ok", weight=weight, imageScaler=imageScaler)
+
+    def computeWarpWeightFromMetadata(self, tempExpRef):
+        """!
+        \brief Compute the weight and photometric scaling of a warp from the statistics in its metadata
+
+        The clipped mean variance recorded by MakeCoaddTempExpTask is unscaled; with a scalar photometric
+        scaling s the clipped mean of the scaled variance is s**2 times larger. The recorded statistics are
+        therefore only used with a scalar scaling (\ref ImageScaler), and only if they were measured with
+        our sigmaClip, clipIter and badMaskPlanes.
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \return Struct with status, weight and imageScaler, as returned by \ref computeWarpWeight,
+            or None if the recorded statistics cannot be used
+        """
+        tempExpInfo = self.readWarpInfo(tempExpRef)
+        metadata = tempExpInfo.getMetadata()
+        if not all(metadata.exists(key) for key in WARP_WEIGHT_KEYS.getDict().values()):
+            return None
+        if (not numpy.isclose(metadata.get(WARP_WEIGHT_KEYS.sigmaClip), self.config.sigmaClip) or
+                metadata.get(WARP_WEIGHT_KEYS.clipIter) != self.config.clipIter or
+                metadata.get(WARP_WEIGHT_KEYS.badMaskPlanes) != ",".join(sorted(self.config.badMaskPlanes))):
+            self.log.debug("Weight statistics of %s were measured with different parameters",
+                           tempExpRef.dataId)
+            return None
+        imageScaler = self.scaleZeroPoint.computeImageScaler(
+            exposure=tempExpInfo,
+            dataRef=tempExpRef,
+        )
+        if type(imageScaler) is not ImageScaler:
+            return None
+        weight = 1.0/(float(metadata.get(WARP_WEIGHT_KEYS.meanVar))*imageScaler._scale**2)
+        if not numpy.isfinite(weight):
+            self.log.warn("Non-finite weight for %s: skipping", tempExpRef.dataId)
+            return pipeBase.Struct(status="nonFiniteWeight", weight=None, imageScaler=None)
+        return pipeBase.Struct(status="ok", weight=weight, imageScaler=imageScaler)
+
+    def getWeightCacheFilename(self, tempExpRef):
+        """!
+        \brief Return the name of the weight cache file of a warp, which sits next to the warp
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \return tuple of the name of the warp file and the name of its weight cache file
+        """
+        warpFilename = tempExpRef.get(self.getTempExpDatasetName(self.warpType) + "_filename")[0]
+        return warpFilename, warpFilename + ".weight.json"
+
+    def makeWeightCacheKey(self, tempExpRef, warpFilename):
+        """!
+        \brief Return the key identifying a cached warp weight
+
+        The key covers the identity of the warp, the modification time and size of its file, and the
+        configuration used to compute the weight and photometric scaling.
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \param[in] warpFilename: Name of the warp file
+        \return key, as a hex digest string
+        """
+        fileStat = os.stat(warpFilename)
+        keyDict = dict(
+            dataId=sorted((str(k), str(v)) for k, v in tempExpRef.dataId.items()),
+            warpType=self.warpType,
+            filename=os.path.abspath(warpFilename),
+            mtime=fileStat.st_mtime,
+            size=fileStat.st_size,
+            sigmaClip=self.config.sigmaClip,
+            clipIter=self.config.clipIter,
+            badMaskPlanes=sorted(self.config.badMaskPlanes),
+            scaleZeroPointTask=type(self.scaleZeroPoint).__name__,
+            scaleZeroPoint=self.scaleZeroPoint.config.toDict(),
+        )
+        return hashlib.sha1(json.dumps(keyDict, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def readWeightCache(self, tempExpRef):
+        """!
+        \brief Read the cached weight and photometric scaling of a warp
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \return Struct with status, weight and imageScaler, as returned by \ref computeWarpWeight,
+            or None if there is no valid cache entry for the warp and the current configuration. Entries
+            that do not have status "ok" (written by earlier versions) are ignored, so that a failure is
+            retried on the next run.
+        """
+        try:
+            warpFilename, cacheFilename = self.getWeightCacheFilename(tempExpRef)
+            if not os.path.exists(cacheFilename):
+                return None
+            with open(cacheFilename) as cacheFile:
+                cacheEntry = json.load(cacheFile)
+            if cacheEntry.get("key") != self.makeWeightCacheKey(tempExpRef, warpFilename):
+                self.log.debug("Weight cache of %s is stale", tempExpRef.dataId)
+                return None
+            if cacheEntry["status"] != "ok":
+                return None
+        except Exception as e:
+            self.log.warn("Unable to read weight cache of %s: %s", tempExpRef.dataId, e)
+            return None
+        return pipeBase.Struct(status="ok", weight=cacheEntry["weight"],
+                               imageScaler=ImageScaler(cacheEntry["scale"]))
+
+    def writeWeightCache(self, tempExpRef, warpWeight):
+        """!
+        \brief Cache the weight and photometric scaling of a warp
+
+        Only successful results with a scalar photometric scaling (\ref ImageScaler) are cached; failures
+        may be transient (e.g. a failed read) and are not written, so they are retried on the next run.
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \param[in] warpWeight: Struct with status, weight and imageScaler from \ref computeWarpWeight
+        """
+        if warpWeight.status != "ok" or type(warpWeight.imageScaler) is not ImageScaler:
+            return
+        try:
+            warpFilename, cacheFilename = self.getWeightCacheFilename(tempExpRef)
+            cacheEntry = dict(
+                key=self.makeWeightCacheKey(tempExpRef, warpFilename),
+                status=warpWeight.status,
+                weight=warpWeight.weight,
+                scale=warpWeight.imageScaler._scale,
+            )
+            tmpFilename = "%s.%d.tmp" % (cacheFilename, os.getpid())
+            with open(tmpFilename, "w") as cacheFile:
+                json.dump(cacheEntry, cacheFile)
+            os.rename(tmpFilename, cacheFilename)
+        except Exception as e:
+            self.log.warn("Unable to write weight cache of %s: %s", tempExpRef.dataId, e)
+
     def backgroundMatching(self, inputData, refExpDataRef=None, refImageScaler=None):
         """!
         \brief Perform background matching on the prepared inputs
@@ -612,24 +893,141 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
         large area), the assembly is performed over small areas on the image at a time in order to
         conserve memory usage. Iterate over subregions within the outer bbox of the patch using
         \ref assembleSubregion to stack the corresponding subregions from the coaddTempExps with the
-        statistic specified. Set the edge bits the coadd mask based on the weight map.
+        statistic specified. Set the edge bits the coadd mask based on the weight map. See
+        \ref assembleStatistics to stack the same warps with several statistics in a single pass.
 
         \param[in] skyInfo: Patch geometry information, from getSkyInfo
         \param[in] tempExpRefList: List of data references to Warps (previously called CoaddTempExps)
         \param[in] imageScalerList: List of image scalers
         \param[in] weightList: List of weights
         \param[in] bgInfoList: List of background data from background matching, or None
-        \param[in] altMaskList: List of alternate masks to use rather than those stored with tempExp, or None
+        \param[in] altMaskList: List of alternate masks to use rather than those stored with tempExp, or None;
+                                each is either a full-patch Mask, or a dict of mask plane name: list of
+                                SpanSets to set in the tempExp mask (see \ref applyAltMaskPlanes)
         \param[in] mask: Mask to ignore when coadding
         \param[in] supplementaryData: pipeBase.Struct with additional data products needed to assemble coadd.
                         Only used by subclasses that implement makeSupplementaryData and override assemble.
         \return pipeBase.Struct with coaddExposure, nImage if requested
         """
+        result = self.assembleStatistics(skyInfo, tempExpRefList, imageScalerList, weightList,
+                                         [self.config.statistic], bgInfoList=bgInfoList,
+                                         altMaskList=altMaskList, mask=mask)
+        return pipeBase.Struct(coaddExposure=result.coaddExposureList[0], nImage=result.nImage)
+
+    def assembleStatistics(self, skyInfo, tempExpRefList, imageScalerList, weightList, statisticList,
+                           bgInfoList=None, altMaskList=None, mask=None):
+        """!
+        \brief Assemble coadds of the same input warps with one or more statistics
+
+        Each subregion of each warp is read, scaled and masked once and then stacked with every statistic in
+        statisticList (see \ref assembleSubregionStatistics), so e.g. a MEAN and a MEANCLIP coadd cost a
+        single pass over the warps. The coadd made with each statistic is identical to the one made by
+        \ref AssembleCoaddTask.assemble_ "assemble" with config.statistic set to that statistic.
+
+        \param[in] skyInfo: Patch geometry information, from getSkyInfo
+        \param[in] tempExpRefList: List of data references to Warps (previously called CoaddTempExps)
+        \param[in] imageScalerList: List of image scalers
+        \param[in] weightList: List of weights
+        \param[in] statisticList: List of names of statistics with which to stack, e.g. ["MEAN", "MEANCLIP"]
+        \param[in] bgInfoList: List of background data from background matching, or None
+        \param[in] altMaskList: List of alternate masks to use rather than those stored with tempExp, or None;
+                                each is either a full-patch Mask, or a dict of mask plane name: list of
+                                SpanSets to set in the tempExp mask (see \ref applyAltMaskPlanes)
+        \param[in] mask: Mask to ignore when coadding
+        \return pipeBase.Struct with:
+        - coaddExposureList: list of coadds, one for each statistic in statisticList
+        - nImage: exposure count for each pixel if config.doNImage, else None
+        """
         tempExpName = self.getTempExpDatasetName(self.warpType)
-        self.log.info("Assembling %s %s", len(tempExpRefList), tempExpName)
+        self.log.info("Assembling %s %s with %s", len(tempExpRefList), tempExpName, ", ".join(statisticList))
         if mask is None:
             mask = self.getBadPixelMask()
 
+        statsCtrl = self.makeStatsCtrl(mask)
+        statsFlagsList = [afwMath.stringToStatisticsProperty(statistic) for statistic in statisticList]
+
+        if bgInfoList is None:
+            bgInfoList = [None]*len(tempExpRefList)
+
+        if altMaskList is None:
+            altMaskList = [None]*len(tempExpRefList)
+
+        coaddExposureList = []
+        # Every coadd has the same inputs, so read the non-pixel components of the warps only once
+        tempExpInfoList = [self.readWarpInfo(tempExpRef) for tempExpRef in tempExpRefList]
+        for statistic in statisticList:
+            coaddExposure = afwImage.ExposureF(skyInfo.bbox, skyInfo.wcs)
+            coaddExposure.setCalib(self.scaleZeroPoint.getCalib())
+            coaddExposure.getInfo().setCoaddInputs(self.inputRecorder.makeCoaddInputs())
+            self.assembleMetadata(coaddExposure, tempExpRefList, weightList,
+                                  tempExpInfoList=tempExpInfoList)
+            coaddExposureList.append(coaddExposure)
+        if self.config.maxMemoryBytes > 0:
+            subregionSize = self.chooseSubregionSize(skyInfo.bbox, len(tempExpRefList), len(statisticList),
+                                                     altMaskList)
+        else:
+            subregionSizeArr = self.config.subregionSize
+            subregionSize = afwGeom.Extent2I(subregionSizeArr[0], subregionSizeArr[1])
+        # if nImage is requested, create a zero one which can be passed to assembleSubregion
+        if self.config.doNImage:
+            nImage = afwImage.ImageU(skyInfo.bbox)
+        else:
+            nImage = None
+        subBBoxList = list(_subBBoxIter(skyInfo.bbox, subregionSize))
+        subregionArgs = (tempExpRefList, imageScalerList, weightList, bgInfoList, altMaskList,
+                         statsFlagsList, statsCtrl)
+        validBBoxList = None
+        if self.config.doSkipNonOverlappingWarps and len(subBBoxList) > 1:
+            if mask & afwImage.Mask.getPlaneBitMask("NO_DATA"):
+                validBBoxList = self.makeValidRegionIndex(skyInfo.bbox, tempExpRefList)
+            else:
+                self.log.warn("Not skipping non-overlapping warps: NO_DATA pixels are not excluded")
+        self._assembleSubregions(coaddExposureList, subBBoxList, subregionArgs, nImage, validBBoxList)
+
+        for coaddExposure in coaddExposureList:
+            coaddMaskedImage = coaddExposure.getMaskedImage()
+            coaddUtils.setCoaddEdgeBits(coaddMaskedImage.getMask(), coaddMaskedImage.getVariance())
+        return pipeBase.Struct(coaddExposureList=coaddExposureList, nImage=nImage)
+
+    def _assembleSubregions(self, coaddExposureList, subBBoxList, subregionArgs, nImage, validBBoxList):
+        """!
+        \brief Assemble every subregion, in parallel or serially (with read-ahead), as configured
+
+        \param[in,out] coaddExposureList: The target images for the coadds, one for each statistic
+        \param[in] subBBoxList: List of sub-regions to coadd
+        \param[in] subregionArgs: Tuple of the remaining positional arguments of
+                                   \ref assembleSubregionStatistics
+        \param[in,out] nImage: optional ImageU of the exposure count of each pixel
+        \param[in] validBBoxList: optional list of the valid region of each tempExp
+        """
+        tempExpRefList = subregionArgs[0]
+        if self.config.numWorkers > 1 and len(subBBoxList) > 1:
+            self.assembleSubregionsParallel(coaddExposureList, subBBoxList, subregionArgs, nImage=nImage,
+                                            validBBoxList=validBBoxList)
+        else:
+            doPrefetch = self.config.prefetchDepth > 0 and len(subBBoxList) > 1
+            if doPrefetch and any(self.getStackBandHeight(subBBox, len(tempExpRefList)) < subBBox.getHeight()
+                                  for subBBox in subBBoxList):
+                self.log.info("Not reading warps ahead: subregion stacks exceed maxStackMemory")
+                doPrefetch = False
+            if doPrefetch:
+                subregionIter = self._iterPrefetchedSubregions(subBBoxList, tempExpRefList, validBBoxList)
+            else:
+                subregionIter = ((subBBox, None) for subBBox in subBBoxList)
+            for subBBox, exposureList in subregionIter:
+                self._assembleSubregionOrLog(coaddExposureList, subBBox, subregionArgs, nImage=nImage,
+                                             exposureList=exposureList, validBBoxList=validBBoxList)
+
+    def makeStatsCtrl(self, mask, thresholdScale=1.0):
+        """!
+        \brief Make the statistics control object for stacking
+
+        \param[in] mask: Mask planes to exclude from the stack
+        \param[in] thresholdScale: Factor by which to scale config.maskPropagationThresholds, e.g. to
+                                   keep them relative to the total weight of all warps when some warps
+                                   are left out of the stack
+        \return afwMath.StatisticsControl
+        """
         statsCtrl = afwMath.StatisticsControl()
         statsCtrl.setNumSigmaClip(self.config.sigmaClip)
         statsCtrl.setNumIter(self.config.clipIter)
@@ -639,40 +1037,392 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
         statsCtrl.setCalcErrorFromInputVariance(True)
         for plane, threshold in self.config.maskPropagationThresholds.items():
             bit = afwImage.Mask.getMaskPlane(plane)
-            statsCtrl.setMaskPropagationThreshold(bit, threshold)
+            statsCtrl.setMaskPropagationThreshold(bit, threshold*thresholdScale)
+        return statsCtrl
 
-        statsFlags = afwMath.stringToStatisticsProperty(self.config.statistic)
+    def makeValidRegionIndex(self, coaddBBox, tempExpRefList):
+        """!
+        \brief Bound the valid region of each warp in the patch
 
-        if bgInfoList is None:
-            bgInfoList = [None]*len(tempExpRefList)
+        \param[in] coaddBBox: Bounding box of the patch
+        \param[in] tempExpRefList: List of data references to tempExp
+        \return list of the bounding box of the valid pixels of each warp, clipped to the patch (and empty if
+            the warp has no valid pixels in it), or None where it cannot be determined
+        """
+        validBBoxList = []
+        for tempExpRef in tempExpRefList:
+            try:
+                validBBox = self.getWarpValidBBox(tempExpRef, coaddBBox)
+            except Exception as e:
+                self.log.warn("Cannot determine the valid region of %s: %s", tempExpRef.dataId, e)
+                validBBox = None
+            validBBoxList.append(validBBox)
+        numBounded = sum(1 for validBBox in validBBoxList if validBBox is not None)
+        self.log.info("Bounded the valid region of %d of %d warps; mean coverage %.2f of the patch",
+                      numBounded, len(validBBoxList),
+                      sum(coaddBBox.getArea() if validBBox is None else validBBox.getArea()
+                          for validBBox in validBBoxList)/max(1, len(validBBoxList))/coaddBBox.getArea())
+        return validBBoxList
+
+    def getWarpValidBBox(self, tempExpRef, coaddBBox):
+        """!
+        \brief Bound the valid pixels of a warp from the CCDs in its CoaddInputs
 
-        if altMaskList is None:
-            altMaskList = [None]*len(tempExpRefList)
+        The valid polygon (or else the bounding box) of each CCD is mapped to the pixels of the warp along
+        its edges, and the result grown by a margin for the warping kernel.
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \param[in] coaddBBox: Bounding box of the patch
+        \return bounding box of the valid pixels of the warp clipped to coaddBBox (empty if there are none),
+            or None if the warp has no CCDs with a Wcs to bound it
+        """
+        warpInfo = self.readWarpInfo(tempExpRef)
+        warpWcs = warpInfo.getWcs()
+        coaddInputs = warpInfo.getInfo().getCoaddInputs()
+        if warpWcs is None or coaddInputs is None or len(coaddInputs.ccds) == 0:
+            return None
+        validBBox = afwGeom.Box2D()
+        for ccdRecord in coaddInputs.ccds:
+            ccdWcs = ccdRecord.getWcs()
+            if ccdWcs is None:
+                return None
+            validPolygon = ccdRecord.getValidPolygon()
+            ccdBBox = (validPolygon.getBBox() if validPolygon is not None else
+                       afwGeom.Box2D(ccdRecord.getBBox()))
+            corners = ccdBBox.getCorners()
+            for start, end in zip(corners, corners[1:] + corners[:1]):
+                for frac in numpy.linspace(0.0, 1.0, _VALID_REGION_EDGE_POINTS, endpoint=False):
+                    ccdPoint = afwGeom.Point2D(start.getX() + frac*(end.getX() - start.getX()),
+                                               start.getY() + frac*(end.getY() - start.getY()))
+                    validBBox.include(warpWcs.skyToPixel(ccdWcs.pixelToSky(ccdPoint)))
+        validBBox.grow(_VALID_REGION_MARGIN)
+        bbox = afwGeom.Box2I(validBBox, afwGeom.Box2I.EXPAND)
+        bbox.clip(coaddBBox)
+        return bbox
+
+    def assembleIncremental(self, dataRef, skyInfo, tempExpRefList):
+        """!
+        \brief Assemble a MEAN coadd by updating the accumulated sums of the previous run
+
+        The weighted sums of the warps are kept in a \ref MeanCoaddAccumulator next to the coadd (see
+        \ref getAccumulatorFilename). Warps that are not yet in the accumulator are read, weighted and added;
+        warps that are in the accumulator but no longer among the inputs are read again and subtracted;
+        the other warps are not read at all (apart from their metadata). If a warp has changed since it was
+        accumulated, or a warp to be removed can no longer be read as it was, or the accumulator was made
+        with a different configuration, the accumulator is rebuilt from all the warps.
+
+        \param[in] dataRef: Data reference defining the patch
+        \param[in] skyInfo: Patch geometry information, from getSkyInfo
+        \param[in] tempExpRefList: List of data references to Warps
+        \return pipeBase.Struct with coaddExposure, nImage if requested, or None if there are no warps
+        """
+        tempExpName = self.getTempExpDatasetName(self.warpType)
+        accumulatorFilename = self.getAccumulatorFilename(dataRef)
+        configKey = self.makeAccumulatorConfigKey(skyInfo)
+        accumulator = None
+        if os.path.exists(accumulatorFilename):
+            try:
+                accumulator = MeanCoaddAccumulator.readFrom(accumulatorFilename, configKey)
+            except Exception as e:
+                self.log.warn("Unable to read coadd accumulator %s: %s", accumulatorFilename, e)
+            if accumulator is None:
+                self.log.info("Rebuilding coadd accumulator %s", accumulatorFilename)
+
+        refDict = {}
+        for tempExpRef in tempExpRefList:
+            if tempExpRef.datasetExists(tempExpName):
+                refDict[self._getWarpKey(tempExpRef)] = tempExpRef
+
+        # Find the warps to remove; they must still be readable as they were accumulated
+        removeList = []
+        if accumulator is not None:
+            butler = dataRef.getButler()
+            for key, warpInfo in accumulator.warps.items():
+                tempExpRef = refDict.get(key)
+                if tempExpRef is None:
+                    tempExpRef = butler.dataRef(datasetType=tempExpName, dataId=warpInfo["dataId"])
+                    removeList.append((key, tempExpRef, ImageScaler(warpInfo["scale"])))
+                if self._getWarpIdentity(tempExpRef) != warpInfo["identity"]:
+                    self.log.info("%s %s has changed since it was accumulated", tempExpName,
+                                  warpInfo["dataId"])
+                    accumulator = None
+                    removeList = []
+                    break
+        if accumulator is None:
+            accumulator = MeanCoaddAccumulator(skyInfo.bbox, self.config.badMaskPlanes,
+                                               self.config.maskPropagationThresholds)
+
+        inputData = self.prepareInputs([tempExpRef for key, tempExpRef in sorted(refDict.items())
+                                        if key not in accumulator.warps])
+        for imageScaler in inputData.imageScalerList:
+            if type(imageScaler) is not ImageScaler:
+                raise RuntimeError("doIncremental requires a scalar photometric scaling, not %s" %
+                                   (type(imageScaler).__name__,))
+        self.log.info("Adding %d and removing %d %s; keeping %d", len(inputData.tempExpRefList),
+                      len(removeList), tempExpName, len(accumulator.warps) - len(removeList))
 
         coaddExposure = afwImage.ExposureF(skyInfo.bbox, skyInfo.wcs)
         coaddExposure.setCalib(self.scaleZeroPoint.getCalib())
         coaddExposure.getInfo().setCoaddInputs(self.inputRecorder.makeCoaddInputs())
-        self.assembleMetadata(coaddExposure, tempExpRefList, weightList)
-        coaddMaskedImage = coaddExposure.getMaskedImage()
-        subregionSizeArr = self.config.subregionSize
-        subregionSize = afwGeom.Extent2I(subregionSizeArr[0], subregionSizeArr[1])
-        # if nImage is requested, create a zero one which can be passed to assembleSubregion
-        if self.config.doNImage:
-            nImage = afwImage.ImageU(skyInfo.bbox)
-        else:
-            nImage = None
+        statsCtrl = afwMath.StatisticsControl()
+        subregionSize = afwGeom.Extent2I(*self.config.subregionSize)
         for subBBox in _subBBoxIter(skyInfo.bbox, subregionSize):
-            try:
-                self.assembleSubregion(coaddExposure, subBBox, tempExpRefList, imageScalerList,
-                                       weightList, bgInfoList, altMaskList, statsFlags, statsCtrl,
-                                       nImage=nImage)
-            except Exception as e:
-                self.log.fatal("Cannot compute coadd %s: %s", subBBox, e)
+            for key, tempExpRef, imageScaler in removeList:
+                maskedImage = self.readSubregionInputs(coaddExposure, subBBox, [tempExpRef], [imageScaler],
+                                                       [None], [None], statsCtrl).maskedImageList[0]
+                accumulator.remove(key, maskedImage)
+            for tempExpRef, imageScaler, weight in zip(inputData.tempExpRefList, inputData.imageScalerList,
+                                                       inputData.weightList):
+                maskedImage = self.readSubregionInputs(coaddExposure, subBBox, [tempExpRef], [imageScaler],
+                                                       [None], [None], statsCtrl).maskedImageList[0]
+                warpInfo = dict(dataId=tempExpRef.dataId, scale=imageScaler._scale,
+                                identity=self._getWarpIdentity(tempExpRef))
+                accumulator.add(self._getWarpKey(tempExpRef), maskedImage, weight, warpInfo=warpInfo)
+        for key, tempExpRef, imageScaler in removeList:
+            accumulator.forget(key)
+
+        if not accumulator.warps:
+            return None
+        try:
+            accumulatorDir = os.path.dirname(accumulatorFilename)
+            if accumulatorDir and not os.path.isdir(accumulatorDir):
+                os.makedirs(accumulatorDir)
+            accumulator.writeTo(accumulatorFilename, configKey)
+        except Exception as e:
+            self.log.warn("Unable to write coadd accumulator %s: %s", accumulatorFilename, e)
 
+        keyList = sorted(accumulator.warps)
+        self.assembleMetadata(coaddExposure, [refDict[key] for key in keyList],
+                              [accumulator.warps[key]["weight"] for key in keyList])
+        maskedImage, nImage = accumulator.makeCoadd()
+        coaddExposure.setMaskedImage(maskedImage)
+        coaddMaskedImage = coaddExposure.getMaskedImage()
         coaddUtils.setCoaddEdgeBits(coaddMaskedImage.getMask(), coaddMaskedImage.getVariance())
-        return pipeBase.Struct(coaddExposure=coaddExposure, nImage=nImage)
+        return pipeBase.Struct(coaddExposure=coaddExposure, nImage=nImage if self.config.doNImage else None)
+
+    def getAccumulatorFilename(self, dataRef):
+        """!
+        \brief Return the name of the file of accumulated sums of an incremental coadd, next to the coadd
+
+        \param[in] dataRef: Data reference defining the patch
+        """
+        coaddFilename = dataRef.get(self.getCoaddDatasetName(self.warpType) + "_filename")[0]
+        return coaddFilename + ".accumulator.npz"
+
+    def makeAccumulatorConfigKey(self, skyInfo):
+        """!
+        \brief Return a key identifying the configuration with which warps are accumulated
+
+        \param[in] skyInfo: Patch geometry information, from getSkyInfo
+        \return key, as a hex digest string
+        """
+        keyDict = dict(
+            bbox=str(skyInfo.bbox),
+            warpType=self.warpType,
+            sigmaClip=self.config.sigmaClip,
+            clipIter=self.config.clipIter,
+            badMaskPlanes=sorted(self.config.badMaskPlanes),
+            removeMaskPlanes=sorted(self.config.removeMaskPlanes),
+            maskPropagationThresholds=dict(self.config.maskPropagationThresholds.items()),
+            scaleZeroPointTask=type(self.scaleZeroPoint).__name__,
+            scaleZeroPoint=self.scaleZeroPoint.config.toDict(),
+        )
+        return hashlib.sha1(json.dumps(keyDict, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _getWarpKey(self, tempExpRef):
+        """!
+        \brief Return a string identifying a warp by its dataId
+        """
+        return json.dumps(sorted((str(k), str(v)) for k, v in tempExpRef.dataId.items()))
+
+    def _getWarpIdentity(self, tempExpRef):
+        """!
+        \brief Return the name, modification time and size of the file of a warp, or None if it does not exist
+        """
+        tempExpName = self.getTempExpDatasetName(self.warpType)
+        if not tempExpRef.datasetExists(tempExpName):
+            return None
+        warpFilename = tempExpRef.get(tempExpName + "_filename")[0]
+        fileStat = os.stat(warpFilename)
+        return [os.path.abspath(warpFilename), fileStat.st_mtime, fileStat.st_size]
+
+    def assembleSubregionsParallel(self, coaddExposureList, subBBoxList, subregionArgs, nImage=None,
+                                   validBBoxList=None):
+        """!
+        \brief Assemble a list of subregions concurrently using a pool of config.numWorkers workers
+
+        Each subregion is stacked independently by \ref assembleSubregionStatistics, so the result is
+        identical to assembling the subregions serially. With config.parallelType="thread" the workers write
+        directly into their (disjoint) slices of the coadds and nImage. With config.parallelType="process"
+        the workers are forked from this process, so they inherit the inputs without pickling them; each
+        worker returns the pixels of its subregion, which are copied into the coadds and nImage here.
+
+        \param[in,out] coaddExposureList: The target images for the coadds, one for each statistic
+        \param[in] subBBoxList: List of sub-regions to coadd
+        \param[in] subregionArgs: Tuple of the remaining positional arguments of
+                                   \ref assembleSubregionStatistics
+        \param[in,out] nImage: optional ImageU keeps track of exposure count for each pixel
+        \param[in] validBBoxList: optional list of the valid region of each tempExp
+                                  (see \ref makeValidRegionIndex)
+        """
+        numWorkers = min(self.config.numWorkers, len(subBBoxList))
+        self.log.info("Assembling %d subregions with %d %s workers", len(subBBoxList), numWorkers,
+                      self.config.parallelType)
+        if self.config.parallelType == "thread":
+            pool = ThreadPool(numWorkers)
+            try:
+                pool.map(lambda subBBox: self._assembleSubregionOrLog(coaddExposureList, subBBox,
+                                                                      subregionArgs, nImage=nImage,
+                                                                      validBBoxList=validBBoxList),
+                         subBBoxList)
+            finally:
+                pool.close()
+                pool.join()
+            return
+
+        global _subregionWorkerState
+        _subregionWorkerState = pipeBase.Struct(task=self, coaddExposureList=coaddExposureList,
+                                                subBBoxList=subBBoxList, subregionArgs=subregionArgs,
+                                                nImage=nImage, validBBoxList=validBBoxList)
+        pool = _getForkContext().Pool(numWorkers)
+        try:
+            for result in pool.imap_unordered(_assembleSubregionWorker, range(len(subBBoxList))):
+                if result is None:
+                    continue
+                index, planesList, nImageArr = result
+                subBBox = subBBoxList[index]
+                for coaddExposure, planes in zip(coaddExposureList, planesList):
+                    _assignCoaddSubregion(coaddExposure, subBBox, *planes)
+                if nImageArr is not None:
+                    _assignNImageSubregion(nImage, subBBox, nImageArr)
+        finally:
+            pool.close()
+            pool.join()
+            _subregionWorkerState = None
+
+    def _iterPrefetchedSubregions(self, subBBoxList, tempExpRefList, validBBoxList=None):
+        """!
+        \brief Iterate over subregions, reading the warps of upcoming subregions on background threads
+
+        A reader thread reads the subregion of every warp for each subregion in turn, using a pool of
+        config.numIoThreads threads, and hands them over through a queue, so reading the next subregions
+        overlaps with stacking the current one. A subregion counts against config.prefetchDepth from the
+        moment its read starts until it is handed over for stacking, so at most config.prefetchDepth
+        subregions are held besides the one being stacked. If the warps of a subregion cannot be read,
+        None is yielded in place of its exposure list and the subregion is read (and the failure
+        reported) by \ref assembleSubregionStatistics.
+
+        \param[in] subBBoxList: List of sub-regions to coadd
+        \param[in] tempExpRefList: List of data references to tempExp
+        \param[in] validBBoxList: optional list of the valid region of each tempExp; tempExps that do not
+                                  overlap a subregion are not read, and None is yielded in their place
+        \return iterator over (subBBox, exposureList) tuples in the order of subBBoxList
+        """
+        readQueue = queue.Queue()
+        # One slot per subregion being read or waiting in the queue; the reader takes a slot before it
+        # starts reading and the consumer frees it on taking the subregion, so at most prefetchDepth
+        # subregions are held besides the one being stacked
+        readSlots = threading.Semaphore(self.config.prefetchDepth)
+        stopReading = threading.Event()
+        readPool = ThreadPool(max(1, min(self.config.numIoThreads, len(tempExpRefList))))
+        if validBBoxList is None:
+            validBBoxList = [None]*len(tempExpRefList)
+
+        def readAhead():
+            for subBBox in subBBoxList:
+                while not readSlots.acquire(timeout=0.1):
+                    if stopReading.is_set():
+                        return
+                if stopReading.is_set():
+                    return
+                try:
+                    exposureList = readPool.map(
+                        lambda item: (self.readWarpSubregion(item[0], subBBox)
+                                      if item[1] is None or item[1].overlaps(subBBox) else None),
+                        list(zip(tempExpRefList, validBBoxList)))
+                except Exception as e:
+                    self.log.warn("Cannot read ahead warps for %s: %s", subBBox, e)
+                    exposureList = None
+                readQueue.put((subBBox, exposureList))
+
+        reader = threading.Thread(target=readAhead)
+        reader.daemon = True
+        reader.start()
+        try:
+            for i in range(len(subBBoxList)):
+                item = readQueue.get()
+                readSlots.release()
+                yield item
+        finally:
+            stopReading.set()
+            reader.join()
+            readPool.close()
+            readPool.join()
+
+    def readWarp(self, tempExpRef, warpType=None):
+        """!
+        \brief Read a full warp
+
+        Reads through the \ref WarpReader "WarpReader" cache if config.useWarpReaderCache, else through
+        the butler.
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \param[in] warpType: Type of warp to read; defaults to the warp type being coadded
+        \return Exposure containing the warp
+        """
+        tempExpName = self.getTempExpDatasetName(warpType if warpType is not None else self.warpType)
+        if self.warpReaderCache is not None:
+            return self.warpReaderCache.get(tempExpRef, tempExpName).read()
+        return tempExpRef.get(tempExpName, immediate=True)
+
+    def readWarpSubregion(self, tempExpRef, bbox, warpType=None):
+        """!
+        \brief Read a subregion of a warp
+
+        Reads through the \ref WarpReader "WarpReader" cache if config.useWarpReaderCache, else through
+        the butler.
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \param[in] bbox: Sub-region to read
+        \param[in] warpType: Type of warp to read; defaults to the warp type being coadded
+        \return Exposure containing the subregion of the warp
+        """
+        tempExpName = self.getTempExpDatasetName(warpType if warpType is not None else self.warpType)
+        if self.warpReaderCache is not None:
+            return self.warpReaderCache.get(tempExpRef, tempExpName).readSubregion(bbox)
+        return tempExpRef.get(tempExpName + "_sub", bbox=bbox)
+
+    def readWarpInfo(self, tempExpRef):
+        """!
+        \brief Read the non-pixel components of a warp (metadata, Wcs, Psf, Calib, filter and CoaddInputs)
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \return Exposure with a single pixel of the warp
+        """
+        tempExpName = self.getTempExpDatasetName(self.warpType)
+        if self.warpReaderCache is not None:
+            return self.warpReaderCache.get(tempExpRef, tempExpName).getInfo()
+        # We load a single pixel of each coaddTempExp, because we just want to get at the metadata
+        # (and we need more than just the PropertySet that contains the header), which is not possible
+        # with the current butler (see #2777).
+        return tempExpRef.get(tempExpName + "_sub",
+                              bbox=afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(1, 1)),
+                              imageOrigin="LOCAL", immediate=True)
+
+    def _assembleSubregionOrLog(self, coaddExposureList, subBBox, subregionArgs, **kwargs):
+        """!
+        \brief Call \ref assembleSubregionStatistics, logging rather than raising any failure
+
+        \return True if the subregion was assembled
+        """
+        try:
+            self.assembleSubregionStatistics(coaddExposureList, subBBox, *subregionArgs, **kwargs)
+        except Exception as e:
+            self.log.fatal("Cannot compute coadd %s: %s", subBBox, e)
+            return False
+        return True
 
-    def assembleMetadata(self, coaddExposure, tempExpRefList, weightList):
+    def assembleMetadata(self, coaddExposure, tempExpRefList, weightList, tempExpInfoList=None):
         """!
         \brief Set the metadata for the coadd
 
@@ -682,15 +1432,15 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
         \param[in] coaddExposure: The target image for the coadd
         \param[in] tempExpRefList: List of data references to tempExp
         \param[in] weightList: List of weights
+        \param[in] tempExpInfoList: optional list of the non-pixel components of each tempExp, as returned
+                                    by \ref readWarpInfo; read from tempExpRefList if None
         """
         assert len(tempExpRefList) == len(weightList), "Length mismatch"
-        tempExpName = self.getTempExpDatasetName(self.warpType)
-        # We load a single pixel of each coaddTempExp, because we just want to get at the metadata
-        # (and we need more than just the PropertySet that contains the header), which is not possible
-        # with the current butler (see #2777).
-        tempExpList = [tempExpRef.get(tempExpName + "_sub",
-                                      bbox=afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(1, 1)),
-                                      imageOrigin="LOCAL", immediate=True) for tempExpRef in tempExpRefList]
+        if tempExpInfoList is None:
+            tempExpList = [self.readWarpInfo(tempExpRef) for tempExpRef in tempExpRefList]
+        else:
+            assert len(tempExpInfoList) == len(tempExpRefList), "Length mismatch"
+            tempExpList = tempExpInfoList
         numCcds = sum(len(tempExp.getInfo().getCoaddInputs().ccds) for tempExp in tempExpList)
 
         coaddExposure.setFilter(tempExpList[0].getFilter())
@@ -718,14 +1468,12 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
         coaddExposure.getInfo().setApCorrMap(apCorrMap)
 
     def assembleSubregion(self, coaddExposure, bbox, tempExpRefList, imageScalerList, weightList,
-                          bgInfoList, altMaskList, statsFlags, statsCtrl, nImage=None):
+                          bgInfoList, altMaskList, statsFlags, statsCtrl, nImage=None, exposureList=None):
         """!
         \brief Assemble the coadd for a sub-region.
 
-        For each coaddTempExp, check for (and swap in) an alternative mask if one is passed. If background
-        matching is enabled, add the background and background variance from each coaddTempExp. Remove mask
-        planes listed in config.removeMaskPlanes, Finally, stack the actual exposures using
-        \ref afwMath.statisticsStack "statisticsStack" with the statistic specified
+        Prepare the subregion of each coaddTempExp with \ref readSubregionInputs, then stack the actual
+        exposures using \ref afwMath.statisticsStack "statisticsStack" with the statistic specified
         by statsFlags. Typically, the statsFlag will be one of afwMath.MEAN for a mean-stack or
         afwMath.MEANCLIP for outlier rejection using an N-sigma clipped mean where N and iterations
         are specified by statsCtrl.  Assign the stacked subregion back to the coadd.
@@ -736,55 +1484,437 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
         \param[in] imageScalerList: List of image scalers
         \param[in] weightList: List of weights
         \param[in] bgInfoList: List of background data from background matching
-        \param[in] altMaskList: List of alternate masks to use rather than those stored with tempExp, or None
+        \param[in] altMaskList: List of alternate masks to use rather than those stored with tempExp, or None;
+                                each is either a full-patch Mask, or a dict of mask plane name: list of
+                                SpanSets to set in the tempExp mask (see \ref applyAltMaskPlanes)
         \param[in] statsFlags: afwMath.Property object for statistic for coadd
         \param[in] statsCtrl: Statistics control object for coadd
         \param[in] nImage: optional ImageU keeps track of exposure count for each pixel
+        \param[in] exposureList: optional list of the subregion of each tempExp, already read
+                                 (e.g. by \ref readWarpSubregion on a read-ahead thread); if None, read them
+        """
+        self.assembleSubregionStatistics([coaddExposure], bbox, tempExpRefList, imageScalerList, weightList,
+                                         bgInfoList, altMaskList, [statsFlags], statsCtrl, nImage=nImage,
+                                         exposureList=exposureList)
+
+    def assembleSubregionStatistics(self, coaddExposureList, bbox, tempExpRefList, imageScalerList,
+                                    weightList, bgInfoList, altMaskList, statsFlagsList, statsCtrl,
+                                    nImage=None, exposureList=None, validBBoxList=None):
+        """!
+        \brief Assemble the coadds for a sub-region with one or more statistics
+
+        Prepare the subregion of each coaddTempExp once with \ref readSubregionInputs, then stack them with
+        each statistic in statsFlagsList and assign each stacked subregion to the corresponding coadd.
+        If the stack would exceed config.maxStackMemory, the subregion of each coaddTempExp is instead read
+        and prepared once into a scratch file (see \ref stageSubregionInputs), from which bands of rows of
+        the stack are stacked in turn (see \ref getStackBandHeight). Every statistic is computed pixel by
+        pixel, so the coadd is unchanged, while the memory needed no longer grows with the depth of the
+        stack times the subregion height, and the deepest stacks need no smaller subregionSize (and no more
+        reads per warp).
+
+        If validBBoxList is given, the tempExps whose valid region does not overlap the subregion are
+        neither read nor stacked. Their pixels would all be excluded from the stack as NO_DATA, so only
+        the mask propagation thresholds, which are relative to the total weight of the stack, need to be
+        scaled to leave the coadd unchanged.
+
+        \param[in] coaddExposureList: The target images for the coadds, one for each statistic
+        \param[in] bbox: Sub-region to coadd
+        \param[in] tempExpRefList: List of data reference to tempExp
+        \param[in] imageScalerList: List of image scalers
+        \param[in] weightList: List of weights
+        \param[in] bgInfoList: List of background data from background matching
+        \param[in] altMaskList: List of alternate masks to use rather than those stored with tempExp, or None;
+                                each is either a full-patch Mask, or a dict of mask plane name: list of
+                                SpanSets to set in the tempExp mask (see \ref applyAltMaskPlanes)
+        \param[in] statsFlagsList: List of afwMath.Property objects for the statistic of each coadd
+        \param[in] statsCtrl: Statistics control object for coadd
+        \param[in] nImage: optional ImageU keeps track of exposure count for each pixel
+        \param[in] exposureList: optional list of the subregion of each tempExp, already read
+                                 (e.g. by \ref readWarpSubregion on a read-ahead thread); if None, read them
+        \param[in] validBBoxList: optional list of the valid region of each tempExp
+                                  (see \ref makeValidRegionIndex)
         """
         self.log.debug("Computing coadd over %s", bbox)
-        tempExpName = self.getTempExpDatasetName(self.warpType)
-        coaddMaskedImage = coaddExposure.getMaskedImage()
-        maskedImageList = []
+        totalWeight = sum(weightList)
+        if validBBoxList is not None:
+            keep = [i for i, validBBox in enumerate(validBBoxList)
+                    if validBBox is None or validBBox.overlaps(bbox)]
+            # statisticsStack needs at least one input; an all-NO_DATA one gives the same result
+            keep = keep or [0]
+            if len(keep) < len(tempExpRefList):
+                self.log.debug("Skipping %d of %d warps that do not overlap %s",
+                               len(tempExpRefList) - len(keep), len(tempExpRefList), bbox)
+                if self.config.maskPropagationThresholds:
+                    statsCtrl = self.makeStatsCtrl(statsCtrl.getAndMask(),
+                                                   sum(weightList)/sum(weightList[i] for i in keep))
+                tempExpRefList, imageScalerList, weightList, bgInfoList, altMaskList = (
+                    [inputList[i] for i in keep] for inputList in
+                    (tempExpRefList, imageScalerList, weightList, bgInfoList, altMaskList))
+                if exposureList is not None:
+                    exposureList = [exposureList[i] for i in keep]
+        statisticNames = [_CUBE_STATISTICS_BY_PROPERTY.get(statsFlags) for statsFlags in statsFlagsList]
+        useCube = self.config.stackBackend == "numpy" and None not in statisticNames
+        bandHeight = self.getStackBandHeight(bbox, len(tempExpRefList))
+        if bandHeight >= bbox.getHeight():
+            if useCube:
+                inputs = self.readSubregionCube(coaddExposureList[0], bbox, tempExpRefList, imageScalerList,
+                                                bgInfoList, altMaskList, statsCtrl,
+                                                doNImage=nImage is not None, exposureList=exposureList)
+                self._stackCubeStatistics(coaddExposureList, bbox, inputs.imageCube, inputs.maskCube,
+                                          inputs.varianceCube, weightList, statisticNames, statsCtrl,
+                                          totalWeight)
+            else:
+                inputs = self.readSubregionInputs(coaddExposureList[0], bbox, tempExpRefList,
+                                                  imageScalerList, bgInfoList, altMaskList, statsCtrl,
+                                                  doNImage=nImage is not None, exposureList=exposureList)
+                self._stackStatistics(coaddExposureList, bbox, inputs.maskedImageList, weightList,
+                                      statsFlagsList, statsCtrl)
+            if nImage is not None:
+                _assignNImageSubregion(nImage, bbox, inputs.nImage.getArray())
+            return
+
+        self.log.debug("Stacking %s in bands of %d rows", bbox, bandHeight)
+        stagedStack = self.stageSubregionInputs(coaddExposureList[0], bbox, tempExpRefList, imageScalerList,
+                                                bgInfoList, altMaskList, statsCtrl, useCube,
+                                                nImage=nImage, exposureList=exposureList)
+        del exposureList
+        try:
+            for y0 in range(bbox.getMinY(), bbox.getMaxY() + 1, bandHeight):
+                height = min(bandHeight, bbox.getMaxY() + 1 - y0)
+                bandBBox = afwGeom.Box2I(afwGeom.Point2I(bbox.getMinX(), y0),
+                                         afwGeom.Extent2I(bbox.getWidth(), height))
+                if useCube:
+                    imageCube, maskCube, varianceCube = stagedStack.getBandCubes(bandBBox)
+                    self._stackCubeStatistics(coaddExposureList, bandBBox, imageCube, maskCube, varianceCube,
+                                              weightList, statisticNames, statsCtrl, totalWeight)
+                    del imageCube, maskCube, varianceCube
+                else:
+                    self._stackStatistics(coaddExposureList, bandBBox,
+                                          stagedStack.getBandMaskedImages(bandBBox), weightList,
+                                          statsFlagsList, statsCtrl)
+        finally:
+            stagedStack.close()
+
+    def stageSubregionInputs(self, coaddExposure, bbox, tempExpRefList, imageScalerList, bgInfoList,
+                             altMaskList, statsCtrl, useCube, nImage=None, exposureList=None):
+        """!
+        \brief Read and prepare the sub-region of each coaddTempExp once, into a scratch file
+
+        Each coaddTempExp is read and prepared in turn, as by \ref readSubregionCube if useCube, else by
+        \ref readSubregionInputs, and written to a \ref StagedStack in config.stagingDir. The stack can
+        then be stacked in bands of rows without reading any coaddTempExp again; only one prepared
+        sub-region is held in memory at a time.
+
+        \param[in] coaddExposure: The target image for the coadd (only its xy0 is used)
+        \param[in] bbox: Sub-region to coadd
+        \param[in] tempExpRefList: List of data reference to tempExp
+        \param[in] imageScalerList: List of image scalers
+        \param[in] bgInfoList: List of background data from background matching
+        \param[in] altMaskList: List of alternate masks (see \ref readSubregionInputs)
+        \param[in] statsCtrl: Statistics control object for coadd; its AndMask excludes pixels from nImage
+        \param[in] useCube: prepare the sub-regions as for \ref stackCube rather than statisticsStack?
+        \param[in,out] nImage: optional ImageU in which to set the exposure count of each pixel of the
+                               sub-region
+        \param[in] exposureList: optional list of the subregion of each tempExp, already read
+        \return StagedStack of the prepared sub-region of each tempExp; the caller must close it
+        """
+        stagedStack = StagedStack(bbox, len(tempExpRefList), self.config.stagingDir)
+        # Drop each read subregion as soon as it is staged
+        exposureList = [None]*len(tempExpRefList) if exposureList is None else list(exposureList)
+        subNImageArr = None
+        if nImage is not None:
+            subNImageArr = numpy.zeros((bbox.getHeight(), bbox.getWidth()),
+                                       dtype=afwImage.ImageU(1, 1).getArray().dtype)
+        try:
+            for i, inputArgs in enumerate(zip(tempExpRefList, imageScalerList, bgInfoList, altMaskList,
+                                              exposureList)):
+                tempExpRef, imageScaler, bgInfo, altMask, exposure = inputArgs
+                if useCube:
+                    inputs = self.readSubregionCube(coaddExposure, bbox, [tempExpRef], [imageScaler],
+                                                    [bgInfo], [altMask], statsCtrl,
+                                                    doNImage=nImage is not None, exposureList=[exposure])
+                    stagedStack.assignInput(i, inputs.imageCube[0], inputs.maskCube[0],
+                                            inputs.varianceCube[0])
+                else:
+                    inputs = self.readSubregionInputs(coaddExposure, bbox, [tempExpRef], [imageScaler],
+                                                      [bgInfo], [altMask], statsCtrl,
+                                                      doNImage=nImage is not None, exposureList=[exposure])
+                    maskedImage = inputs.maskedImageList[0]
+                    stagedStack.assignInput(i, maskedImage.getImage().getArray(),
+                                            maskedImage.getMask().getArray(),
+                                            maskedImage.getVariance().getArray())
+                if subNImageArr is not None:
+                    subNImageArr += inputs.nImage.getArray()
+                del inputs, exposure
+                exposureList[i] = None
+        except Exception:
+            stagedStack.close()
+            raise
         if nImage is not None:
+            _assignNImageSubregion(nImage, bbox, subNImageArr)
+        return stagedStack
+
+    def _stackStatistics(self, coaddExposureList, bbox, maskedImageList, weightList, statsFlagsList,
+                         statsCtrl):
+        """!
+        \brief Stack prepared sub-regions with statisticsStack and assign them to each coadd
+        """
+        for coaddExposure, statsFlags in zip(coaddExposureList, statsFlagsList):
+            with self.timer("stack"):
+                coaddSubregion = afwMath.statisticsStack(maskedImageList, statsFlags, statsCtrl, weightList)
+            _assignCoaddSubregion(coaddExposure, bbox, coaddSubregion.getImage().getArray(),
+                                  coaddSubregion.getMask().getArray(),
+                                  coaddSubregion.getVariance().getArray())
+
+    def _stackCubeStatistics(self, coaddExposureList, bbox, imageCube, maskCube, varianceCube, weightList,
+                             statisticNames, statsCtrl, totalWeight):
+        """!
+        \brief Stack prepared sub-region cubes with \ref stackCube and assign them to each coadd
+        """
+        maskPropagationThresholds = {afwImage.Mask.getPlaneBitMask(plane): threshold
+                                     for plane, threshold in self.config.maskPropagationThresholds.items()}
+        for coaddExposure, statistic in zip(coaddExposureList, statisticNames):
+            with self.timer("stack"):
+                imageArr, maskArr, varianceArr = stackCube(
+                    imageCube, maskCube, varianceCube, weightList, statistic,
+                    statsCtrl.getAndMask(), self.config.sigmaClip, self.config.clipIter,
+                    maskPropagationThresholds=maskPropagationThresholds,
+                    totalWeight=totalWeight,
+                    noGoodPixelsMask=afwImage.Mask.getPlaneBitMask("NO_DATA"))
+            _assignCoaddSubregion(coaddExposure, bbox, imageArr, maskArr, varianceArr)
+
+    def chooseSubregionSize(self, bbox, numInputs, numStatistics, altMaskList):
+        """!
+        \brief Choose the subregion size so that assembling a patch fits in config.maxMemoryBytes
+
+        The estimated peak is the sum of:
+        - the coadds (one MaskedImageF per statistic) and nImage, over the whole patch;
+        - alternate masks given as full-patch Masks (SpanSets are small and are not counted);
+        - the stacks of warp subregions, and the stacked subregions, held at once: one per worker if
+          numWorkers > 1, else one plus config.prefetchDepth read ahead.
+        All the statistics of statisticsStack hold the same stack, so the statistic itself does not change
+        the estimate. The subregion size is then chosen by \ref subregionSizeForBudget.
+
+        \param[in] bbox: Bounding box of the patch
+        \param[in] numInputs: Number of warps to stack
+        \param[in] numStatistics: Number of statistics (coadds) computed at once
+        \param[in] altMaskList: List of alternate masks, as passed to \ref assembleStatistics
+        \return subregion size, as an afwGeom.Extent2I
+        \throw RuntimeError if config.maxMemoryBytes cannot hold the parts that do not depend on the
+            subregion size (see \ref subregionSizeForBudget)
+        """
+        maskedImageBytes = 3*4  # 4-byte image, mask and variance pixels of a MaskedImageF
+        patchArea = bbox.getArea()
+        fixedBytes = patchArea*(numStatistics*maskedImageBytes + (2 if self.config.doNImage else 0))
+        numAltMasks = sum(1 for altMask in altMaskList
+                          if altMask is not None and not isinstance(altMask, dict))
+        fixedBytes += numAltMasks*patchArea*4
+        if self.config.numWorkers > 1:
+            numStacks = self.config.numWorkers
+        else:
+            numStacks = 1 + self.config.prefetchDepth
+        bytesPerPixel = numStacks*(numInputs + numStatistics)*maskedImageBytes
+        subregionSize = subregionSizeForBudget(bbox, self.config.maxMemoryBytes, fixedBytes, bytesPerPixel)
+        width, height = subregionSize.getX(), subregionSize.getY()
+        if height == 1 and width < bbox.getWidth():
+            self.log.warn("maxMemoryBytes=%d is too small for %d warps; assembling %d pixels of a row at a "
+                          "time", self.config.maxMemoryBytes, numInputs, width)
+        self.log.info("Using subregions of %dx%d for %d warps: estimated peak memory %.1f MiB",
+                      width, height, numInputs, (fixedBytes + width*height*bytesPerPixel)/2.0**20)
+        return subregionSize
+
+    def getStackBandHeight(self, bbox, numInputs):
+        """!
+        \brief Return the number of rows of a subregion to stack at once within config.maxStackMemory
+
+        The stack of a band holds the image, mask and variance of every input, and its coadd. While the
+        stack is staged (see \ref stageSubregionInputs), only one input sub-region is held at a time.
+
+        \param[in] bbox: Sub-region to coadd
+        \param[in] numInputs: Number of warps in the stack
+        \return number of rows, at least 1 and at most the height of bbox
+        """
+        if self.config.maxStackMemory <= 0:
+            return bbox.getHeight()
+        # 4-byte image, mask and variance pixels of a MaskedImageF
+        bytesPerRow = bbox.getWidth()*(numInputs + 1)*3*4
+        return max(1, min(bbox.getHeight(), self.config.maxStackMemory//bytesPerRow))
+
+    def readSubregionInputs(self, coaddExposure, bbox, tempExpRefList, imageScalerList, bgInfoList,
+                            altMaskList, statsCtrl, doNImage=False, exposureList=None):
+        """!
+        \brief Read and prepare the sub-region of each coaddTempExp for stacking
+
+        For each coaddTempExp, check for (and swap in) an alternative mask if one is passed (see
+        \ref readSubregionMaskedImage). Scale it to the photometric zero point. If background matching is
+        enabled, add the background and background variance from each coaddTempExp. Remove mask planes
+        listed in config.removeMaskPlanes.
+
+        \param[in] coaddExposure: The target image for the coadd (only its xy0 is used)
+        \param[in] bbox: Sub-region to coadd
+        \param[in] tempExpRefList: List of data reference to tempExp
+        \param[in] imageScalerList: List of image scalers
+        \param[in] bgInfoList: List of background data from background matching
+        \param[in] altMaskList: List of alternate masks to use rather than those stored with tempExp, or None;
+                                each is either a full-patch Mask, or a dict of mask plane name: list of
+                                SpanSets to set in the tempExp mask (see \ref applyAltMaskPlanes)
+        \param[in] statsCtrl: Statistics control object for coadd; its AndMask excludes pixels from nImage
+        \param[in] doNImage: count the exposures contributing to each pixel?
+        \param[in] exposureList: optional list of the subregion of each tempExp, already read
+                                 (e.g. by \ref readWarpSubregion on a read-ahead thread); if None, read them
+        \return pipeBase.Struct with:
+        - maskedImageList: list of the prepared sub-region of each tempExp
+        - nImage: ImageU with the exposure count of each pixel of the sub-region if doNImage, else None
+        """
+        coaddXY0 = coaddExposure.getXY0()
+        removeMask = self.getRemoveMaskPlanesBitMask()
+        maskedImageList = []
+        subNImage = None
+        if doNImage:
             subNImage = afwImage.ImageU(bbox.getWidth(), bbox.getHeight())
-        for tempExpRef, imageScaler, bgInfo, altMask in zip(tempExpRefList, imageScalerList, bgInfoList,
-                                                            altMaskList):
-            exposure = tempExpRef.get(tempExpName + "_sub", bbox=bbox)
-            maskedImage = exposure.getMaskedImage()
-            if altMask:
-                altMaskSub = altMask.Factory(altMask, bbox, afwImage.PARENT)
-                maskedImage.getMask().swap(altMaskSub)
+        if exposureList is None:
+            exposureList = [None]*len(tempExpRefList)
+        for tempExpRef, imageScaler, bgInfo, altMask, exposure in zip(tempExpRefList, imageScalerList,
+                                                                      bgInfoList, altMaskList, exposureList):
+            maskedImage = self.readSubregionMaskedImage(tempExpRef, bbox, altMask, exposure)
             imageScaler.scaleMaskedImage(maskedImage)
 
-            if self.config.doMatchBackgrounds and not bgInfo.isReference:
-                backgroundModel = bgInfo.backgroundModel
-                backgroundImage = backgroundModel.getImage() if \
-                    self.matchBackgrounds.config.usePolynomial else \
-                    backgroundModel.getImageF()
-                backgroundImage.setXY0(coaddMaskedImage.getXY0())
-                maskedImage += backgroundImage.Factory(backgroundImage, bbox, afwImage.PARENT, False)
+            backgroundImage = self.getBackgroundSubregion(bgInfo, bbox, coaddXY0)
+            if backgroundImage is not None:
+                maskedImage += backgroundImage
                 var = maskedImage.getVariance()
                 var += (bgInfo.fitRMS)**2
             # Add 1 for each pixel which is not excluded by the exclude mask.
             # In legacyCoadd, pixels may also be excluded by afwMath.statisticsStack.
-            if nImage is not None:
+            if subNImage is not None:
                 subNImage.getArray()[maskedImage.getMask().getArray() & statsCtrl.getAndMask() == 0] += 1
-            if self.config.removeMaskPlanes:
+            if removeMask:
                 mask = maskedImage.getMask()
-                for maskPlane in self.config.removeMaskPlanes:
-                    try:
-                        mask &= ~mask.getPlaneBitMask(maskPlane)
-                    except Exception as e:
-                        self.log.warn("Unable to remove mask plane %s: %s", maskPlane, e.message)
+                mask &= ~removeMask
 
             maskedImageList.append(maskedImage)
+        return pipeBase.Struct(maskedImageList=maskedImageList, nImage=subNImage)
 
-        with self.timer("stack"):
-            coaddSubregion = afwMath.statisticsStack(
-                maskedImageList, statsFlags, statsCtrl, weightList)
-        coaddMaskedImage.assign(coaddSubregion, bbox)
-        if nImage is not None:
-            nImage.assign(subNImage, bbox)
+    def readSubregionMaskedImage(self, tempExpRef, bbox, altMask, exposure=None):
+        """!
+        \brief Read the sub-region of a coaddTempExp and swap in its alternative mask, if any
+
+        Alternative masks given as SpanSets (see \ref applyAltMaskPlanes) are rasterized onto the
+        sub-region of the coaddTempExp's own mask; full-patch Masks replace it.
+
+        \param[in] tempExpRef: Data reference to tempExp
+        \param[in] bbox: Sub-region to read
+        \param[in] altMask: Alternate mask (see \ref readSubregionInputs), or None
+        \param[in] exposure: optional subregion of the tempExp, already read; if None, read it
+        \return MaskedImage of the sub-region of the tempExp
+        """
+        if exposure is None:
+            exposure = self.readWarpSubregion(tempExpRef, bbox)
+        maskedImage = exposure.getMaskedImage()
+        if altMask:
+            if isinstance(altMask, dict):
+                applyAltMaskPlanes(maskedImage.getMask(), altMask)
+            else:
+                altMaskSub = altMask.Factory(altMask, bbox, afwImage.PARENT)
+                maskedImage.getMask().swap(altMaskSub)
+        return maskedImage
+
+    def getBackgroundSubregion(self, bgInfo, bbox, coaddXY0):
+        """!
+        \brief Return the sub-region of the matched background model to add to a coaddTempExp
+
+        \param[in] bgInfo: Background data of the tempExp from background matching
+        \param[in] bbox: Sub-region
+        \param[in] coaddXY0: xy0 of the coadd
+        \return Image of the background model over bbox, or None if backgrounds are not matched or the
+            tempExp is the reference
+        """
+        if not self.config.doMatchBackgrounds or bgInfo.isReference:
+            return None
+        backgroundModel = bgInfo.backgroundModel
+        backgroundImage = backgroundModel.getImage() if \
+            self.matchBackgrounds.config.usePolynomial else \
+            backgroundModel.getImageF()
+        backgroundImage.setXY0(coaddXY0)
+        return backgroundImage.Factory(backgroundImage, bbox, afwImage.PARENT, False)
+
+    def getRemoveMaskPlanesBitMask(self):
+        """!
+        \brief Return the bit mask of the planes of config.removeMaskPlanes, warning about unknown planes
+        """
+        removeMask = 0
+        for maskPlane in self.config.removeMaskPlanes:
+            try:
+                removeMask |= afwImage.Mask.getPlaneBitMask(maskPlane)
+            except Exception as e:
+                self.log.warn("Unable to remove mask plane %s: %s", maskPlane, e)
+        return removeMask
+
+    def readSubregionCube(self, coaddExposure, bbox, tempExpRefList, imageScalerList, bgInfoList,
+                          altMaskList, statsCtrl, doNImage=False, exposureList=None):
+        """!
+        \brief Read and prepare the sub-region of each coaddTempExp into cubes for \ref stackCube
+
+        Equivalent to \ref readSubregionInputs, but the sub-region of each coaddTempExp is copied into one
+        plane of preallocated image, mask and variance cubes as it is read, and the photometric scaling,
+        background matching and mask plane removal are then applied to the whole cubes at once.
+
+        \param[in] coaddExposure: The target image for the coadd (only its xy0 is used)
+        \param[in] bbox: Sub-region to coadd
+        \param[in] tempExpRefList: List of data reference to tempExp
+        \param[in] imageScalerList: List of image scalers
+        \param[in] bgInfoList: List of background data from background matching
+        \param[in] altMaskList: List of alternate masks to use rather than those stored with tempExp, or None
+                                (see \ref readSubregionInputs)
+        \param[in] statsCtrl: Statistics control object for coadd; its AndMask excludes pixels from nImage
+        \param[in] doNImage: count the exposures contributing to each pixel?
+        \param[in] exposureList: optional list of the subregion of each tempExp, already read
+        \return pipeBase.Struct with:
+        - imageCube, maskCube, varianceCube: (number of tempExps, height, width) arrays of the prepared
+          sub-region of each tempExp
+        - nImage: ImageU with the exposure count of each pixel of the sub-region if doNImage, else None
+        """
+        coaddXY0 = coaddExposure.getXY0()
+        shape = (len(tempExpRefList), bbox.getHeight(), bbox.getWidth())
+        imageCube = numpy.empty(shape, dtype=numpy.float32)
+        varianceCube = numpy.empty(shape, dtype=numpy.float32)
+        maskCube = None
+        scales = numpy.ones(len(tempExpRefList), dtype=numpy.float32)
+        subNImage = None
+        if doNImage:
+            subNImage = afwImage.ImageU(bbox.getWidth(), bbox.getHeight())
+        if exposureList is None:
+            exposureList = [None]*len(tempExpRefList)
+        for i, (tempExpRef, imageScaler, altMask, exposure) in enumerate(zip(tempExpRefList, imageScalerList,
+                                                                             altMaskList, exposureList)):
+            maskedImage = self.readSubregionMaskedImage(tempExpRef, bbox, altMask, exposure)
+            if type(imageScaler) is ImageScaler:
+                scales[i] = imageScaler._scale
+            else:
+                imageScaler.scaleMaskedImage(maskedImage)
+            maskArr = maskedImage.getMask().getArray()
+            if maskCube is None:
+                maskCube = numpy.empty(shape, dtype=maskArr.dtype)
+            imageCube[i] = maskedImage.getImage().getArray()
+            maskCube[i] = maskArr
+            varianceCube[i] = maskedImage.getVariance().getArray()
+            if subNImage is not None:
+                subNImage.getArray()[maskArr & statsCtrl.getAndMask() == 0] += 1
+            del exposure, maskedImage, maskArr
+        imageCube *= scales[:, numpy.newaxis, numpy.newaxis]
+        varianceCube *= (scales**2)[:, numpy.newaxis, numpy.newaxis]
+
+        for i, bgInfo in enumerate(bgInfoList):
+            backgroundImage = self.getBackgroundSubregion(bgInfo, bbox, coaddXY0)
+            if backgroundImage is not None:
+                imageCube[i] += backgroundImage.getArray()
+                varianceCube[i] += bgInfo.fitRMS**2
+
+        removeMask = self.getRemoveMaskPlanesBitMask()
+        if removeMask:
+            maskCube &= numpy.array(~removeMask).astype(maskCube.dtype)
+        return pipeBase.Struct(imageCube=imageCube, maskCube=maskCube, varianceCube=varianceCube,
+                               nImage=subNImage)
 
     def addBackgroundMatchingMetadata(self, coaddExposure, tempExpRefList, backgroundInfoList):
         """!
@@ -809,6 +1939,80 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
                 metadata.addDouble("CTExp_SDQA2_%d" % (ind),
                                    backgroundInfo.fitRMS)
 
+    def interpolateCoadd(self, coaddExposure, planeName="NO_DATA"):
+        """!
+        \brief Interpolate over the pixels of a coadd in a mask plane, in independent bands of rows
+
+        measAlg.interpolateOverDefects interpolates along rows, from the good pixels of the same row, and
+        tapers to the fallback value at the left and right edges of the image. So the rows containing
+        pixels to interpolate are grouped into full-width bands (of at most config.subregionSize[1] rows),
+        which need no halo; the fallback value is computed once over the whole coadd; and the bands are
+        interpolated concurrently by config.numWorkers workers (see config.parallelType). Rows with no
+        pixels to interpolate are not processed.
+
+        \param[in,out] coaddExposure: Coadd to interpolate in place
+        \param[in] planeName: Name of the mask plane of the pixels to interpolate over
+        """
+        maskedImage = coaddExposure.getMaskedImage()
+        bbox = maskedImage.getBBox(afwImage.PARENT)
+        planeMask = afwImage.Mask.getPlaneBitMask(planeName)
+        rows = numpy.flatnonzero((maskedImage.getMask().getArray() & planeMask).any(axis=1))
+        if len(rows) == 0:
+            self.log.info("No %s pixels to interpolate", planeName)
+            return
+        fallbackValue = None
+        if self.interpImage.config.useFallbackValueAtEdge:
+            fallbackValue = self.interpImage.computeFallbackValue(maskedImage)
+
+        # Group the rows into bands of consecutive rows, each no higher than the subregions
+        maxHeight = self.config.subregionSize[1]
+        if self.config.numWorkers > 1:
+            maxHeight = min(maxHeight, max(1, -(-(rows[-1] + 1 - rows[0])//self.config.numWorkers)))
+        bandList = []
+        start = end = rows[0]
+        for row in rows[1:]:
+            if row - start >= maxHeight:
+                bandList.append((start, end))
+                start = row
+            elif row > end + 1 and row - start >= maxHeight//2:
+                bandList.append((start, end))
+                start = row
+            end = row
+        bandList.append((start, end))
+        bandBBoxList = [afwGeom.Box2I(afwGeom.Point2I(bbox.getMinX(), bbox.getMinY() + start),
+                                      afwGeom.Point2I(bbox.getMaxX(), bbox.getMinY() + end))
+                        for start, end in bandList]
+        self.log.info("Interpolating over %s in %d bands of %d rows", planeName, len(bandBBoxList),
+                      sum(bandBBox.getHeight() for bandBBox in bandBBoxList))
+
+        def interpolateBand(bandBBox):
+            bandMaskedImage = maskedImage.Factory(maskedImage, bandBBox, afwImage.PARENT, False)
+            self.interpImage.run(bandMaskedImage, planeName=planeName, fallbackValue=fallbackValue)
+            return bandMaskedImage
+
+        numWorkers = min(self.config.numWorkers, len(bandBBoxList))
+        if numWorkers <= 1:
+            for bandBBox in bandBBoxList:
+                interpolateBand(bandBBox)
+        elif self.config.parallelType == "thread":
+            pool = ThreadPool(numWorkers)
+            try:
+                pool.map(interpolateBand, bandBBoxList)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            global _interpWorkerState
+            _interpWorkerState = pipeBase.Struct(interpolateBand=interpolateBand, bandBBoxList=bandBBoxList)
+            pool = _getForkContext().Pool(numWorkers)
+            try:
+                for index, planes in pool.imap_unordered(_interpolateBandWorker, range(len(bandBBoxList))):
+                    _assignCoaddSubregion(coaddExposure, bandBBoxList[index], *planes)
+            finally:
+                pool.close()
+                pool.join()
+                _interpWorkerState = None
+
     def readBrightObjectMasks(self, dataRef):
         """Returns None on failure"""
         try:
@@ -840,11 +2044,25 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
                     self.log.warn("Expected to see %s == %s in metadata, saw %s", k, md.get(k), dataId[k])
 
         mask = exposure.getMaskedImage().getMask()
+        maskBBox = mask.getBBox()
         wcs = exposure.getWcs()
         plateScale = wcs.pixelScale().asArcseconds()
 
+        numMasked = 0
         for rec in brightObjectMasks:
             center = afwGeom.PointI(wcs.skyToPixel(rec.getCoord()))
+            # Skip the objects whose bounding box misses the patch before rasterizing them
+            if rec["type"] == "box":
+                halfExtent = 0.5*max(rec["width"].asArcseconds(), rec["height"].asArcseconds())/plateScale
+            elif rec["type"] == "circle":
+                halfExtent = rec["radius"].asArcseconds()/plateScale
+            else:
+                halfExtent = 0
+            objectBBox = afwGeom.Box2I(center, afwGeom.Extent2I(1, 1))
+            objectBBox.grow(int(halfExtent) + 1)
+            if not objectBBox.overlaps(maskBBox):
+                continue
+            numMasked += 1
             if rec["type"] == "box":
                 assert rec["angle"] == 0.0, ("Angle != 0 for mask object %s" % rec["id"])
                 width = rec["width"].asArcseconds()/plateScale    # convert to pixels
@@ -862,7 +2080,8 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
             else:
                 self.log.warn("Unexpected region type %s at %s" % rec["type"], center)
                 continue
-            spans.clippedTo(mask.getBBox()).setMask(mask, self.brightObjectBitmask)
+            spans.clippedTo(maskBBox).setMask(mask, self.brightObjectBitmask)
+        self.log.info("%d bright object masks overlap %s", numMasked, dataId)
 
     @classmethod
     def _makeArgumentParser(cls):
@@ -879,6 +2098,246 @@ discussed in \ref pipeTasks_multiBand (but note that normally, one would use the
         return parser
 
 
+# State inherited by forked subregion workers; only set while AssembleCoaddTask.assembleSubregionsParallel
+# is running its worker pool
+_subregionWorkerState = None
+
+# State inherited by forked interpolation workers; only set while AssembleCoaddTask.interpolateCoadd
+# is running its worker pool
+_interpWorkerState = None
+
+
+def _getForkContext():
+    """!
+    \brief Return a multiprocessing context that forks its workers
+    """
+    try:
+        return multiprocessing.get_context("fork")
+    except AttributeError:  # Python 2 always forks
+        return multiprocessing
+
+
+# Names of the statistics implemented by stackCube, by afw.math statistics property
+_CUBE_STATISTICS_BY_PROPERTY = {afwMath.stringToStatisticsProperty(statistic): statistic
+                                for statistic in CUBE_STATISTICS}
+
+# Number of points along each edge of a CCD mapped to the warp to bound its valid region
+_VALID_REGION_EDGE_POINTS = 8
+# Margin, in pixels, by which the valid region of a warp is grown to allow for the warping kernel
+_VALID_REGION_MARGIN = 10
+
+
+def _assembleSubregionWorker(index):
+    """!
+    \brief Assemble one subregion in a forked worker process
+
+    \param[in] index: index of the subregion in the subBBoxList of the inherited _subregionWorkerState
+    \return tuple of index, a list of the (image, mask, variance) arrays of the subregion of each coadd,
+        and the nImage array of the subregion, or None if the subregion could not be assembled
+    """
+    state = _subregionWorkerState
+    subBBox = state.subBBoxList[index]
+    if not state.task._assembleSubregionOrLog(state.coaddExposureList, subBBox, state.subregionArgs,
+                                              nImage=state.nImage, validBBoxList=state.validBBoxList):
+        return None
+    planesList = []
+    for coaddExposure in state.coaddExposureList:
+        coaddMaskedImage = coaddExposure.getMaskedImage()
+        subMaskedImage = coaddMaskedImage.Factory(coaddMaskedImage, subBBox, afwImage.PARENT)
+        planesList.append((subMaskedImage.getImage().getArray(), subMaskedImage.getMask().getArray(),
+                           subMaskedImage.getVariance().getArray()))
+    nImageArr = None
+    if state.nImage is not None:
+        nImageArr = state.nImage.Factory(state.nImage, subBBox, afwImage.PARENT).getArray()
+    return (index, planesList, nImageArr)
+
+
+def _interpolateBandWorker(index):
+    """!
+    \brief Interpolate one band of a coadd in a forked worker process
+
+    \param[in] index: index of the band in the bandBBoxList of the inherited _interpWorkerState
+    \return tuple of index and the (image, mask, variance) arrays of the interpolated band
+    """
+    bandMaskedImage = _interpWorkerState.interpolateBand(_interpWorkerState.bandBBoxList[index])
+    return (index, (bandMaskedImage.getImage().getArray(), bandMaskedImage.getMask().getArray(),
+                    bandMaskedImage.getVariance().getArray()))
+
+
+def _assignCoaddSubregion(coaddExposure, bbox, imageArr, maskArr, varianceArr):
+    """!
+    \brief Copy the planes of a stacked subregion into a coadd ExposureF
+    """
+    coaddMaskedImage = coaddExposure.getMaskedImage()
+    subMaskedImage = coaddMaskedImage.Factory(coaddMaskedImage, bbox, afwImage.PARENT)
+    subMaskedImage.getImage().getArray()[:] = imageArr
+    subMaskedImage.getMask().getArray()[:] = maskArr
+    subMaskedImage.getVariance().getArray()[:] = varianceArr
+
+
+def _assignNImageSubregion(nImage, bbox, nImageArr):
+    """!
+    \brief Copy the exposure count of a subregion into an nImage ImageU
+    """
+    nImage.Factory(nImage, bbox, afwImage.PARENT).getArray()[:] = nImageArr
+
+
+def subregionSizeForBudget(bbox, maxBytes, fixedBytes, bytesPerPixel):
+    """!
+    \brief Choose the largest subregion of a patch whose memory fits in a budget
+
+    Subregions are as square as the patch allows, so the fewest of them are read; if a full row of the
+    patch does not fit, they are single rows of as many pixels as fit.
+
+    \param[in] bbox: Bounding box of the patch
+    \param[in] maxBytes: Memory budget, in bytes
+    \param[in] fixedBytes: Memory, in bytes, that does not depend on the subregion size
+    \param[in] bytesPerPixel: Memory, in bytes, per pixel of the subregion
+    \return subregion size, as an afwGeom.Extent2I, such that fixedBytes + area*bytesPerPixel <= maxBytes
+    \throw RuntimeError if even a single pixel does not fit in the budget
+    """
+    area = (maxBytes - fixedBytes)//bytesPerPixel
+    if area <= 0:
+        raise RuntimeError("Memory budget of %d bytes is too small: %d bytes are needed before any "
+                           "subregion, and %d per subregion pixel" % (maxBytes, fixedBytes, bytesPerPixel))
+    if area < bbox.getWidth():
+        return afwGeom.Extent2I(int(area), 1)
+    width = min(bbox.getWidth(), int(numpy.sqrt(area)))
+    height = min(bbox.getHeight(), area//width)
+    return afwGeom.Extent2I(int(width), int(height))
+
+
+def spanSetFromBinaryArray(array, xy0):
+    """!
+    \brief Make a SpanSet of the nonzero pixels of a 2-d array
+
+    Equivalent to afwGeom.SpanSet.fromMask on a Mask made from the array, without making the Mask.
+
+    \param[in] array: 2-d array, nonzero for the pixels to include
+    \param[in] xy0: parent position (afwGeom.Point2I) of array[0, 0]
+    \return SpanSet of the nonzero pixels
+    """
+    return spanSetFromSpanArray(spanArrayFromBinaryArray(array, xy0))
+
+
+def spanArrayFromBinaryArray(array, xy0):
+    """!
+    \brief Find the runs of nonzero pixels in the rows of a 2-d array
+
+    \param[in] array: 2-d array, nonzero for the pixels to include
+    \param[in] xy0: parent position (afwGeom.Point2I) of array[0, 0]
+    \return int64 array of shape (N, 3) with the parent y, first x and last x of each run, sorted by row
+    """
+    # Runs of nonzero pixels start where a row steps up from zero and end where it steps down
+    padded = numpy.zeros((array.shape[0], array.shape[1] + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = array != 0
+    steps = numpy.diff(padded, axis=1)
+    startY, startX = numpy.nonzero(steps == 1)
+    endY, endX = numpy.nonzero(steps == -1)
+    x0, y0 = xy0.getX(), xy0.getY()
+    return numpy.stack([startY + y0, startX + x0, endX - 1 + x0], axis=1).astype(numpy.int64).reshape(-1, 3)
+
+
+def spanSetFromSpanArray(spans):
+    """!
+    \brief Make a SpanSet from disjoint (y, x0, x1) runs, joining the runs that touch along a row
+
+    Runs found separately in adjacent sub-regions (see \ref spanArrayFromBinaryArray) are joined where a
+    row crosses the boundary between them, so the SpanSet is the same as if the pixels had been found in a
+    single array.
+
+    \param[in] spans: int array of shape (N, 3) of disjoint runs, in any order
+    \return SpanSet of the pixels of the runs
+    """
+    spans = numpy.asarray(spans, dtype=numpy.int64).reshape(-1, 3)
+    if len(spans) == 0:
+        return afwGeom.SpanSet()
+    spans = spans[numpy.lexsort((spans[:, 1], spans[:, 0]))]
+    startsRun = numpy.ones(len(spans), dtype=bool)
+    startsRun[1:] = (spans[1:, 0] != spans[:-1, 0]) | (spans[1:, 1] != spans[:-1, 2] + 1)
+    starts = numpy.nonzero(startsRun)[0]
+    ends = numpy.append(starts[1:] - 1, len(spans) - 1)
+    return afwGeom.SpanSet([afwGeom.Span(int(y), int(xStart), int(xEnd))
+                            for y, xStart, xEnd in zip(spans[starts, 0], spans[starts, 1], spans[ends, 2])])
+
+
+class SpanSetListStore(object):
+    """!
+    \brief Store lists of SpanSets compactly, writing them to temporary files beyond a memory budget
+
+    Each list is kept as an array of (y, x0, x1) spans; once the arrays held in memory would exceed the
+    budget, further lists are written to compressed numpy files in a temporary directory, which is removed
+    by \ref close.
+    """
+
+    def __init__(self, maxMemory, spillDir=None):
+        """!
+        \param[in] maxMemory: maximum number of bytes of spans to hold in memory
+        \param[in] spillDir: directory in which to make the temporary directory, or None for the default
+        """
+        self.maxMemory = maxMemory
+        self.spillDir = spillDir
+        self.numSpilled = 0
+        self._entries = []
+        self._memory = 0
+        self._tmpDir = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, spanSetList):
+        """!
+        \brief Add a list of SpanSets to the store
+
+        \param[in] spanSetList: list of SpanSets
+        """
+        spanList = []
+        offsets = [0]
+        for spanSet in spanSetList:
+            for span in spanSet:
+                spanList.append((span.getY(), span.getMinX(), span.getMaxX()))
+            offsets.append(len(spanList))
+        spans = numpy.array(spanList, dtype=numpy.int32).reshape(-1, 3)
+        offsets = numpy.array(offsets, dtype=numpy.int64)
+        nBytes = spans.nbytes + offsets.nbytes
+        if self._memory + nBytes <= self.maxMemory:
+            self._memory += nBytes
+            self._entries.append((spans, offsets))
+            return
+        if self._tmpDir is None:
+            self._tmpDir = tempfile.mkdtemp(prefix="spanSetListStore-", dir=self.spillDir)
+        filename = os.path.join(self._tmpDir, "%d.npz" % (len(self._entries),))
+        numpy.savez_compressed(filename, spans=spans, offsets=offsets)
+        self._entries.append(filename)
+        self.numSpilled += 1
+
+    def get(self, index):
+        """!
+        \brief Return a list of SpanSets from the store
+
+        \param[in] index: index of the list, in the order in which the lists were added
+        \return list of SpanSets
+        """
+        entry = self._entries[index]
+        if isinstance(entry, tuple):
+            spans, offsets = entry
+        else:
+            with numpy.load(entry) as data:
+                spans, offsets = data["spans"], data["offsets"]
+        return [afwGeom.SpanSet([afwGeom.Span(int(y), int(x0), int(x1)) for y, x0, x1 in spans[start:end]])
+                for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def close(self):
+        """!
+        \brief Forget all stored lists and remove any temporary files
+        """
+        self._entries = []
+        self._memory = 0
+        if self._tmpDir is not None:
+            shutil.rmtree(self._tmpDir, ignore_errors=True)
+            self._tmpDir = None
+
+
 def _subBBoxIter(bbox, subregionSize):
     """!
     \brief Iterate over subregions of a bbox
@@ -958,6 +2417,86 @@ class AssembleCoaddDataIdContainer(pipeBase.DataIdContainer):
             self.refList.append(dataRef)
 
 
+def applyAltMaskPlanes(mask, altMaskSpans):
+    """!
+    \brief Set the mask planes of an alternative mask given as SpanSets
+
+    Alternative masks are kept as SpanSets, which are much smaller than a full-patch Mask for each warp,
+    and are rasterized only onto the sub-region being coadded.
+
+    \param[in,out] mask: mask (typically a sub-region of a warp's mask) in which to set the planes
+    \param[in] altMaskSpans: dict of mask plane name: list of SpanSets (in parent coordinates) to set in
+                             that plane; the plane is added to the mask plane dictionary if necessary
+    \return mask
+    """
+    bbox = mask.getBBox(afwImage.PARENT)
+    for planeName, spanSetList in altMaskSpans.items():
+        bitValue = 2**mask.addMaskPlane(planeName)
+        for spanSet in spanSetList:
+            if spanSet.getBBox().overlaps(bbox):
+                spanSet.clippedTo(bbox).setMask(mask, bitValue)
+    return mask
+
+
+def labelSpanSets(spanSetList, bbox):
+    """!
+    \brief Label the pixels covered by a list of SpanSets
+
+    The labels allow the pixels of every SpanSet to be counted at once (see \ref countMaskInLabels and
+    \ref countSelectedLabels) rather than rasterizing each SpanSet into a Mask of its own. SpanSets may
+    overlap, in which case their common pixels are listed once for each of them; only labels of disjoint
+    SpanSets can be combined into a single label image.
+
+    \param[in] spanSetList: list of SpanSets, e.g. the spans of the footprints of a FootprintSet
+    \param[in] bbox: bounding box of the images to be counted; SpanSets are clipped to it
+    \return pipeBase.Struct with:
+    - indices: flat indices of the covered pixels in a row-major array with the dimensions of bbox
+    - labels: index in spanSetList of the SpanSet covering each pixel
+    - count: number of SpanSets
+    """
+    x0, y0 = bbox.getMinX(), bbox.getMinY()
+    width = bbox.getWidth()
+    indicesList = [numpy.zeros(0, dtype=numpy.int64)]
+    labelsList = [numpy.zeros(0, dtype=numpy.int64)]
+    for label, spanSet in enumerate(spanSetList):
+        y, x = spanSet.clippedTo(bbox).indices()
+        y = numpy.asarray(y, dtype=numpy.int64)
+        x = numpy.asarray(x, dtype=numpy.int64)
+        indices = (y - y0)*width + (x - x0)
+        indicesList.append(indices)
+        labelsList.append(numpy.full(len(indices), label, dtype=numpy.int64))
+    return pipeBase.Struct(indices=numpy.concatenate(indicesList), labels=numpy.concatenate(labelsList),
+                           count=len(spanSetList))
+
+
+def countSelectedLabels(spanSetLabels, selected):
+    """!
+    \brief Count the selected pixels of each labelled SpanSet
+
+    \param[in] spanSetLabels: labelled pixels, from \ref labelSpanSets
+    \param[in] selected: boolean array selecting pixels of spanSetLabels.indices
+    \return array with the number of selected pixels in each SpanSet
+    """
+    return numpy.bincount(spanSetLabels.labels[selected], minlength=spanSetLabels.count)
+
+
+def countMaskInLabels(spanSetLabels, maskArray, bitmask, ignoreMask=0):
+    """!
+    \brief Count the pixels of each labelled SpanSet with a specific mask
+
+    Equivalent to calling \ref countMaskFromFootprint for each SpanSet, in a single pass over the mask.
+
+    \param[in] spanSetLabels: labelled pixels, from \ref labelSpanSets
+    \param[in] maskArray: array of a mask with the bounding box used to label the SpanSets
+    \param[in] bitmask: specific mask that we wish to count the number of occurances of.
+    \param[in] ignoreMask: pixels to not consider.
+    \return array with the number of pixels in each SpanSet with bitmask but not ignoreMask set
+    """
+    values = maskArray.ravel()[spanSetLabels.indices]
+    selected = numpy.logical_and((values & bitmask) != 0, (values & ignoreMask) == 0)
+    return countSelectedLabels(spanSetLabels, selected)
+
+
 def countMaskFromFootprint(mask, footprint, bitmask, ignoreMask):
     """!
     \brief Function to count the number of pixels with a specific mask in a footprint.
@@ -1041,6 +2580,8 @@ class SafeClipAssembleCoaddConfig(AssembleCoaddConfig):
             log.warn("Additional Sigma-clipping not allowed in Safe-clipped Coadds. "
                      "Ignoring doSigmaClip.")
             self.doSigmaClip = False
+        if self.doIncremental:
+            raise ValueError("doIncremental is not supported by SafeClipAssembleCoadd")
         if self.statistic != "MEAN":
             raise ValueError("Only MEAN statistic allowed for final stacking in SafeClipAssembleCoadd "
                              "(%s chosen). Please set statistic to MEAN."
@@ -1224,17 +2765,8 @@ class SafeClipAssembleCoaddTask(AssembleCoaddTask):
 
         # Go to individual visits for big footprints
         maskClipValue = mask.getPlaneBitMask("CLIPPED")
-        maskDetValue = mask.getPlaneBitMask("DETECTED") | mask.getPlaneBitMask("DETECTED_NEGATIVE")
         bigFootprints = self.detectClipBig(result.tempExpClipList, result.clipFootprints, result.clipIndices,
-                                           maskClipValue, maskDetValue)
-
-        # Create mask of the current clipped footprints
-        maskClip = mask.Factory(mask.getBBox(afwImage.PARENT))
-        afwDet.setMaskFromFootprintList(maskClip, result.clipFootprints, maskClipValue)
-
-        maskClipBig = maskClip.Factory(mask.getBBox(afwImage.PARENT))
-        afwDet.setMaskFromFootprintList(maskClipBig, bigFootprints, maskClipValue)
-        maskClip |= maskClipBig
+                                           result.detectionFootprintsList, mask.getBBox(afwImage.PARENT))
 
         # Assemble coadd from base class, but ignoring CLIPPED pixels
         badMaskPlanes = self.config.badMaskPlanes[:]
@@ -1246,7 +2778,8 @@ class SafeClipAssembleCoaddTask(AssembleCoaddTask):
         # Set the coadd CLIPPED mask from the footprints since currently pixels that are masked
         # do not get propagated
         maskExp = retStruct.coaddExposure.getMaskedImage().getMask()
-        maskExp |= maskClip
+        for footprint in result.clipFootprints + bigFootprints:
+            footprint.spans.clippedTo(maskExp.getBBox(afwImage.PARENT)).setMask(maskExp, maskClipValue)
 
         return retStruct
 
@@ -1255,7 +2788,8 @@ class SafeClipAssembleCoaddTask(AssembleCoaddTask):
         \brief Return an exposure that contains the difference between and unclipped and clipped coadds.
 
         Generate a difference image between clipped and unclipped coadds.
-        Compute the difference image by subtracting an outlier-clipped coadd from an outlier-unclipped coadd.
+        Compute the difference image by subtracting an outlier-clipped coadd from an outlier-unclipped coadd,
+        both stacked in a single pass over the warps by \ref AssembleCoaddTask.assembleStatistics.
         Return the difference image.
 
         @param skyInfo: Patch geometry information, from getSkyInfo
@@ -1265,23 +2799,11 @@ class SafeClipAssembleCoaddTask(AssembleCoaddTask):
         @param bgModelList: List of background models from background matching
         @return Difference image of unclipped and clipped coadd wrapped in an Exposure
         """
-        # Clone and upcast self.config because current self.config is frozen
-        config = AssembleCoaddConfig()
-        # getattr necessary because subtasks do not survive Config.toDict()
-        configIntersection = {k: getattr(self.config, k)
-                              for k, v in self.config.toDict().items() if (k in config.keys())}
-        config.update(**configIntersection)
-
-        # statistic MEAN copied from self.config.statistic, but for clarity explicitly assign
-        config.statistic = 'MEAN'
-        task = AssembleCoaddTask(config=config)
-        coaddMean = task.assemble(skyInfo, tempExpRefList, imageScalerList, weightList,
-                                  bgModelList).coaddExposure
-
-        config.statistic = 'MEANCLIP'
-        task = AssembleCoaddTask(config=config)
-        coaddClip = task.assemble(skyInfo, tempExpRefList, imageScalerList, weightList,
-                                  bgModelList).coaddExposure
+        # Both coadds are stacked from a single read of each warp subregion
+        coaddMean, coaddClip = AssembleCoaddTask.assembleStatistics(self, skyInfo, tempExpRefList,
+                                                                    imageScalerList, weightList,
+                                                                    ["MEAN", "MEANCLIP"],
+                                                                    bgModelList).coaddExposureList
 
         coaddDiff = coaddMean.getMaskedImage().Factory(coaddMean.getMaskedImage())
         coaddDiff -= coaddClip.getMaskedImage()
@@ -1291,59 +2813,75 @@ class SafeClipAssembleCoaddTask(AssembleCoaddTask):
 
     def detectClip(self, exp, tempExpRefList):
         """!
-        \brief Detect clipped regions on an exposure and set the mask on the individual tempExp masks
+        \brief Detect clipped regions on an exposure and record them as SpanSets for the individual tempExps
 
         Detect footprints in the difference image after smoothing the difference image with a Gaussian kernal.
         Identify footprints that overlap with one or two input coaddTempExps by comparing the computed overlap
         fraction to thresholds set in the config.
         A different threshold is applied depending on the number of overlapping visits (restricted to one or
         two).
-        If the overlap exceeds the thresholds, the footprint is considered "CLIPPED" and is marked as such on
-        the coaddTempExp.
+        If the overlap exceeds the thresholds, the footprint is considered "CLIPPED" and is recorded as such
+        for the coaddTempExp.
+        The mask of each coaddTempExp is read once, in turn, to count its overlap with every footprint and to
+        collect its large detections for \ref detectClipBig, so only one full mask is held at a time.
         Return a struct with the clipped footprints, the indices of the coaddTempExps that end up overlapping
-        with the clipped footprints and a list of new masks for the coaddTempExps.
+        with the clipped footprints and a list of alternative masks for the coaddTempExps.
 
         \param[in] exp: Exposure to run detection on
         \param[in] tempExpRefList: List of data reference to tempExp
         \return struct containing:
         - clippedFootprints: list of clipped footprints
         - clippedIndices: indices for each clippedFootprint in tempExpRefList
-        - tempExpClipList: list of new masks for tempExp
+        - tempExpClipList: list of alternative masks for tempExp, each a dict with a "CLIPPED" entry listing
+            the SpanSets to mask as clipped (see \ref applyAltMaskPlanes)
+        - detectionFootprintsList: list of the DETECTED footprints of each tempExp with at least
+            config.minBigOverlap pixels
         """
         mask = exp.getMaskedImage().getMask()
-        maskClipValue = mask.getPlaneBitMask("CLIPPED")
         maskDetValue = mask.getPlaneBitMask("DETECTED") | mask.getPlaneBitMask("DETECTED_NEGATIVE")
         fpSet = self.clipDetection.detectFootprints(exp, doSmooth=True, clearMask=True)
         # Merge positive and negative together footprints together
         fpSet.positive.merge(fpSet.negative)
-        footprints = fpSet.positive
-        self.log.info('Found %d potential clipped objects', len(footprints.getFootprints()))
+        footprints = fpSet.positive.getFootprints()
+        self.log.info('Found %d potential clipped objects', len(footprints))
         ignoreMask = self.getBadPixelMask()
 
+        # Count the bad and detected pixels of each visit in each footprint, one visit at a time,
+        # in a single pass over the labelled footprint pixels
+        footprintLabels = labelSpanSets([footprint.spans for footprint in footprints],
+                                        mask.getBBox(afwImage.PARENT))
+        ignoreCounts = numpy.zeros((len(footprints), len(tempExpRefList)), dtype=int)
+        detCounts = numpy.zeros((len(footprints), len(tempExpRefList)), dtype=int)
+        detectionFootprintsList = []
+        for i, tmpExpRef in enumerate(tempExpRefList):
+            tmpExpMask = self.readWarp(tmpExpRef).getMaskedImage().getMask()
+            maskArray = tmpExpMask.getArray()
+            ignoreCounts[:, i] = countMaskInLabels(footprintLabels, maskArray, ignoreMask)
+            detCounts[:, i] = countMaskInLabels(footprintLabels, maskArray, maskDetValue, ignoreMask)
+
+            # Keep the large detections of this visit for detectClipBig
+            tmpExpMask &= maskDetValue
+            visitFootprints = afwDet.FootprintSet(tmpExpMask, afwDet.Threshold(1))
+            detectionFootprintsList.append([foot for foot in visitFootprints.getFootprints() if
+                                            foot.getArea() >= self.config.minBigOverlap])
+            del tmpExpMask
+
         clipFootprints = []
         clipIndices = []
+        clipSpansList = [[] for tmpExpRef in tempExpRefList]
 
-        # build a list with a mask for each visit which can be modified with clipping information
-        tempExpClipList = [tmpExpRef.get(self.getTempExpDatasetName(self.warpType),
-                                         immediate=True).getMaskedImage().getMask() for
-                           tmpExpRef in tempExpRefList]
-
-        for footprint in footprints.getFootprints():
+        for footprint, ignoreCount, detCount in zip(footprints, ignoreCounts, detCounts):
             nPixel = footprint.getArea()
             overlap = []  # hold the overlap with each visit
-            maskList = []  # which visit mask match
             indexList = []  # index of visit in global list
-            for i, tmpExpMask in enumerate(tempExpClipList):
+            for i, (ignore, overlapDet) in enumerate(zip(ignoreCount, detCount)):
                 # Determine the overlap with the footprint
-                ignore = countMaskFromFootprint(tmpExpMask, footprint, ignoreMask, 0x0)
-                overlapDet = countMaskFromFootprint(tmpExpMask, footprint, maskDetValue, ignoreMask)
                 totPixel = nPixel - ignore
 
                 # If we have more bad pixels than detection skip
                 if ignore > overlapDet or totPixel <= 0.5*nPixel or overlapDet == 0:
                     continue
                 overlap.append(overlapDet/float(totPixel))
-                maskList.append(tmpExpMask)
                 indexList.append(i)
 
             overlap = numpy.array(overlap)
@@ -1377,62 +2915,71 @@ class SafeClipAssembleCoaddTask(AssembleCoaddTask):
                 continue
 
             for index in keepIndex:
-                footprint.spans.setMask(maskList[index], maskClipValue)
+                clipSpansList[indexList[index]].append(footprint.spans)
 
             clipIndices.append(numpy.array(indexList)[keepIndex])
             clipFootprints.append(footprint)
 
+        tempExpClipList = [{"CLIPPED": clipSpans} for clipSpans in clipSpansList]
         return pipeBase.Struct(clipFootprints=clipFootprints, clipIndices=clipIndices,
-                               tempExpClipList=tempExpClipList)
+                               tempExpClipList=tempExpClipList,
+                               detectionFootprintsList=detectionFootprintsList)
 
-    def detectClipBig(self, tempExpClipList, clipFootprints, clipIndices, maskClipValue, maskDetValue):
+    def detectClipBig(self, tempExpClipList, clipFootprints, clipIndices, detectionFootprintsList, bbox):
         """!
         \brief Find footprints from individual tempExp footprints for large footprints.
 
         Identify big footprints composed of many sources in the coadd difference that may have originated in a
         large diffuse source in the coadd. We do this by indentifying all clipped footprints that overlap
         significantly with each source in all the coaddTempExps.
+        The clipped footprints are labelled once; the overlap of every large source of a coaddTempExp with
+        the footprints clipped in that coaddTempExp is then counted in a single pass.
 
-        \param[in] tempExpClipList: List of tempExp masks with clipping information
+        \param[in,out] tempExpClipList: List of alternative tempExp masks with clipping information, as
+                                        returned by \ref detectClip; big footprints are added to their
+                                        "CLIPPED" SpanSets
         \param[in] clipFootprints: List of clipped footprints
         \param[in] clipIndices: List of which entries in tempExpClipList each footprint belongs to
-        \param[in] maskClipValue: Mask value of clipped pixels
-        \param[in] maskClipValue: Mask value of detected pixels
+        \param[in] detectionFootprintsList: List of the large DETECTED footprints of each tempExp
+        \param[in] bbox: Bounding box of the coadd
         \return list of big footprints
         """
         bigFootprintsCoadd = []
-        ignoreMask = self.getBadPixelMask()
-        for index, tmpExpMask in enumerate(tempExpClipList):
-
-            # Create list of footprints from the DETECTED pixels
-            maskVisitDet = tmpExpMask.Factory(tmpExpMask, tmpExpMask.getBBox(afwImage.PARENT),
-                                              afwImage.PARENT, True)
-            maskVisitDet &= maskDetValue
-            visitFootprints = afwDet.FootprintSet(maskVisitDet, afwDet.Threshold(1))
-
-            # build a mask of clipped footprints that are in this visit
-            clippedFootprintsVisit = []
-            for foot, clipIndex in zip(clipFootprints, clipIndices):
-                if index not in clipIndex:
-                    continue
-                clippedFootprintsVisit.append(foot)
-            maskVisitClip = maskVisitDet.Factory(maskVisitDet.getBBox(afwImage.PARENT))
-            afwDet.setMaskFromFootprintList(maskVisitClip, clippedFootprintsVisit, maskClipValue)
+        if not clipFootprints:
+            return bigFootprintsCoadd
+
+        # Label image of the clipped footprints (0 for unclipped pixels)
+        clipLabels = labelSpanSets([foot.spans for foot in clipFootprints], bbox)
+        clipLabelArray = numpy.zeros(bbox.getArea(), dtype=numpy.int32)
+        clipLabelArray[clipLabels.indices] = clipLabels.labels + 1
+
+        # The labels of the clipped footprints of each visit
+        clipLabelsVisitList = [[] for tmpExpClip in tempExpClipList]
+        for label, clipIndex in enumerate(clipIndices):
+            for index in clipIndex:
+                clipLabelsVisitList[index].append(label + 1)
+
+        for tmpExpClip, visitFootprints, clipLabelsVisit in zip(tempExpClipList, detectionFootprintsList,
+                                                                 clipLabelsVisitList):
+            if not clipLabelsVisit:
+                continue
+            visitFootprints = [foot for foot in visitFootprints
+                               if foot.getArea() >= self.config.minBigOverlap]
+            if not visitFootprints:
+                continue
 
-            bigFootprintsVisit = []
-            for foot in visitFootprints.getFootprints():
-                if foot.getArea() < self.config.minBigOverlap:
-                    continue
-                nCount = countMaskFromFootprint(maskVisitClip, foot, maskClipValue, ignoreMask)
+            # Count the pixels of each large footprint of this visit that are in its clipped footprints
+            isClippedVisit = numpy.zeros(len(clipFootprints) + 1, dtype=bool)
+            isClippedVisit[clipLabelsVisit] = True
+            visitLabels = labelSpanSets([foot.spans for foot in visitFootprints], bbox)
+            nCounts = countSelectedLabels(visitLabels, isClippedVisit[clipLabelArray[visitLabels.indices]])
+
+            for foot, nCount in zip(visitFootprints, nCounts):
                 if nCount > self.config.minBigOverlap:
-                    bigFootprintsVisit.append(foot)
+                    # Update single visit masks
+                    tmpExpClip["CLIPPED"].append(foot.spans)
                     bigFootprintsCoadd.append(foot)
 
-            # Update single visit masks
-            maskVisitClip.clearAllMaskPlanes()
-            afwDet.setMaskFromFootprintList(maskVisitClip, bigFootprintsVisit, maskClipValue)
-            tmpExpMask |= maskVisitClip
-
         return bigFootprintsCoadd
 
 
@@ -1481,6 +3028,28 @@ class CompareWarpAssembleCoaddConfig(AssembleCoaddConfig):
         dtype=int,
         default=5
     )
+    artifactCandidateMemory = pexConfig.RangeField(
+        doc="Maximum memory (bytes) in which to hold the candidate artifact regions of all warps between "
+            "detecting and filtering them; the candidates of further warps are written to temporary files.",
+        dtype=int,
+        default=512*1024*1024,
+        min=0,
+    )
+    templateCacheDir = pexConfig.Field(
+        doc="Directory in which to keep the static sky model (templateCoadd) of each patch, keyed by the "
+            "input warps and the assembleStaticSkyModel config, so that it is reused by later runs on the "
+            "same inputs; if None, always assemble it.",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    artifactSpillDir = pexConfig.Field(
+        doc="Directory for the temporary files of candidate artifact regions that exceed "
+            "artifactCandidateMemory; if None, use the default temporary directory.",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
 
     def setDefaults(self):
         AssembleCoaddConfig.setDefaults(self)
@@ -1489,6 +3058,11 @@ class CompareWarpAssembleCoaddConfig(AssembleCoaddConfig):
         self.assembleStaticSkyModel.doWrite = False
         self.statistic = 'MEAN'
 
+    def validate(self):
+        AssembleCoaddConfig.validate(self)
+        if self.doIncremental:
+            raise ValueError("doIncremental is not supported by CompareWarpAssembleCoadd")
+
 
 ## \addtogroup LSST_task_documentation
 ## \{
@@ -1646,10 +3220,68 @@ class CompareWarpAssembleCoaddTask(AssembleCoaddTask):
         \brief Make inputs specific to Subclass
 
         Generate a templateCoadd to use as a native model of static sky to subtract from warps.
+        If config.templateCacheDir is set, reuse the templateCoadd made from the same warps with the same
+        assembleStaticSkyModel config, if any, and keep the one made otherwise.
         """
+        cacheFilename = None
+        if self.config.templateCacheDir:
+            try:
+                cacheKey = self.makeTemplateCacheKey(dataRef, selectDataList)
+            except Exception as e:
+                self.log.warn("Unable to compute the static sky model cache key: %s", e)
+            else:
+                cacheFilename = os.path.join(self.config.templateCacheDir, "templateCoadd-%s.fits" % cacheKey)
+                if os.path.exists(cacheFilename):
+                    self.log.info("Reading static sky model from %s", cacheFilename)
+                    return pipeBase.Struct(templateCoadd=afwImage.ExposureF(cacheFilename))
+
         templateCoadd = self.assembleStaticSkyModel.run(dataRef, selectDataList).coaddExposure
+        if cacheFilename is not None and templateCoadd is not None:
+            try:
+                if not os.path.isdir(self.config.templateCacheDir):
+                    os.makedirs(self.config.templateCacheDir)
+                tmpFilename = "%s.%d.tmp.fits" % (cacheFilename[:-len(".fits")], os.getpid())
+                templateCoadd.writeFits(tmpFilename)
+                os.rename(tmpFilename, cacheFilename)
+            except Exception as e:
+                self.log.warn("Unable to write static sky model to %s: %s", cacheFilename, e)
         return pipeBase.Struct(templateCoadd=templateCoadd)
 
+    def makeTemplateCacheKey(self, dataRef, selectDataList):
+        """!
+        \brief Return the key identifying the static sky model of a patch
+
+        The key covers the patch, the warps assembleStaticSkyModel would select (identified by their dataId
+        and the name, modification time and size of their file) and the assembleStaticSkyModel config. The
+        weights and photometric scalings of the warps are computed from these by assembleStaticSkyModel, so
+        they are covered without reading the warps.
+
+        @param dataRef: Data reference defining the patch
+        @param selectDataList: List of data references to select warps from, as passed to \ref run
+        @return key, as a hex digest string
+        """
+        staticSkyTask = self.assembleStaticSkyModel
+        skyInfo = staticSkyTask.getSkyInfo(dataRef)
+        calExpRefList = staticSkyTask.selectExposures(dataRef, skyInfo, selectDataList=selectDataList)
+        tempExpRefList = staticSkyTask.getTempExpRefList(dataRef, calExpRefList)
+        tempExpName = staticSkyTask.getTempExpDatasetName(staticSkyTask.warpType)
+        warpList = []
+        for tempExpRef in tempExpRefList:
+            warpInfo = dict(dataId=sorted((str(k), str(v)) for k, v in tempExpRef.dataId.items()))
+            if tempExpRef.datasetExists(tempExpName):
+                warpFilename = tempExpRef.get(tempExpName + "_filename")[0]
+                fileStat = os.stat(warpFilename)
+                warpInfo.update(filename=os.path.abspath(warpFilename), mtime=fileStat.st_mtime,
+                                size=fileStat.st_size)
+            warpList.append(warpInfo)
+        keyDict = dict(
+            patch=sorted((str(k), str(v)) for k, v in dataRef.dataId.items()),
+            bbox=str(skyInfo.bbox),
+            warps=sorted(warpList, key=lambda warpInfo: warpInfo["dataId"]),
+            config=staticSkyTask.config.toDict(),
+        )
+        return hashlib.sha1(json.dumps(keyDict, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
     def assemble(self, skyInfo, tempExpRefList, imageScalerList, weightList, bgModelList,
                  supplementaryData, *args, **kwargs):
         """!
@@ -1692,6 +3324,11 @@ class CompareWarpAssembleCoaddTask(AssembleCoaddTask):
         in each using count map to filter out variable sources and sources that are difficult to
         subtract cleanly.
 
+        The first loop reads each warp one subregion at a time (see \ref findArtifactCandidates), and the
+        candidate artifacts of each warp are kept compactly, in memory up to config.artifactCandidateMemory
+        and in temporary files beyond that (see \ref SpanSetListStore), so memory use does not grow with the
+        number of warps times the area of the patch.
+
         @param templateCoadd: Exposure to serve as model of static sky
         @param tempExpRefList: List of data references to warps
         @param imageScalerList: List of image scalers
@@ -1699,55 +3336,100 @@ class CompareWarpAssembleCoaddTask(AssembleCoaddTask):
 
         self.log.debug("Generating Count Image, and mask lists.")
         coaddBBox = templateCoadd.getBBox()
-        slateIm = afwImage.ImageU(coaddBBox)
         epochCountImage = afwImage.ImageU(coaddBBox)
-        spanSetArtifactList = []
+        epochCountArray = epochCountImage.array.reshape(-1)
+        subregionSize = afwGeom.Extent2I(*self.config.subregionSize)
+        subBBoxList = list(_subBBoxIter(coaddBBox, subregionSize))
         spanSetNoDataMaskList = []
+        candidateStore = SpanSetListStore(self.config.artifactCandidateMemory, self.config.artifactSpillDir)
+        chiBuffers = self._makeChiBuffers(subBBoxList)
 
         maxNumEpochs = int(max(1, self.config.temporalThreshold*len(tempExpRefList)))
-        for warpRef, imageScaler in zip(tempExpRefList, imageScalerList):
-            mi = self._readAndComputeWarpDiff(warpRef, imageScaler, templateCoadd)
-            if mi is not None:
-                chiIm = self._makeChiIm(mi)
-                chiOneMap = self._snrToBinaryIm(chiIm)
-                outliers = afwImage.makeMaskFromArray(chiOneMap.array.astype(afwImage.MaskPixel))
-                outliers.setXY0(mi.getXY0())
-                spanSetList = afwGeom.SpanSet.fromMask(outliers).split()
-                dilatedSpanSetList = [s.dilated(self.config.growMaskBy,
-                                                afwGeom.Stencil.CIRCLE).clippedTo(coaddBBox)
-                                      for s in spanSetList]
-                slateIm.set(0)
-                for spans in dilatedSpanSetList:
-                    spans.setImage(slateIm, 1, doClip=True)
-                epochCountImage += slateIm
-            else:
-                chiIm = afwImage.ImageF(coaddBBox, numpy.nan)
-                dilatedSpanSetList = []
+        try:
+            for warpRef, imageScaler in zip(tempExpRefList, imageScalerList):
+                candidates = self.findArtifactCandidates(warpRef, imageScaler, templateCoadd, subBBoxList,
+                                                         chiBuffers=chiBuffers)
+                # Each pixel counts once per epoch, even where dilated candidates overlap
+                if candidates.artifacts:
+                    labels = labelSpanSets(candidates.artifacts, coaddBBox)
+                    epochCountArray[numpy.unique(labels.indices)] += 1
+                candidateStore.append(candidates.artifacts)
+                spanSetNoDataMaskList.append(candidates.noData)
+
+            if lsstDebug.Info(__name__).saveCountIm:
+                path = self._dataRef2DebugPath("epochCountIm", tempExpRefList[0], coaddLevel=True)
+                epochCountImage.writeFits(path)
+
+            spanSetArtifactList = []
+            for i in range(len(candidateStore)):
+                spanSetList = candidateStore.get(i)
+                if spanSetList:
+                    spanSetList = self._filterArtifacts(spanSetList, epochCountImage,
+                                                        maxNumEpochs=maxNumEpochs)
+                spanSetArtifactList.append(spanSetList)
+            if candidateStore.numSpilled:
+                self.log.info("Candidate artifacts of %d of %d warps were written to temporary files",
+                              candidateStore.numSpilled, len(candidateStore))
+        finally:
+            candidateStore.close()
 
+        return pipeBase.Struct(artifacts=spanSetArtifactList,
+                               noData=spanSetNoDataMaskList)
+
+    def findArtifactCandidates(self, warpRef, imageScaler, templateCoadd, subBBoxList, chiBuffers=None):
+        """!
+        \brief Find the candidate artifacts of a warp, reading it one subregion at a time
+
+        Threshold the chi-image of the difference between the PSF-matched warp and the templateCoadd at
+        config.chiThreshold, one subregion at a time. Each thresholded subregion is reduced to its runs of
+        outlier (and no-data) pixels at once, so only subregion-sized arrays are allocated. Thresholding is
+        done pixel by pixel, so the subregions need no overlap; the runs of adjacent subregions are joined
+        and the regions above threshold are grown by config.growMaskBy once the whole warp has been
+        thresholded.
+
+        @param warpRef: Butler dataRef of the warp
+        @param imageScaler: Image scaler of the warp
+        @param templateCoadd: Exposure to serve as model of static sky
+        @param subBBoxList: List of sub-regions covering the bbox of templateCoadd
+        @param chiBuffers: Work buffers from \ref _makeChiBuffers, to be reused from warp to warp;
+                           if None, allocate them
+        @return pipeBase.Struct with:
+        - artifacts: list of SpanSets of the grown regions above threshold
+        - noData: list of SpanSets of the pixels with no data in the PSF-matched warp
+        """
+        coaddBBox = templateCoadd.getBBox()
+        # Warp comparison must use PSF-Matched Warps regardless of requested coadd warp type
+        warpName = self.getTempExpDatasetName('psfMatched')
+        if not warpRef.datasetExists(warpName):
+            self.log.warn("Could not find %s %s; skipping it", warpName, warpRef.dataId)
+            # The whole PSF-matched warp is missing, so none of it can be checked for artifacts
+            return pipeBase.Struct(artifacts=[], noData=[afwGeom.SpanSet(coaddBBox)])
+
+        if chiBuffers is None:
+            chiBuffers = self._makeChiBuffers(subBBoxList)
+        outlierSpansList = []
+        noDataSpansList = []
+        for subBBox in subBBoxList:
+            mi = self._readAndComputeWarpDiff(warpRef, imageScaler, templateCoadd, bbox=subBBox)
+            subShape = (subBBox.getHeight(), subBBox.getWidth())
+            chiArray = self._makeChiArr(mi, out=chiBuffers.chi[:subShape[0], :subShape[1]])
+            outlierArray = self._snrToBinaryArr(chiArray, out=chiBuffers.binary[:subShape[0], :subShape[1]],
+                                                work=chiBuffers.absChi[:subShape[0], :subShape[1]])
+            outlierSpansList.append(spanArrayFromBinaryArray(outlierArray, subBBox.getMin()))
             # PSF-Matched warps have less available area (~the matching kernel) because the calexps
             # undergo a second convolution. Pixels with data in the direct warp
             # but not in the PSF-matched warp will not have their artifacts detected.
             # NaNs from the PSF-matched warp therefore must be masked in the direct warp
-            nans = numpy.where(numpy.isnan(chiIm.array), 1, 0)
-            nansMask = afwImage.makeMaskFromArray(nans.astype(afwImage.MaskPixel))
-            nansMask.setXY0(chiIm.getXY0())
-            spanSetNoDataMask = afwGeom.SpanSet.fromMask(nansMask).split()
-
-            spanSetArtifactList.append(dilatedSpanSetList)
-            spanSetNoDataMaskList.append(spanSetNoDataMask)
+            noDataArray = numpy.isnan(chiArray, out=chiBuffers.binary[:subShape[0], :subShape[1]])
+            noDataSpansList.append(spanArrayFromBinaryArray(noDataArray, subBBox.getMin()))
+            del mi
 
-        if lsstDebug.Info(__name__).saveCountIm:
-            path = self._dataRef2DebugPath("epochCountIm", tempExpRefList[0], coaddLevel=True)
-            epochCountImage.writeFits(path)
-
-        for i, spanSetList in enumerate(spanSetArtifactList):
-            if spanSetList:
-                filteredSpanSetList = self._filterArtifacts(spanSetList, epochCountImage,
-                                                            maxNumEpochs=maxNumEpochs)
-                spanSetArtifactList[i] = filteredSpanSetList
-
-        return pipeBase.Struct(artifacts=spanSetArtifactList,
-                               noData=spanSetNoDataMaskList)
+        spanSetList = spanSetFromSpanArray(numpy.concatenate(outlierSpansList)).split()
+        del outlierSpansList
+        dilatedSpanSetList = [s.dilated(self.config.growMaskBy, afwGeom.Stencil.CIRCLE).clippedTo(coaddBBox)
+                              for s in spanSetList]
+        spanSetNoDataMask = spanSetFromSpanArray(numpy.concatenate(noDataSpansList)).split()
+        return pipeBase.Struct(artifacts=dilatedSpanSetList, noData=spanSetNoDataMask)
 
     def computeAltMaskList(self, tempExpRefList, maskSpanSets):
         """!
@@ -1756,72 +3438,112 @@ class CompareWarpAssembleCoaddTask(AssembleCoaddTask):
         @param tempExpRefList: List of data references to warps
         @param maskSpanSets: Struct containing artifact and noData spanSet lists to apply
 
-        return List of alternative masks
+        return List of alternative masks, each a dict of mask plane name: list of SpanSets
 
-        Add artifact span set list as "CLIPPED" plane and NaNs to existing "NO_DATA" plane
+        Add artifact span set list as "CLIPPED" plane and NaNs to existing "NO_DATA" plane.
+        The masks are kept as SpanSets, and set in the warp masks by \ref applyAltMaskPlanes one sub-region
+        at a time during assembly, so the warps need not be read here.
         """
         spanSetMaskList = maskSpanSets.artifacts
         spanSetNoDataList = maskSpanSets.noData
         altMaskList = []
         for warpRef, artifacts, noData in zip(tempExpRefList, spanSetMaskList, spanSetNoDataList):
-            warp = warpRef.get(self.getTempExpDatasetName(self.config.warpType), immediate=True)
-            mask = warp.maskedImage.mask
-            maskClipValue = mask.addMaskPlane("CLIPPED")
-            noDataValue = mask.addMaskPlane("NO_DATA")
-            for artifact in artifacts:
-                artifact.clippedTo(mask.getBBox()).setMask(mask, 2**maskClipValue)
-            for noDataRegion in noData:
-                noDataRegion.clippedTo(mask.getBBox()).setMask(mask, 2**noDataValue)
-            altMaskList.append(mask)
+            altMask = {"CLIPPED": artifacts, "NO_DATA": noData}
+            altMaskList.append(altMask)
             if lsstDebug.Info(__name__).saveAltMask:
+                mask = self.readWarp(warpRef, self.config.warpType).maskedImage.mask
+                applyAltMaskPlanes(mask, altMask)
                 mask.writeFits(self._dataRef2DebugPath("altMask", warpRef))
 
         return altMaskList
 
     def _filterArtifacts(self, spanSetList, epochCountImage, maxNumEpochs=None, minPixels=None):
+        """Select the candidate artifacts that are outliers in few enough epochs
+
+        A SpanSet is kept if it has at least minPixels pixels, and more than config.spatialThreshold of its
+        pixels in epochCountImage are outliers in 1 to maxNumEpochs epochs. minPixels is compared with the
+        area of the whole SpanSet, including any pixels outside epochCountImage.
+
+        @param spanSetList: List of SpanSets of candidate artifacts
+        @param epochCountImage: Image of the number of epochs in which each pixel is an outlier
+        @param maxNumEpochs: Maximum number of epochs in which the pixels of an artifact are outliers
+        @param minPixels: Minimum number of pixels of an artifact; config.minPixels if None
+        @return list of the SpanSets of spanSetList that are artifacts
+        """
         if minPixels is None:
             minPixels = self.config.minPixels
-        maskSpanSetList = []
-        x0, y0 = epochCountImage.getXY0()
-        for i, span in enumerate(spanSetList):
-            y, x = span.indices()
-            if len(y) < minPixels:
-                continue
-            counts = epochCountImage.array[[y1 - y0 for y1 in y], [x1 - x0 for x1 in x]]
-            idx = numpy.where((counts > 0) & (counts <= maxNumEpochs))
-            percentBelowThreshold = len(idx[0]) / len(counts)
-            if percentBelowThreshold > self.config.spatialThreshold:
-                maskSpanSetList.append(span)
-        return maskSpanSetList
-
-    def _snrToBinaryArr(self, arrIn):
+        nPixels = numpy.array([spanSet.getArea() for spanSet in spanSetList], dtype=numpy.int64)
+        # Count the pixels of every SpanSet in the image, and those that are outliers in few enough epochs,
+        # at once
+        labels = labelSpanSets(spanSetList, epochCountImage.getBBox())
+        nPixelsInImage = numpy.bincount(labels.labels, minlength=labels.count)
+        counts = epochCountImage.array.reshape(-1)[labels.indices]
+        nBelowThreshold = countSelectedLabels(labels, (counts > 0) & (counts <= maxNumEpochs))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            percentBelowThreshold = nBelowThreshold/nPixelsInImage
+        keep = (nPixels >= minPixels) & (percentBelowThreshold > self.config.spatialThreshold)
+        return [span for span, isArtifact in zip(spanSetList, keep) if isArtifact]
+
+    def _snrToBinaryArr(self, arrIn, out=None, work=None):
+        """Threshold a chi array at config.chiThreshold (and -config.chiThreshold if config.doMaskNegative)
+
+        @param arrIn: float array of chi values
+        @param out: optional uint8 array of the shape of arrIn in which to write the result
+        @param work: optional float array of the shape of arrIn to use as a work buffer
+        @return out, which is 1 where the threshold is met and 0 elsewhere
+        """
+        if out is None:
+            out = numpy.empty(arrIn.shape, dtype=numpy.uint8)
         with numpy.errstate(invalid='ignore'):
-            arr = numpy.where(arrIn >= self.config.chiThreshold, 1, 0)
             if self.config.doMaskNegative:
-                arr[numpy.where(arrIn <= -self.config.chiThreshold)] = 1
-        return arr
+                if work is None:
+                    work = numpy.empty(arrIn.shape, dtype=arrIn.dtype)
+                numpy.absolute(arrIn, out=work)
+                numpy.greater_equal(work, self.config.chiThreshold, out=out)
+            else:
+                numpy.greater_equal(arrIn, self.config.chiThreshold, out=out)
+        return out
 
-    def _snrToBinaryIm(self, im):
-        arr = self._snrToBinaryArr(im.array)
-        return afwImage.ImageU(arr.astype(numpy.uint16), xy0=im.getXY0())
+    def _makeChiArr(self, maskedImage, out=None):
+        """Compute the chi (image/sqrt(variance)) array of a masked image
 
-    def _makeChiIm(self, maskedImage):
-        chiIm = maskedImage.image.Factory(1./numpy.sqrt(maskedImage.variance.array))
-        chiIm *= maskedImage.image
-        chiIm.setXY0(maskedImage.getXY0())
-        return chiIm
+        @param maskedImage: masked image
+        @param out: optional float32 array of the shape of maskedImage in which to write the result
+        @return out
+        """
+        if out is None:
+            out = numpy.empty(maskedImage.image.array.shape, dtype=numpy.float32)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            numpy.sqrt(maskedImage.variance.array, out=out)
+            numpy.divide(maskedImage.image.array, out, out=out)
+        return out
+
+    def _makeChiBuffers(self, subBBoxList):
+        """Allocate work buffers for the chi array of the largest sub-region in subBBoxList
+        """
+        shape = (max(subBBox.getHeight() for subBBox in subBBoxList),
+                 max(subBBox.getWidth() for subBBox in subBBoxList))
+        return pipeBase.Struct(chi=numpy.empty(shape, dtype=numpy.float32),
+                               absChi=numpy.empty(shape, dtype=numpy.float32),
+                               binary=numpy.empty(shape, dtype=numpy.uint8))
 
-    def _readAndComputeWarpDiff(self, warpRef, imageScaler, templateCoadd):
+    def _readAndComputeWarpDiff(self, warpRef, imageScaler, templateCoadd, bbox=None):
         # Warp comparison must use PSF-Matched Warps regardless of requested coadd warp type
-        warpName = self.getTempExpDatasetName('psfMatched')
-        if not warpRef.datasetExists(warpName):
-            self.log.warn("Could not find %s %s; skipping it", warpName, warpRef.dataId)
-            return None
-        warp = warpRef.get(self.getTempExpDatasetName('psfMatched'), immediate=True)
+        if bbox is None:
+            warpName = self.getTempExpDatasetName('psfMatched')
+            if not warpRef.datasetExists(warpName):
+                self.log.warn("Could not find %s %s; skipping it", warpName, warpRef.dataId)
+                return None
+            warp = self.readWarp(warpRef, 'psfMatched')
+            templateMaskedImage = templateCoadd.getMaskedImage()
+        else:
+            warp = self.readWarpSubregion(warpRef, bbox, 'psfMatched')
+            templateMaskedImage = templateCoadd.getMaskedImage().Factory(templateCoadd.getMaskedImage(),
+                                                                         bbox, afwImage.PARENT)
         # direct image scaler OK for PSF-matched Warp
         imageScaler.scaleMaskedImage(warp.getMaskedImage())
         mi = warp.getMaskedImage()
-        mi -= templateCoadd.getMaskedImage()
+        mi -= templateMaskedImage
         return mi
 
     def _dataRef2DebugPath(self, prefix, warpRef, coaddLevel=False):
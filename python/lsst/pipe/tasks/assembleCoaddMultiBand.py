@@ -0,0 +1,280 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+import copy
+
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from .assembleCoadd import AssembleCoaddTask, AssembleCoaddDataIdContainer, _getForkContext
+from .coaddBase import SelectDataIdContainer
+from .selectImages import WcsSelectImagesTask
+
+__all__ = ["MultiBandAssembleCoaddConfig", "MultiBandAssembleCoaddTask"]
+
+
+class MultiBandAssembleCoaddConfig(pexConfig.Config):
+    """!
+    \anchor MultiBandAssembleCoaddConfig_
+
+    \brief Configuration for \ref MultiBandAssembleCoaddTask_ "MultiBandAssembleCoaddTask"
+    """
+    assembleCoadd = pexConfig.ConfigurableField(
+        target=AssembleCoaddTask,
+        doc="Task to assemble the coadd of each band; its memory budget (maxMemoryBytes) and workers "
+        "(numWorkers) apply to each band",
+    )
+    numBandWorkers = pexConfig.RangeField(
+        dtype=int,
+        doc="Number of bands assembled concurrently, each in a forked process; 1 assembles the bands "
+        "in turn in this process. The peak memory is numBandWorkers times that of one band.",
+        default=1,
+        min=1,
+    )
+    doSelectPerBand = pexConfig.Field(
+        dtype=bool,
+        doc="Select the calexps of each band with that band's patch data ID, rather than once for the "
+        "patch? Always done if assembleCoadd.select is not a WcsSelectImagesTask, whose selection depends "
+        "only on the Wcs and so is the same for every band; set this for a WcsSelectImagesTask subclass "
+        "that uses the filter of the patch data ID.",
+        default=False,
+    )
+
+    def validate(self):
+        pexConfig.Config.validate(self)
+        if self.numBandWorkers > 1 and not self.assembleCoadd.doWrite:
+            raise ValueError("Bands assembled in forked processes (numBandWorkers > 1) must be written "
+                             "(assembleCoadd.doWrite)")
+
+
+class MultiBandAssembleCoaddRunner(pipeBase.TaskRunner):
+    """!
+    \brief Task runner for \ref MultiBandAssembleCoaddTask_ "MultiBandAssembleCoaddTask", which is run on
+    the list of data references to the bands of each patch.
+    """
+
+    @staticmethod
+    def getTargetList(parsedCmd, **kwargs):
+        """!
+        \brief Provide a list of patch references, one for each band, for each patch
+
+        \param[in]  parsedCmd  the parsed command
+        \param      **kwargs   key word arguments passed to the task's run method
+        \throws RuntimeError if multiple references are provided for the same combination of tract, patch and
+        filter
+        """
+        refList = {}  # Will index this as refList[(tract, patch)][filter] = ref
+        for ref in parsedCmd.id.refList:
+            patchKey = (ref.dataId["tract"], ref.dataId["patch"])
+            filterRefs = refList.setdefault(patchKey, {})
+            if ref.dataId["filter"] in filterRefs:
+                raise RuntimeError("Multiple versions of %s" % (ref.dataId,))
+            filterRefs[ref.dataId["filter"]] = ref
+        return [(list(filterRefs.values()), dict(selectDataList=parsedCmd.selectId.dataList, **kwargs))
+                for filterRefs in refList.values()]
+
+
+class MultiBandAssembleCoaddDataIdContainer(AssembleCoaddDataIdContainer):
+    """!
+    \brief An AssembleCoaddDataIdContainer that reads the configuration of the assembleCoadd subtask
+    """
+
+    def makeDataRefList(self, namespace):
+        assembleNamespace = copy.copy(namespace)
+        assembleNamespace.config = namespace.config.assembleCoadd
+        AssembleCoaddDataIdContainer.makeDataRefList(self, assembleNamespace)
+
+
+class MultiBandAssembleCoaddTask(pipeBase.CmdLineTask):
+    """!
+    \anchor MultiBandAssembleCoaddTask_
+
+    \brief Assemble the coadds of several bands of a patch in one process
+
+    Assembling each band separately looks up the patch in the sky map and selects the calexps overlapping
+    the patch (reading and testing the Wcs of every calexp in the selection list) once for each band.
+    This task looks up the patch once and, when the select task is a \ref WcsSelectImagesTask, selects
+    the calexps once for the patch, then assembles the coadd of each band with the
+    \ref AssembleCoaddTask_ "assembleCoadd" subtask (which may be retargeted to SafeClipAssembleCoaddTask
+    or CompareWarpAssembleCoaddTask), passing it the shared geometry and the calexps of the band.
+
+    The bands are assembled in turn, each using the workers of the subtask, or config.numBandWorkers at
+    a time in forked processes. The warps of each band, and so their weights, scalings and valid regions,
+    are not shared.
+
+    Calexps selected once for the patch are assigned to a band by the "filter" key of their data ID; if
+    calexp data IDs do not carry it, every band is given all the selected calexps. A select task that is
+    not a WcsSelectImagesTask (or any select task, with config.doSelectPerBand) may depend on the filter of
+    the patch data ID, so it is run with the patch data reference of each band, as if assembled separately.
+    """
+    ConfigClass = MultiBandAssembleCoaddConfig
+    RunnerClass = MultiBandAssembleCoaddRunner
+    _DefaultName = "multiBandAssembleCoadd"
+
+    def __init__(self, *args, **kwargs):
+        pipeBase.CmdLineTask.__init__(self, *args, **kwargs)
+        self.makeSubtask("assembleCoadd")
+
+    @pipeBase.timeMethod
+    def run(self, patchRefList, selectDataList=[]):
+        """!
+        \brief Assemble the coadd of each band of a patch
+
+        \param[in] patchRefList: List of data references to the patch, one for each band
+        \param[in] selectDataList: List of data references to calexps, from which those overlapping the
+                                   patch are selected
+        \return a pipeBase.Struct with fields:
+                 - results: dict of filter: Struct returned by assembleCoadd.run (None if the band was
+                   assembled in a forked process or had no inputs)
+        \throws RuntimeError if any band failed, once all bands have been attempted
+        """
+        skyInfo = self.assembleCoadd.getSkyInfo(patchRefList[0])
+        bandList = self.selectBandExposures(patchRefList, skyInfo, selectDataList)
+
+        if self.config.numBandWorkers > 1 and len(bandList) > 1:
+            results, failedFilters = self.assembleBandsParallel(bandList, skyInfo, selectDataList)
+        else:
+            results = {}
+            failedFilters = []
+            for patchRef, bandCalExpRefList in bandList:
+                filterName = patchRef.dataId["filter"]
+                try:
+                    results[filterName] = self.assembleCoadd.run(patchRef, selectDataList, skyInfo=skyInfo,
+                                                                 calExpRefList=bandCalExpRefList)
+                except Exception as e:
+                    self.log.fatal("Failed to assemble %s: %s", patchRef.dataId, e)
+                    failedFilters.append(filterName)
+        if failedFilters:
+            raise RuntimeError("Failed to assemble filters %s of %s" %
+                               (failedFilters, patchRefList[0].dataId))
+        return pipeBase.Struct(results=results)
+
+    def selectBandExposures(self, patchRefList, skyInfo, selectDataList):
+        """!
+        \brief Select the calexps of each band of a patch
+
+        The calexps are selected once for the patch and split by filter if the selection depends only on
+        the Wcs, otherwise they are selected separately with the patch data reference of each band.
+
+        \param[in] patchRefList: List of data references to the patch, one for each band
+        \param[in] skyInfo: geometry of the patch
+        \param[in] selectDataList: List of data references to calexps
+        \return list of (patch data reference, list of calexp data references) for each band
+        """
+        select = self.assembleCoadd.select
+        if self.config.doSelectPerBand or not isinstance(select, WcsSelectImagesTask):
+            self.log.info("Selecting exposures separately for %d bands of %s (select task %s)",
+                          len(patchRefList), patchRefList[0].dataId, type(select).__name__)
+            return [(patchRef, self.assembleCoadd.selectExposures(patchRef, skyInfo,
+                                                                  selectDataList=selectDataList))
+                    for patchRef in patchRefList]
+
+        calExpRefList = self.assembleCoadd.selectExposures(patchRefList[0], skyInfo,
+                                                           selectDataList=selectDataList)
+        self.log.info("Selected %d exposures for %d bands of %s", len(calExpRefList), len(patchRefList),
+                      patchRefList[0].dataId)
+        return [(patchRef, self.getBandCalExpRefList(patchRef, calExpRefList)) for patchRef in patchRefList]
+
+    def getBandCalExpRefList(self, patchRef, calExpRefList):
+        """!
+        \brief Return the calexps of the band of a patch reference
+
+        \param[in] patchRef: Data reference to the patch in one band
+        \param[in] calExpRefList: List of data references to the calexps selected for all bands
+        \return list of the data references to calexps of the band (all of them if calexp data IDs do not
+            have a filter)
+        """
+        filterName = patchRef.dataId["filter"]
+        if not all("filter" in calExpRef.dataId for calExpRef in calExpRefList):
+            return calExpRefList
+        return [calExpRef for calExpRef in calExpRefList if calExpRef.dataId["filter"] == filterName]
+
+    def assembleBandsParallel(self, bandList, skyInfo, selectDataList):
+        """!
+        \brief Assemble bands concurrently in forked processes, config.numBandWorkers at a time
+
+        Each process assembles and writes the coadd of one band; the coadds are not returned.
+
+        \param[in] bandList: list of (patch data reference, list of calexp data references) for each band
+        \param[in] skyInfo: geometry of the patch
+        \param[in] selectDataList: List of data references to calexps
+        \return dict of filter: None for each band assembled, and the list of filters that failed
+        """
+        context = _getForkContext()
+        pending = list(bandList)
+        running = []
+        results = {}
+        failedFilters = []
+        while pending or running:
+            while pending and len(running) < self.config.numBandWorkers:
+                patchRef, bandCalExpRefList = pending.pop(0)
+                # Each band runs its own subregion worker pool, so the band processes must not be daemonic
+                process = context.Process(target=self._assembleBandInProcess,
+                                          args=(patchRef, skyInfo, selectDataList, bandCalExpRefList))
+                process.start()
+                running.append((patchRef.dataId["filter"], process))
+            filterName, process = running.pop(0)
+            process.join()
+            if process.exitcode == 0:
+                results[filterName] = None
+            else:
+                self.log.fatal("Failed to assemble filter %s: exit code %s", filterName, process.exitcode)
+                failedFilters.append(filterName)
+        return results, failedFilters
+
+    def _assembleBandInProcess(self, patchRef, skyInfo, selectDataList, calExpRefList):
+        """!
+        \brief Assemble one band in a forked process, exiting with a non-zero status on failure
+        """
+        try:
+            self.assembleCoadd.run(patchRef, selectDataList, skyInfo=skyInfo, calExpRefList=calExpRefList)
+        except Exception as e:
+            self.log.fatal("Failed to assemble %s: %s", patchRef.dataId, e)
+            raise
+
+    @classmethod
+    def _makeArgumentParser(cls):
+        """!
+        \brief Create an argument parser
+        """
+        config = cls.ConfigClass().assembleCoadd
+        parser = pipeBase.ArgumentParser(name=cls._DefaultName)
+        parser.add_id_argument("--id", config.coaddName + "Coadd_" + config.warpType + "Warp",
+                               help="data ID, e.g. --id tract=12345 patch=1,2 filter=g^r^i",
+                               ContainerClass=MultiBandAssembleCoaddDataIdContainer)
+        parser.add_id_argument("--selectId", "calexp", help="data ID, e.g. --selectId visit=6789 ccd=0..9",
+                               ContainerClass=SelectDataIdContainer)
+        return parser
+
+    def _getConfigName(self):
+        """!
+        \brief Do not persist the configuration: there is no dataset for it, and no single data ID
+        """
+        return None
+
+    def _getMetadataName(self):
+        return None
+
+    def writeMetadata(self, dataRefList):
+        """!
+        \brief No metadata to write for a list of dataRefs; each band's coadd records its own
+        """
+        pass
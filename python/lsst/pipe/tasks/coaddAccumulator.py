@@ -0,0 +1,233 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+import json
+import os
+
+import numpy
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+
+__all__ = ["MeanCoaddAccumulator"]
+
+
+class MeanCoaddAccumulator(object):
+    """Accumulate the weighted mean of warps so that warps can be added to or removed from a coadd
+
+    The accumulator keeps, for every pixel of the patch:
+    - the weighted sum of the good pixels of the warps, their sum of weights and their sum of
+      weight**2*variance, from which the weighted MEAN coadd and its variance are computed as by
+      lsst.afw.math.statisticsStack (with weights and errors computed from the input variance);
+    - the number of warps in which the pixel is not masked by the bad mask, for the nImage, and the number
+      of warps in which the pixel is good;
+    - for each mask plane, the number of good pixels with that plane set; the coadd mask has the plane set
+      if any good pixel has it set;
+    - for each plane with a mask propagation threshold, the sum of the weights of the rejected pixels with
+      that plane set, and their number; the coadd mask has the plane set if that sum exceeds the threshold
+      times the sum of the weights of all warps.
+    A pixel is good if none of the bad mask planes is set and its value is finite; pixels with no good
+    pixels are set to NaN and masked NO_DATA. All sums are kept as counts or in double precision, so they
+    can be decremented when a warp is removed. Whether a pixel has data, or has rejected pixels to
+    propagate, is decided from the counts, which are exact: the weight sums of a pixel from which all
+    warps have been removed may be left with a rounding residue instead of zero.
+
+    Warps are added and removed one subregion at a time; the accumulator itself covers the whole patch.
+    """
+    _version = 2
+
+    def __init__(self, bbox, badMaskPlanes, maskPropagationThresholds):
+        """Construct an empty accumulator
+
+        @param[in] bbox: bounding box of the patch
+        @param[in] badMaskPlanes: names of the mask planes of pixels to leave out of the coadd
+        @param[in] maskPropagationThresholds: dict of mask plane name: fraction of the total weight of the
+            rejected pixels with that plane set above which the plane is set in the coadd
+        """
+        self.bbox = afwGeom.Box2I(bbox)
+        self.badMaskPlanes = sorted(badMaskPlanes)
+        self.maskPropagationThresholds = dict(maskPropagationThresholds)
+        self.warps = {}
+        shape = (bbox.getHeight(), bbox.getWidth())
+        self.weightedSum = numpy.zeros(shape, dtype=numpy.float64)
+        self.weightSum = numpy.zeros(shape, dtype=numpy.float64)
+        self.varianceSum = numpy.zeros(shape, dtype=numpy.float64)
+        self.nImage = numpy.zeros(shape, dtype=numpy.int32)
+        self.goodCount = numpy.zeros(shape, dtype=numpy.int32)
+        self.maskCounts = {}
+        self.rejectedWeights = {plane: numpy.zeros(shape, dtype=numpy.float64)
+                                for plane in self.maskPropagationThresholds}
+        self.rejectedCounts = {plane: numpy.zeros(shape, dtype=numpy.int32)
+                               for plane in self.maskPropagationThresholds}
+
+    def getTotalWeight(self):
+        """Return the sum of the weights of all warps in the accumulator
+        """
+        return sum(warp["weight"] for warp in self.warps.values())
+
+    def add(self, key, maskedImage, weight, warpInfo=None):
+        """Add the subregion of a scaled warp to the accumulator
+
+        Call once for every subregion of the warp with the same key; the warp is recorded in the list of
+        warps on the first call.
+
+        @param[in] key: string identifying the warp
+        @param[in] maskedImage: subregion of the warp, scaled to the coadd zero point
+        @param[in] weight: weight of the warp
+        @param[in] warpInfo: dict of further JSON-serializable information to record about the warp
+        """
+        if key not in self.warps:
+            info = dict(warpInfo) if warpInfo is not None else {}
+            info["weight"] = weight
+            self.warps[key] = info
+        self._accumulate(maskedImage, weight, 1)
+
+    def remove(self, key, maskedImage):
+        """Remove the subregion of a scaled warp from the accumulator
+
+        Call once for every subregion of the warp, then call \\ref forget.
+
+        @param[in] key: string identifying the warp, as given to \\ref add
+        @param[in] maskedImage: subregion of the warp, scaled to the coadd zero point as when it was added
+        """
+        self._accumulate(maskedImage, self.warps[key]["weight"], -1)
+
+    def forget(self, key):
+        """Remove a warp from the list of warps, once all its subregions have been removed
+        """
+        del self.warps[key]
+
+    def _accumulate(self, maskedImage, weight, sign):
+        """Add (sign=1) or subtract (sign=-1) the subregion of a warp
+        """
+        bbox = maskedImage.getBBox(afwImage.PARENT)
+        rows = slice(bbox.getMinY() - self.bbox.getMinY(), bbox.getMaxY() + 1 - self.bbox.getMinY())
+        cols = slice(bbox.getMinX() - self.bbox.getMinX(), bbox.getMaxX() + 1 - self.bbox.getMinX())
+        image = maskedImage.getImage().getArray()
+        variance = maskedImage.getVariance().getArray()
+        mask = maskedImage.getMask().getArray()
+        notBad = (mask & afwImage.Mask.getPlaneBitMask(self.badMaskPlanes)) == 0
+        good = notBad & numpy.isfinite(image)
+
+        self.nImage[rows, cols] += sign*notBad
+        self.goodCount[rows, cols] += sign*good
+        self.weightedSum[rows, cols] += numpy.where(good, sign*weight*image, 0.0)
+        self.weightSum[rows, cols] += numpy.where(good, sign*weight, 0.0)
+        self.varianceSum[rows, cols] += numpy.where(good, sign*weight**2*variance, 0.0)
+
+        for plane, bit in afwImage.Mask.getMaskPlaneDict().items():
+            hasPlane = (mask & (1 << bit)) != 0
+            if plane in self.rejectedWeights:
+                rejectedWithPlane = hasPlane & ~good
+                self.rejectedWeights[plane][rows, cols] += numpy.where(rejectedWithPlane, sign*weight, 0.0)
+                self.rejectedCounts[plane][rows, cols] += sign*rejectedWithPlane
+            goodWithPlane = hasPlane & good
+            if plane not in self.maskCounts:
+                if not goodWithPlane.any():
+                    continue
+                self.maskCounts[plane] = numpy.zeros(self.weightSum.shape, dtype=numpy.int32)
+            self.maskCounts[plane][rows, cols] += sign*goodWithPlane
+
+    def makeCoadd(self):
+        """Make the coadd from the accumulated sums
+
+        @return MaskedImageF of the coadd, and ImageU of the number of warps contributing to each pixel
+        """
+        maskedImage = afwImage.MaskedImageF(self.bbox)
+        hasData = self.goodCount > 0
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            maskedImage.getImage().getArray()[:] = numpy.where(hasData, self.weightedSum/self.weightSum,
+                                                               numpy.nan)
+            maskedImage.getVariance().getArray()[:] = numpy.where(hasData,
+                                                                  self.varianceSum/self.weightSum**2,
+                                                                  numpy.nan)
+        maskArray = maskedImage.getMask().getArray()
+        for plane, counts in self.maskCounts.items():
+            maskArray[counts > 0] |= afwImage.Mask.getPlaneBitMask(plane)
+        totalWeight = self.getTotalWeight()
+        for plane, rejectedWeight in self.rejectedWeights.items():
+            threshold = self.maskPropagationThresholds[plane]*totalWeight
+            propagate = (self.rejectedCounts[plane] > 0) & (rejectedWeight > threshold)
+            maskArray[propagate] |= afwImage.Mask.getPlaneBitMask(plane)
+        maskArray[~hasData] = afwImage.Mask.getPlaneBitMask("NO_DATA")
+        nImage = afwImage.ImageU(self.bbox)
+        nImage.getArray()[:] = self.nImage
+        return maskedImage, nImage
+
+    def writeTo(self, filename, configKey):
+        """Write the accumulator to a file, via a temporary file so that it is replaced atomically
+
+        @param[in] filename: name of the file (a numpy .npz file)
+        @param[in] configKey: string identifying the configuration with which the warps were accumulated
+        """
+        metadata = dict(
+            version=self._version,
+            configKey=configKey,
+            bbox=[self.bbox.getMinX(), self.bbox.getMinY(), self.bbox.getWidth(), self.bbox.getHeight()],
+            badMaskPlanes=self.badMaskPlanes,
+            maskPropagationThresholds=self.maskPropagationThresholds,
+            warps=self.warps,
+        )
+        arrays = dict(weightedSum=self.weightedSum, weightSum=self.weightSum, varianceSum=self.varianceSum,
+                      nImage=self.nImage, goodCount=self.goodCount,
+                      metadata=numpy.array(json.dumps(metadata)))
+        for plane, counts in self.maskCounts.items():
+            arrays["maskCount_" + plane] = counts
+        for plane, rejectedWeight in self.rejectedWeights.items():
+            arrays["rejectedWeight_" + plane] = rejectedWeight
+            arrays["rejectedCount_" + plane] = self.rejectedCounts[plane]
+        tmpFilename = "%s.%d.tmp.npz" % (filename[:-len(".npz")] if filename.endswith(".npz") else filename,
+                                         os.getpid())
+        numpy.savez_compressed(tmpFilename, **arrays)
+        os.rename(tmpFilename, filename)
+
+    @classmethod
+    def readFrom(cls, filename, configKey):
+        """Read an accumulator written by \\ref writeTo
+
+        @param[in] filename: name of the file
+        @param[in] configKey: string identifying the current configuration
+        @return MeanCoaddAccumulator, or None if the file was written by another version of this class or
+            with another configuration
+        """
+        with numpy.load(filename) as data:
+            metadata = json.loads(str(data["metadata"]))
+            if metadata.get("version") != cls._version or metadata.get("configKey") != configKey:
+                return None
+            x0, y0, width, height = metadata["bbox"]
+            bbox = afwGeom.Box2I(afwGeom.Point2I(x0, y0), afwGeom.Extent2I(width, height))
+            accumulator = cls(bbox, metadata["badMaskPlanes"], metadata["maskPropagationThresholds"])
+            accumulator.warps = metadata["warps"]
+            accumulator.weightedSum = data["weightedSum"]
+            accumulator.weightSum = data["weightSum"]
+            accumulator.varianceSum = data["varianceSum"]
+            accumulator.nImage = data["nImage"]
+            accumulator.goodCount = data["goodCount"]
+            for name in data.files:
+                if name.startswith("maskCount_"):
+                    accumulator.maskCounts[name[len("maskCount_"):]] = data[name]
+                elif name.startswith("rejectedWeight_"):
+                    accumulator.rejectedWeights[name[len("rejectedWeight_"):]] = data[name]
+                elif name.startswith("rejectedCount_"):
+                    accumulator.rejectedCounts[name[len("rejectedCount_"):]] = data[name]
+        return accumulator
@@ -0,0 +1,112 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object, range
+import os
+import tempfile
+
+import numpy
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+
+__all__ = ["StagedStack"]
+
+
+class StagedStack(object):
+    """The prepared subregions of a stack of warps, kept in a memory-mapped scratch file
+
+    Each input is written once, as a whole subregion, and the stack is then read back one band of rows
+    at a time, so a stack deeper than the memory budget is stacked without reading the warps once per
+    band. The image, mask and variance planes of each input are contiguous, so a band is read as one
+    contiguous block of rows per input.
+    """
+
+    def __init__(self, bbox, numInputs, stagingDir=None):
+        """Create the scratch file
+
+        @param[in] bbox: parent bounding box of the subregion
+        @param[in] numInputs: number of inputs in the stack
+        @param[in] stagingDir: directory of the scratch file; None for the default temporary directory
+        """
+        self.bbox = afwGeom.Box2I(bbox)
+        self.numInputs = numInputs
+        shape = (numInputs, bbox.getHeight(), bbox.getWidth())
+        maskDtype = afwImage.Mask(afwGeom.Extent2I(1, 1)).getArray().dtype
+        dtypeList = [numpy.float32, maskDtype, numpy.float32]
+        fd, self.filename = tempfile.mkstemp(dir=stagingDir, suffix=".stack")
+        os.close(fd)
+        sizeList = [numpy.dtype(dtype).itemsize*numInputs*bbox.getArea() for dtype in dtypeList]
+        with open(self.filename, "r+b") as stagingFile:
+            stagingFile.truncate(sum(sizeList))
+        self._cubes = []
+        offset = 0
+        for dtype, size in zip(dtypeList, sizeList):
+            self._cubes.append(numpy.memmap(self.filename, dtype=dtype, mode="r+", offset=offset,
+                                            shape=shape))
+            offset += size
+
+    def assignInput(self, index, imageArr, maskArr, varianceArr):
+        """Stage the prepared subregion of an input
+
+        @param[in] index: index of the input in the stack
+        @param[in] imageArr, maskArr, varianceArr: planes of the whole subregion of the input
+        """
+        for cube, array in zip(self._cubes, (imageArr, maskArr, varianceArr)):
+            cube[index] = array
+
+    def getBandCubes(self, bbox):
+        """Read a band of rows of the stack into memory
+
+        @param[in] bbox: parent bounding box of the band, spanning the width of the subregion
+        @return image, mask and variance arrays of shape (numInputs, height of bbox, width of bbox)
+        """
+        rows, cols = self._getSlices(bbox)
+        return [numpy.array(cube[:, rows, cols]) for cube in self._cubes]
+
+    def getBandMaskedImages(self, bbox):
+        """Read a band of rows of the stack into memory as a list of MaskedImageFs
+
+        @param[in] bbox: parent bounding box of the band, spanning the width of the subregion
+        @return list of the MaskedImageF of each input over bbox
+        """
+        rows, cols = self._getSlices(bbox)
+        imageCube, maskCube, varianceCube = self._cubes
+        maskedImageList = []
+        for i in range(self.numInputs):
+            maskedImage = afwImage.MaskedImageF(bbox)
+            maskedImage.getImage().getArray()[:] = imageCube[i, rows, cols]
+            maskedImage.getMask().getArray()[:] = maskCube[i, rows, cols]
+            maskedImage.getVariance().getArray()[:] = varianceCube[i, rows, cols]
+            maskedImageList.append(maskedImage)
+        return maskedImageList
+
+    def _getSlices(self, bbox):
+        return (slice(bbox.getMinY() - self.bbox.getMinY(), bbox.getMaxY() + 1 - self.bbox.getMinY()),
+                slice(bbox.getMinX() - self.bbox.getMinX(), bbox.getMaxX() + 1 - self.bbox.getMinX()))
+
+    def close(self):
+        """Unmap and delete the scratch file
+        """
+        self._cubes = []
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
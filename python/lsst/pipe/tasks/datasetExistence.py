@@ -0,0 +1,125 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+import os
+import threading
+
+__all__ = ["DatasetExistenceCache", "getExistenceCache"]
+
+
+class DatasetExistenceCache(object):
+    """Remember which datasets exist, so that each is looked up in the repository once per process
+
+    The same calexp is selected for every patch it overlaps, and warp tasks are constructed afresh for
+    each patch; with this cache its existence is checked once. The datasets of a list (e.g. the calexps of
+    a patch, or its warps) are looked up together by prefetch, with one listing of each directory that
+    holds them, rather than one file system lookup per dataset. Lookups go through the butler, which is
+    not thread-safe, so they are made one at a time. Datasets written by this process should be recorded
+    with setExists.
+    """
+
+    def __init__(self):
+        self._exists = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _getKey(dataRef, datasetType):
+        return (datasetType, tuple(sorted(dataRef.dataId.items())))
+
+    def exists(self, dataRef, datasetType):
+        """Return whether a dataset exists, looking it up in the repository if it is not cached
+
+        @param dataRef: data reference for the dataset
+        @param datasetType: name of the dataset
+        """
+        key = self._getKey(dataRef, datasetType)
+        with self._lock:
+            if key in self._exists:
+                return self._exists[key]
+        exists = bool(dataRef.datasetExists(datasetType))
+        with self._lock:
+            self._exists[key] = exists
+        return exists
+
+    def prefetch(self, dataRefList, datasetType):
+        """Look up the existence of the datasets that are not yet cached, listing each directory once
+
+        The butler gives the file name of each dataset ("<datasetType>_filename"); the directories holding
+        them (e.g. the visit directories of calexps, or the directory of the warps of a patch) are then
+        listed once each, and a dataset exists if its file is listed.
+        Datasets whose file name cannot be obtained, or whose directory cannot be listed, are left to be
+        looked up one by one by exists.
+
+        @param dataRefList: list of data references for the datasets
+        @param datasetType: name of the datasets
+        """
+        with self._lock:
+            pendingList = [dataRef for dataRef in dataRefList
+                           if self._getKey(dataRef, datasetType) not in self._exists]
+        directories = {}
+        for dataRef in pendingList:
+            try:
+                filename = dataRef.get(datasetType + "_filename")[0]
+            except Exception:
+                continue
+            # Strip the HDU of a dataset in a multi-extension file, e.g. "calexp.fits[1]"
+            if filename.endswith("]") and "[" in filename:
+                filename = filename[:filename.rindex("[")]
+            directory, basename = os.path.split(filename)
+            directories.setdefault(directory, []).append((dataRef, basename))
+        for directory, entryList in directories.items():
+            try:
+                names = set(os.listdir(directory or os.curdir))
+            except OSError:
+                if os.path.exists(directory):
+                    continue
+                names = set()
+            with self._lock:
+                for dataRef, basename in entryList:
+                    self._exists[self._getKey(dataRef, datasetType)] = basename in names
+
+    def setExists(self, dataRef, datasetType, exists=True):
+        """Record that a dataset exists (e.g. because this process wrote it), or not
+        """
+        with self._lock:
+            self._exists[self._getKey(dataRef, datasetType)] = exists
+
+    def clear(self):
+        with self._lock:
+            self._exists.clear()
+
+    def __len__(self):
+        return len(self._exists)
+
+
+# Existence of the datasets looked up by this process; see getExistenceCache
+_existenceCache = None
+
+
+def getExistenceCache():
+    """Return the process-wide DatasetExistenceCache
+    """
+    global _existenceCache
+    if _existenceCache is None:
+        _existenceCache = DatasetExistenceCache()
+    return _existenceCache
@@ -78,7 +78,15 @@ class InterpImageTask(pipeBase.Task):
     _DefaultName = "interpImage"
 
     def _setFallbackValue(self, mi=None):
-        """Set the edge fallbackValue for interpolation
+        """Set the edge fallbackValue for interpolation; see computeFallbackValue
+        """
+        return self.computeFallbackValue(mi)
+
+    def computeFallbackValue(self, mi=None):
+        """Compute the edge fallbackValue for interpolation
+
+        Call this to compute the value over a whole image before interpolating parts of it with run,
+        so that all parts use the same value.
 
         \param[in] mi  input maksedImage on which to calculate the statistics
                        Must be provided if fallbackValueType != "USER".
@@ -111,7 +119,7 @@ class InterpImageTask(pipeBase.Task):
         return fallbackValue
 
     @pipeBase.timeMethod
-    def run(self, image, planeName=None, fwhmPixels=None, defects=None):
+    def run(self, image, planeName=None, fwhmPixels=None, defects=None, fallbackValue=None):
         """!Interpolate in place over pixels in a maskedImage marked as bad
 
         Pixels to be interpolated are set by either a mask planeName provided
@@ -135,6 +143,11 @@ class InterpImageTask(pipeBase.Task):
                                    is set to the exposure psf if available
         \param[in]     defects     List of defects of type measAlg.DefectListT
                                    over which to interpolate.
+        \param[in]     fallbackValue  Value to taper to at the edge of the image, if
+                                   config.useFallbackValueAtEdge; if None it is computed from
+                                   the image as set by config.fallbackValueType. Pass it
+                                   (e.g. from computeFallbackValue) when interpolating parts of
+                                   a larger image, so all parts use the same value.
         """
         try:
             maskedImage = image.getMaskedImage()
@@ -165,9 +178,10 @@ class InterpImageTask(pipeBase.Task):
                            (str(self.config.modelPsf.defaultFwhm)) + " [default]"))
             psf = self.config.modelPsf.apply(fwhm=fwhmPixels)
 
-        fallbackValue = 0.0  # interpolateOverDefects needs this to be a float, regardless if it is used
-        if self.config.useFallbackValueAtEdge:
-            fallbackValue = self._setFallbackValue(maskedImage)
+        if not self.config.useFallbackValueAtEdge:
+            fallbackValue = 0.0  # interpolateOverDefects needs this to be a float, regardless if it is used
+        elif fallbackValue is None:
+            fallbackValue = self.computeFallbackValue(maskedImage)
 
         measAlg.interpolateOverDefects(maskedImage, psf, defectList, fallbackValue,
                                        self.config.useFallbackValueAtEdge)
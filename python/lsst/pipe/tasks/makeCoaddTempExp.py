@@ -21,19 +21,53 @@
 #
 
 from __future__ import absolute_import, division, print_function
+from builtins import zip
+from builtins import range
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+
 import numpy
 
 import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
+from lsst.afw.geom.polygon import Polygon
 import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
 import lsst.coadd.utils as coaddUtils
 import lsst.pipe.base as pipeBase
 import lsst.log as log
-from lsst.meas.algorithms import CoaddPsf, CoaddPsfConfig
-from .coaddBase import CoaddBaseTask
-from .warpAndPsfMatch import WarpAndPsfMatchTask
+from lsst.meas.algorithms import CoaddPsf, CoaddPsfConfig, KernelPsf, WarpedPsf
+from .coaddBase import CoaddBaseTask, CoaddTaskRunner
+from .warpAndPsfMatch import WarpAndPsfMatchTask, PsfMatchingKernelCache
 from .coaddHelpers import groupPatchExposures, getGroupDataRef
+from .datasetExistence import getExistenceCache
+from .warpReader import writeCompressedWarp
+
+__all__ = ["MakeCoaddTempExpTask", "MakeTractCoaddTempExpTask", "WARP_WEIGHT_KEYS"]
+
+# Metadata keys in which MakeCoaddTempExpTask records the clipped mean variance of a warp
+# and the parameters used to measure it (see MakeCoaddTempExpTask.measureWeightStats)
+WARP_WEIGHT_KEYS = pipeBase.Struct(
+    meanVar="WGT_MVAR",
+    sigmaClip="WGT_NSIG",
+    clipIter="WGT_NITR",
+    badMaskPlanes="WGT_MASK",
+)
 
-__all__ = ["MakeCoaddTempExpTask"]
+# Number of points along each edge of the valid polygon of a calexp mapped to the tract
+# to predict its coverage of a patch
+_COVERAGE_EDGE_POINTS = 8
+# Margin, in pixels, by which the patch is grown when predicting coverage, to allow for the approximation
+# of the mapped edges of the calexp by straight lines
+_COVERAGE_MARGIN = 2
+
+# Configuration fields that do not affect the warps made, and so are not part of the configuration key
+# of a warp manifest
+_MANIFEST_IGNORED_FIELDS = ("doWrite", "doOverwrite", "numWarpWorkers", "doCacheExistence",
+                            "doUseManifest", "maxPatchesPerBatch")
 
 
 class MakeCoaddTempExpConfig(CoaddBaseTask.ConfigClass):
@@ -72,11 +106,112 @@ class MakeCoaddTempExpConfig(CoaddBaseTask.ConfigClass):
         dtype=bool,
         default=False,
     )
+    numWarpWorkers = pexConfig.RangeField(
+        doc="Number of forked processes that warp and PSF-match the calexps of a warp concurrently; 1 works "
+        "serially in this process. The calexps are still read by this process one at a time, and their good "
+        "pixels copied into the warp in order. PSF-matching kernels are not cached by the workers.",
+        dtype=int,
+        default=1,
+        min=1,
+    )
+    doCacheExistence = pexConfig.Field(
+        doc="Look up the existence of calexps and warps once per process, keeping the result for other "
+        "patches? The calexps, and the warps, of a patch are looked up together, by listing the directories "
+        "that hold them.",
+        dtype=bool,
+        default=False,
+    )
+    doUseManifest = pexConfig.Field(
+        doc="Record each warp made in a manifest next to the coadd of the patch, with the calexps selected "
+        "for it, and, unless doOverwrite, skip the warps recorded with the same calexps and configuration "
+        "without checking whether their calexps or the warps themselves exist? Warps none of whose calexps "
+        "exist or are predicted to cover the patch are recorded as not created. This lets an interrupted "
+        "run resume where it stopped; delete the manifest (or set doOverwrite) to remake its warps.",
+        dtype=bool,
+        default=False,
+    )
+    doCompressWarps = pexConfig.Field(
+        doc="Rewrite each warp after it is persisted with tiled compression (see warpCompressionAlgorithm, "
+        "warpCompressionTileSize and warpQuantizeLevel)? The image and variance of its NO_DATA pixels are "
+        "not kept. Assembly reads compressed warps with the afw FITS reader instead of memory-mapping them, "
+        "decompressing only the tiles each subregion overlaps.",
+        dtype=bool,
+        default=False,
+    )
+    warpCompressionAlgorithm = pexConfig.ChoiceField(
+        doc="Algorithm used to compress warps; ignored unless doCompressWarps",
+        dtype=str,
+        default="GZIP_SHUFFLE",
+        allowed={
+            "GZIP": "gzip",
+            "GZIP_SHUFFLE": "gzip after shuffling the bytes of each pixel",
+            "RICE": "Rice coding",
+        },
+    )
+    warpCompressionTileSize = pexConfig.RangeField(
+        doc="Width and height, in pixels, of the tiles in which warps are compressed; ignored unless "
+        "doCompressWarps",
+        dtype=int,
+        default=128,
+        min=1,
+    )
+    warpQuantizeLevel = pexConfig.RangeField(
+        doc="Number of quantization steps per standard deviation of the image and variance of a compressed "
+        "warp; 0 compresses them losslessly. The mask is always compressed losslessly. Ignored unless "
+        "doCompressWarps.",
+        dtype=float,
+        default=0.0,
+        min=0.0,
+    )
+    doWeightStats = pexConfig.Field(
+        doc="Measure the clipped mean variance of each warp, which assembleCoadd uses to weight the warp, "
+        "and record it in the warp metadata so that assembleCoadd need not read the whole warp to do so",
+        dtype=bool,
+        default=False,
+    )
+    doPredictCoverage = pexConfig.Field(
+        doc="Predict the fraction of the patch covered by each calexp, by mapping its valid polygon (or else "
+        "its bounding box) onto the patch using the Wcs it is warped with (from its header, or the "
+        "meas_mosaic Wcs if doApplyUberCal), and skip the calexps predicted to cover no more than "
+        "minPredictedCoverage before reading their pixels? Skipped calexps are not recorded in the "
+        "CoaddInputs of the warp, even if inputRecorder.saveEmptyCcds. The mapped polygons are kept by the "
+        "process for other patches.",
+        dtype=bool,
+        default=False,
+    )
+    minPredictedCoverage = pexConfig.RangeField(
+        doc="Fraction of the patch a calexp must be predicted to cover to be warped; ignored unless "
+        "doPredictCoverage. With 0, only calexps predicted not to overlap the patch at all are skipped.",
+        dtype=float,
+        default=0.0,
+        min=0.0,
+        max=1.0,
+    )
+    weightSigmaClip = pexConfig.Field(
+        doc="Sigma for outlier rejection of the clipped mean variance; "
+        "must match assembleCoadd's sigmaClip for the measurement to be used",
+        dtype=float,
+        default=3.0,
+    )
+    weightClipIter = pexConfig.Field(
+        doc="Number of iterations of outlier rejection of the clipped mean variance; "
+        "must match assembleCoadd's clipIter for the measurement to be used",
+        dtype=int,
+        default=2,
+    )
+    weightBadMaskPlanes = pexConfig.ListField(
+        doc="Mask planes ignored by the clipped mean variance; "
+        "must match assembleCoadd's badMaskPlanes for the measurement to be used",
+        dtype=str,
+        default=("NO_DATA", "BAD", "CR"),
+    )
 
     def validate(self):
         CoaddBaseTask.ConfigClass.validate(self)
         if not self.makePsfMatched and not self.makeDirect:
             raise RuntimeError("At least one of config.makePsfMatched and config.makeDirect must be True")
+        if self.doUseManifest and not self.doWrite:
+            raise RuntimeError("config.doUseManifest requires config.doWrite")
         if self.doPsfMatch:
             # Backwards compatibility.
             log.warn("Config doPsfMatch deprecated. Setting makePsfMatched=True and makeDirect=False")
@@ -268,32 +403,38 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
         (assembleCoadd should determine zeropoint scaling without referring to it).
         """
         skyInfo = self.getSkyInfo(patchRef)
-
-        # DataRefs to return are of type *_directWarp unless only *_psfMatchedWarp requested
-        if self.config.makePsfMatched and not self.config.makeDirect:
-            primaryWarpDataset = self.getTempExpDatasetName("psfMatched")
-        else:
-            primaryWarpDataset = self.getTempExpDatasetName("direct")
+        primaryWarpDataset = self.getPrimaryWarpDatasetName()
 
         calExpRefList = self.selectExposures(patchRef, skyInfo, selectDataList=selectDataList)
         if len(calExpRefList) == 0:
             self.log.warn("No exposures to coadd for patch %s", patchRef.dataId)
             return None
         self.log.info("Selected %d calexps for patch %s", len(calExpRefList), patchRef.dataId)
-        calExpRefList = [calExpRef for calExpRef in calExpRefList if calExpRef.datasetExists("calexp")]
+        dataRefList = []
+        manifest = None
+        if self.config.doUseManifest:
+            manifest = self.readManifest(patchRef)
+            calExpRefList = self.removeCompletedWarps(manifest, patchRef, calExpRefList, dataRefList)
+        calExpRefList = self.selectExistingCalExps(calExpRefList)
+        if self.config.doPredictCoverage:
+            calExpRefList = self.selectCoveringCalExps(calExpRefList, skyInfo)
+        if manifest is not None:
+            self.recordUnmadeWarpsInManifest(manifest, patchRef, calExpRefList)
         self.log.info("Processing %d existing calexps for patch %s", len(calExpRefList), patchRef.dataId)
 
         groupData = groupPatchExposures(patchRef, calExpRefList, self.getCoaddDatasetName(),
                                         primaryWarpDataset)
         self.log.info("Processing %d warp exposures for patch %s", len(groupData.groups), patchRef.dataId)
 
-        dataRefList = []
-        for i, (tempExpTuple, calexpRefList) in enumerate(groupData.groups.items()):
-            tempExpRef = getGroupDataRef(patchRef.getButler(), primaryWarpDataset,
-                                         tempExpTuple, groupData.keys)
-            if not self.config.doOverwrite and tempExpRef.datasetExists(datasetType=primaryWarpDataset):
+        tempExpRefList = [getGroupDataRef(patchRef.getButler(), primaryWarpDataset, tempExpTuple,
+                                          groupData.keys) for tempExpTuple in groupData.groups]
+        self.prefetchWarpExistence(tempExpRefList, primaryWarpDataset)
+        for i, (tempExpRef, calexpRefList) in enumerate(zip(tempExpRefList, groupData.groups.values())):
+            if not self.config.doOverwrite and self.warpExists(tempExpRef, primaryWarpDataset):
                 self.log.info("Warp %s exists; skipping", tempExpRef.dataId)
                 dataRefList.append(tempExpRef)
+                if manifest is not None:
+                    self.recordWarpInManifest(manifest, tempExpRef, True)
                 continue
             self.log.info("Processing Warp %d/%d: id=%s", i, len(groupData.groups), tempExpRef.dataId)
 
@@ -313,13 +454,216 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
                 self.log.warn("Warp %s could not be created", tempExpRef.dataId)
 
             if self.config.doWrite:
-                for (warpType, exposure) in exps.items():  # compatible w/ Py3
-                    if exposure is not None:
-                        self.log.info("Persisting %s" % self.getTempExpDatasetName(warpType))
-                        tempExpRef.put(exposure, self.getTempExpDatasetName(warpType))
+                self.writeWarps(tempExpRef, exps)
+                if manifest is not None:
+                    self.recordWarpInManifest(manifest, tempExpRef, any(exps.values()))
 
         return dataRefList
 
+    def writeWarps(self, tempExpRef, exps):
+        """Persist the warps of a visit
+
+        @param tempExpRef: data reference for the warps
+        @param exps: dictionary of warp type: warp, or None if it was not created
+        """
+        for (warpType, exposure) in exps.items():  # compatible w/ Py3
+            if exposure is not None:
+                self.log.info("Persisting %s" % self.getTempExpDatasetName(warpType))
+                tempExpRef.put(exposure, self.getTempExpDatasetName(warpType))
+                if self.config.doCompressWarps:
+                    self.compressWarp(tempExpRef, self.getTempExpDatasetName(warpType), exposure)
+                if self.config.doCacheExistence:
+                    getExistenceCache().setExists(tempExpRef, self.getTempExpDatasetName(warpType))
+
+    def compressWarp(self, tempExpRef, datasetType, exposure):
+        """Replace a persisted warp by a tile-compressed copy
+
+        The copy is written next to the warp and renamed over it, so the warp is never left half-written.
+
+        @param tempExpRef: data reference for the warp
+        @param datasetType: dataset type of the warp
+        @param exposure: the warp; the image and variance of its NO_DATA pixels are set to NaN
+        """
+        filename = tempExpRef.get(datasetType + "_filename")[0]
+        tmpFilename = filename + ".tmp"
+        writeCompressedWarp(exposure, tmpFilename, algorithm=self.config.warpCompressionAlgorithm,
+                            tileSize=self.config.warpCompressionTileSize,
+                            quantizeLevel=self.config.warpQuantizeLevel)
+        os.rename(tmpFilename, filename)
+
+    def selectExistingCalExps(self, calExpRefList):
+        """Return the calexps that exist
+
+        With config.doCacheExistence, their existence is looked up through the process-wide
+        DatasetExistenceCache, listing each calexp directory once.
+
+        @param calExpRefList: List of data references for calexps
+        @return list of the data references of the calexps that exist
+        """
+        if not self.config.doCacheExistence:
+            return [calExpRef for calExpRef in calExpRefList if calExpRef.datasetExists("calexp")]
+        existenceCache = getExistenceCache()
+        existenceCache.prefetch(calExpRefList, "calexp")
+        return [calExpRef for calExpRef in calExpRefList if existenceCache.exists(calExpRef, "calexp")]
+
+    def prefetchWarpExistence(self, tempExpRefList, datasetType):
+        """Look up the existence of the warps of a patch together, listing their directory once, if
+        config.doCacheExistence and existing warps are skipped (not config.doOverwrite)
+
+        @param tempExpRefList: List of data references for the warps
+        @param datasetType: dataset type of the warps
+        """
+        if self.config.doCacheExistence and not self.config.doOverwrite:
+            getExistenceCache().prefetch(tempExpRefList, datasetType)
+
+    def warpExists(self, tempExpRef, datasetType):
+        """Return whether a warp exists, through the process-wide DatasetExistenceCache if
+        config.doCacheExistence
+        """
+        if self.config.doCacheExistence:
+            return getExistenceCache().exists(tempExpRef, datasetType)
+        return tempExpRef.datasetExists(datasetType=datasetType)
+
+    def getManifestFilename(self, patchRef):
+        """Return the name of the manifest of the warps of a patch, next to the coadd of the patch
+        """
+        return patchRef.get(self.getCoaddDatasetName() + "_filename")[0] + ".warpManifest.json"
+
+    def makeManifestConfigKey(self):
+        """Return a key identifying the configuration with which the warps in a manifest were made
+
+        Fields that do not affect the warps themselves are left out.
+        """
+        configDict = self.config.toDict()
+        for name in _MANIFEST_IGNORED_FIELDS:
+            configDict.pop(name, None)
+        return hashlib.sha1(json.dumps(configDict, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def readManifest(self, patchRef):
+        """Read the manifest of the warps of a patch
+
+        A manifest that cannot be read, or was written with another configuration, is ignored and will
+        be replaced.
+
+        @param patchRef: data reference for the patch
+        @return dict with the filename of the manifest, the configuration key and a dict of the warps made:
+            warp key (see _getManifestKey): dict with the calexps selected for the warp and whether it
+            was created
+        """
+        manifest = dict(filename=self.getManifestFilename(patchRef), configKey=self.makeManifestConfigKey(),
+                        warps={})
+        if not os.path.exists(manifest["filename"]):
+            return manifest
+        try:
+            with open(manifest["filename"]) as manifestFile:
+                content = json.load(manifestFile)
+        except (IOError, ValueError) as e:
+            self.log.warn("Cannot read warp manifest %s; ignoring it: %s", manifest["filename"], e)
+            return manifest
+        if content.get("configKey") != manifest["configKey"]:
+            self.log.info("Warp manifest %s was made with another configuration; ignoring it",
+                          manifest["filename"])
+            return manifest
+        manifest["warps"] = content["warps"]
+        self.log.info("Read %d warps from manifest %s", len(manifest["warps"]), manifest["filename"])
+        return manifest
+
+    def removeCompletedWarps(self, manifest, patchRef, calExpRefList, dataRefList):
+        """Remove the calexps of the warps that a manifest records as made from the same calexps
+
+        Warps are not removed if config.doOverwrite. The calexps selected for each remaining warp are noted
+        in the manifest, to be recorded with the warp by recordWarpInManifest or recordUnmadeWarpsInManifest.
+
+        @param manifest: manifest of the patch, as returned by readManifest
+        @param patchRef: data reference for the patch
+        @param calExpRefList: List of data references for the calexps selected for the patch
+        @param dataRefList: list to which the data references of the completed warps that were created
+            are appended
+        @return list of the data references for the calexps of the warps still to be made
+        """
+        primaryWarpDataset = self.getPrimaryWarpDatasetName()
+        groupData = groupPatchExposures(patchRef, calExpRefList, self.getCoaddDatasetName(),
+                                        primaryWarpDataset)
+        pending = manifest.setdefault("pending", {})
+        remainingRefList = []
+        for tempExpTuple, groupRefList in groupData.groups.items():
+            tempExpRef = getGroupDataRef(patchRef.getButler(), primaryWarpDataset,
+                                         tempExpTuple, groupData.keys)
+            warpKey = self._getManifestKey(tempExpRef.dataId)
+            calExpKeys = sorted(self._getManifestKey(calExpRef.dataId) for calExpRef in groupRefList)
+            entry = manifest["warps"].get(warpKey)
+            if entry is not None and entry["calexps"] == calExpKeys and not self.config.doOverwrite:
+                self.log.info("Warp %s is in the manifest; skipping", tempExpRef.dataId)
+                if entry["created"]:
+                    dataRefList.append(tempExpRef)
+                continue
+            pending[warpKey] = calExpKeys
+            remainingRefList += groupRefList
+        return remainingRefList
+
+    def recordWarpInManifest(self, manifest, tempExpRef, created):
+        """Record a warp in the manifest of its patch, and rewrite the manifest
+
+        @param manifest: manifest of the patch, as returned by readManifest
+        @param tempExpRef: data reference for the warp
+        @param created: was the warp created (rather than having no good pixels)?
+        """
+        warpKey = self._getManifestKey(tempExpRef.dataId)
+        calExpKeys = manifest.get("pending", {}).pop(warpKey, None)
+        if calExpKeys is None:
+            return
+        manifest["warps"][warpKey] = dict(calexps=calExpKeys, created=bool(created))
+        self.writeManifest(manifest)
+
+    def recordUnmadeWarpsInManifest(self, manifest, patchRef, calExpRefList):
+        """Record the warps none of whose calexps are left to warp as not created, and rewrite the manifest
+
+        These are the warps noted by removeCompletedWarps all of whose calexps were then found to be missing
+        or predicted not to cover the patch; recording them saves looking for their calexps again.
+
+        @param manifest: manifest of the patch, as returned by readManifest
+        @param patchRef: data reference for the patch
+        @param calExpRefList: List of data references for the calexps left to warp for the patch
+        """
+        pending = manifest.get("pending", {})
+        if not pending:
+            return
+        primaryWarpDataset = self.getPrimaryWarpDatasetName()
+        groupData = groupPatchExposures(patchRef, calExpRefList, self.getCoaddDatasetName(),
+                                        primaryWarpDataset)
+        remainingKeys = set(self._getManifestKey(getGroupDataRef(patchRef.getButler(), primaryWarpDataset,
+                                                                 tempExpTuple, groupData.keys).dataId)
+                            for tempExpTuple in groupData.groups)
+        unmadeKeys = [warpKey for warpKey in pending if warpKey not in remainingKeys]
+        if not unmadeKeys:
+            return
+        for warpKey in unmadeKeys:
+            manifest["warps"][warpKey] = dict(calexps=pending.pop(warpKey), created=False)
+        self.log.info("Recording %d warps with no calexps left to warp in manifest %s", len(unmadeKeys),
+                      manifest["filename"])
+        self.writeManifest(manifest)
+
+    def writeManifest(self, manifest):
+        """Write the manifest of the warps of a patch
+
+        @param manifest: manifest of the patch, as returned by readManifest
+        """
+        directory = os.path.dirname(manifest["filename"])
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write a new file and rename it, so that an interrupted run never leaves a truncated manifest
+        tempFilename = manifest["filename"] + ".tmp"
+        with open(tempFilename, "w") as manifestFile:
+            json.dump(dict(configKey=manifest["configKey"], warps=manifest["warps"]), manifestFile,
+                      sort_keys=True)
+        os.rename(tempFilename, manifest["filename"])
+
+    @staticmethod
+    def _getManifestKey(dataId):
+        """Return a string identifying a dataset in a manifest by its dataId
+        """
+        return json.dumps(sorted((str(k), str(v)) for k, v in dataId.items()))
+
     def createTempExp(self, calexpRefList, skyInfo, visitId=0):
         """Create a Warp from inputs
 
@@ -342,88 +686,384 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
                 "direct": direct warp if config.makeDirect
                 "psfMatched": PSF-matched warp if config.makePsfMatched
         """
-        warpTypeList = self.getWarpTypeList()
+        warpState = self._makeWarpState(skyInfo, visitId, len(calexpRefList))
 
-        totGoodPix = {warpType: 0 for warpType in warpTypeList}
-        didSetMetadata = {warpType: False for warpType in warpTypeList}
-        coaddTempExps = {warpType: self._prepareEmptyExposure(skyInfo) for warpType in warpTypeList}
-        inputRecorder = {warpType: self.inputRecorder.makeCoaddTempExpRecorder(visitId, len(calexpRefList))
-                         for warpType in warpTypeList}
+        for warped in self._iterWarpedCalExps(calexpRefList, skyInfo, [skyInfo.bbox]*len(calexpRefList)):
+            if warped is not None:
+                self._addWarpedCalExp(warpState, *warped)
 
-        modelPsf = self.config.modelPsf.apply() if self.config.makePsfMatched else None
-        for calExpInd, calExpRef in enumerate(calexpRefList):
-            self.log.info("Processing calexp %d of %d for this Warp: id=%s",
-                          calExpInd+1, len(calexpRefList), calExpRef.dataId)
-            try:
-                ccdId = calExpRef.get("ccdExposureId", immediate=True)
-            except Exception:
-                ccdId = calExpInd
+        result = pipeBase.Struct(exposures=self._finishWarps(warpState))
+        return result
+
+    def selectCoveringCalExps(self, calExpRefList, skyInfo, polygonCache=None):
+        """Select the calexps predicted to cover more than config.minPredictedCoverage of a patch
+
+        Calexps whose coverage cannot be predicted are kept.
+
+        @param calExpRefList: List of data references for calexps
+        @param skyInfo: Struct from CoaddBaseTask.getSkyInfo() for the patch
+        @param polygonCache: dict in which the polygons returned by getCalExpTractPolygon are kept, to be
+            reused for other patches of the tract; None for the process-wide cache (see
+            getCalExpPolygonCache)
+        @return list of the data references of the calexps selected
+        """
+        if polygonCache is None:
+            polygonCache = getCalExpPolygonCache()
+        patchPolygon = Polygon(afwGeom.Box2D(skyInfo.bbox))
+        grownBBox = afwGeom.Box2D(skyInfo.bbox)
+        grownBBox.grow(_COVERAGE_MARGIN)
+        grownPatchPolygon = Polygon(grownBBox)
+        tractId = skyInfo.tractInfo.getId()
+        selectedRefList = []
+        for calExpRef in calExpRefList:
+            # The polygon is in the pixels of the tract, and depends on which Wcs the calexp is warped with
+            calExpKey = (tuple(sorted(calExpRef.dataId.items())), tractId, self.config.doApplyUberCal)
             try:
-                # We augment the dataRef here with the tract, which is harmless for loading things
-                # like calexps that don't need the tract, and necessary for meas_mosaic outputs,
-                # which do.
-                calExpRef = calExpRef.butlerSubset.butler.dataRef("calexp", dataId=calExpRef.dataId,
-                                                                  tract=skyInfo.tractInfo.getId())
-                calExp = self.getCalExp(calExpRef, bgSubtracted=self.config.bgSubtracted)
+                tractPolygon = polygonCache.get(calExpKey)
+                if tractPolygon is None:
+                    tractPolygon = self.getCalExpTractPolygon(calExpRef, skyInfo)
+                    polygonCache[calExpKey] = tractPolygon
+                coverage = 0.0
+                if tractPolygon.overlaps(grownPatchPolygon):
+                    coverage = sum(polygon.calculateArea() for polygon in
+                                   tractPolygon.intersection(grownPatchPolygon))/patchPolygon.calculateArea()
             except Exception as e:
-                self.log.warn("Calexp %s not found; skipping it: %s", calExpRef.dataId, e)
+                self.log.warn("Cannot predict the coverage of calexp %s; keeping it: %s", calExpRef.dataId, e)
+                selectedRefList.append(calExpRef)
                 continue
-            try:
-                warpedAndMatched = self.warpAndPsfMatch.run(calExp, modelPsf=modelPsf,
-                                                            wcs=skyInfo.wcs, maxBBox=skyInfo.bbox,
-                                                            makeDirect=self.config.makeDirect,
-                                                            makePsfMatched=self.config.makePsfMatched)
-            except Exception as e:
-                self.log.warn("WarpAndPsfMatch failed for calexp %s; skipping it: %s", calExpRef.dataId, e)
+            if coverage > self.config.minPredictedCoverage:
+                selectedRefList.append(calExpRef)
+            else:
+                self.log.info("Skipping calexp %s: predicted to cover %.2f%% of the patch",
+                              calExpRef.dataId, 100.0*coverage)
+        return selectedRefList
+
+    def getCalExpTractPolygon(self, calExpRef, skyInfo):
+        """Map the valid region of a calexp onto the pixels of the tract without reading its pixels
+
+        The bounding box is read from the calexp header, the valid polygon, if any, from the exposure info
+        of a single-pixel subimage, and the Wcs with which the calexp will be warped from the calexp header
+        or, with config.doApplyUberCal, from the header of the meas_mosaic "wcs" dataset of the tract.
+        Points along the edges of the valid polygon (or else of the bounding box) are mapped onto the tract.
+        The result is kept by selectCoveringCalExps, so these are read once per calexp and tract.
+
+        @param calExpRef: data reference for the calexp
+        @param skyInfo: Struct from CoaddBaseTask.getSkyInfo() for the tract
+        @return Polygon of the valid region of the calexp in tract pixels
+        """
+        metadata = calExpRef.get("calexp_md", immediate=True)
+        calExpBBox = afwImage.bboxFromMetadata(metadata)
+        if self.config.doApplyUberCal:
+            calExpWcs = afwImage.makeWcs(calExpRef.get("wcs_md", immediate=True,
+                                                       tract=skyInfo.tractInfo.getId()))
+        else:
+            calExpWcs = afwImage.makeWcs(metadata)
+        pixelBBox = afwGeom.Box2I(calExpBBox.getMin(), afwGeom.Extent2I(1, 1))
+        validPolygon = calExpRef.get("calexp_sub", bbox=pixelBBox, immediate=True).getInfo().getValidPolygon()
+        if validPolygon is not None:
+            vertices = validPolygon.getVertices()
+        else:
+            vertices = afwGeom.Box2D(calExpBBox).getCorners()
+        tractPoints = []
+        for start, end in zip(vertices, vertices[1:] + vertices[:1]):
+            for frac in numpy.linspace(0.0, 1.0, _COVERAGE_EDGE_POINTS, endpoint=False):
+                calExpPoint = afwGeom.Point2D(start.getX() + frac*(end.getX() - start.getX()),
+                                              start.getY() + frac*(end.getY() - start.getY()))
+                tractPoints.append(skyInfo.wcs.skyToPixel(calExpWcs.pixelToSky(calExpPoint)))
+        return Polygon(tractPoints)
+
+    def _iterWarpedCalExps(self, calExpRefList, skyInfo, maxBBoxList, kernelCache=None, solveBBoxList=None):
+        """Read, warp and optionally PSF-match calexps, yielding them in order
+
+        The calexps are read by this process one at a time, as the butler and task metadata are not
+        thread-safe. With config.numWarpWorkers > 1 each calexp is then warped in a process forked once it
+        has been read, so that it is inherited rather than pickled, and up to config.numWarpWorkers calexps
+        are warped concurrently; the pixels of the warps are sent back to this process. This bounds the
+        memory held by calexps being warped and warps waiting to be yielded.
+
+        @param calExpRefList: List of data references for calexps
+        @param skyInfo: Struct from CoaddBaseTask.getSkyInfo() for the tract
+        @param maxBBoxList: maximum bounding box of the warp of each calexp
+        @param kernelCache: PsfMatchingKernelCache in which the PSF-matching kernels of the calexps with a
+            solve bounding box are looked up and kept; ignored with config.numWarpWorkers > 1
+        @param solveBBoxList: bounding box over which the PSF-matching kernel of each calexp is solved if it
+            is not cached, or None for a calexp whose kernel is not to be cached; ignored unless kernelCache
+        @return iterator over a tuple for each calexp of the data reference (augmented with the tract),
+            calexp, ID and Struct returned by warpAndPsfMatch.run, or None if the calexp could not be read
+            or warped
+        @throw RuntimeError if a worker process fails without reporting an error
+        """
+        modelPsf = self.config.modelPsf.apply() if self.config.makePsfMatched else None
+        numWorkers = min(self.config.numWarpWorkers, len(calExpRefList))
+
+        def readCalExp(calExpInd):
+            calExpRef = calExpRefList[calExpInd]
+            self.log.info("Processing calexp %d of %d for this Warp: id=%s",
+                          calExpInd+1, len(calExpRefList), calExpRef.dataId)
+            return self._readCalExp(calExpRef, skyInfo, calExpInd)
+
+        if numWorkers <= 1:
+            for calExpInd in range(len(calExpRefList)):
+                calExpData = readCalExp(calExpInd)
+                if calExpData is None:
+                    yield None
+                    continue
+                calExpRef, calExp, ccdId = calExpData
+                solveBBox = None
+                if kernelCache is not None and solveBBoxList is not None:
+                    solveBBox = solveBBoxList[calExpInd]
+                try:
+                    warpedAndMatched = self.warpAndPsfMatch.run(
+                        calExp, modelPsf=modelPsf, wcs=skyInfo.wcs, maxBBox=maxBBoxList[calExpInd],
+                        makeDirect=self.config.makeDirect, makePsfMatched=self.config.makePsfMatched,
+                        kernelCache=kernelCache if solveBBox is not None else None,
+                        cacheKey=tuple(sorted(calExpRef.dataId.items())), solveBBox=solveBBox)
+                except Exception as e:
+                    self.log.warn("WarpAndPsfMatch failed for calexp %s; skipping it: %s",
+                                  calExpRef.dataId, e)
+                    yield None
+                    continue
+                yield calExpRef, calExp, ccdId, warpedAndMatched
+            return
+
+        context = _getForkContext()
+        running = collections.deque()
+        try:
+            for calExpInd in range(len(calExpRefList)):
+                calExpData = readCalExp(calExpInd)
+                worker = None
+                if calExpData is not None:
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(target=self._warpCalExpInProcess,
+                                              args=(sender, calExpData[1], skyInfo.wcs, modelPsf,
+                                                    maxBBoxList[calExpInd]))
+                    process.start()
+                    sender.close()
+                    worker = (process, receiver)
+                running.append((calExpData, worker))
+                while len(running) >= numWorkers:
+                    yield self._collectWarpedCalExp(skyInfo.wcs, *running.popleft())
+            while running:
+                yield self._collectWarpedCalExp(skyInfo.wcs, *running.popleft())
+        finally:
+            for calExpData, worker in running:
+                if worker is not None:
+                    worker[0].terminate()
+                    worker[0].join()
+                    worker[1].close()
+
+    def _warpCalExpInProcess(self, sender, calExp, wcs, modelPsf, maxBBox):
+        """Warp and optionally PSF-match a calexp in a forked process, sending the warps back
+
+        @param sender: connection on which to send ("ok", dict of warp type: warp packed by
+            _packWarpedExposure) or ("error", message) if warpAndPsfMatch failed
+        @param calExp: the calexp; other parameters are as for warpAndPsfMatch.run
+        """
+        try:
+            warpedAndMatched = self.warpAndPsfMatch.run(calExp, modelPsf=modelPsf, wcs=wcs, maxBBox=maxBBox,
+                                                        makeDirect=self.config.makeDirect,
+                                                        makePsfMatched=self.config.makePsfMatched)
+            message = ("ok", {warpType: _packWarpedExposure(warpedAndMatched.getDict()[warpType],
+                                                            withPsf=(warpType != "direct"))
+                              for warpType in self.getWarpTypeList()})
+        except Exception as e:
+            message = ("error", str(e))
+        sender.send(message)
+        sender.close()
+
+    def _collectWarpedCalExp(self, wcs, calExpData, worker):
+        """Wait for a calexp warped by _warpCalExpInProcess and rebuild its warps
+
+        @param wcs: Wcs of the warps
+        @param calExpData: tuple returned by _readCalExp, or None if the calexp could not be read
+        @param worker: tuple of the worker process and the connection on which it sends the warps,
+            or None if the calexp could not be read
+        @return a tuple as yielded by _iterWarpedCalExps
+        @throw RuntimeError if the worker fails without reporting an error
+        """
+        if calExpData is None:
+            return None
+        calExpRef, calExp, ccdId = calExpData
+        process, receiver = worker
+        try:
+            status, result = receiver.recv()
+        except EOFError:
+            status, result = None, None
+        finally:
+            receiver.close()
+            process.join()
+        if status is None:
+            raise RuntimeError("Worker process warping calexp %s failed with exit code %s" %
+                               (calExpRef.dataId, process.exitcode))
+        if status != "ok":
+            self.log.warn("WarpAndPsfMatch failed for calexp %s; skipping it: %s", calExpRef.dataId, result)
+            return None
+        warps = {}
+        for warpType, packed in result.items():
+            if packed is None:
+                warps[warpType] = None
                 continue
-            try:
-                numGoodPix = {warpType: 0 for warpType in warpTypeList}
-                for warpType in warpTypeList:
-                    exposure = warpedAndMatched.getDict()[warpType]
-                    if exposure is None:
-                        continue
-                    coaddTempExp = coaddTempExps[warpType]
-                    if didSetMetadata[warpType]:
+            if warpType == "direct":
+                psf = WarpedPsf(calExp.getPsf(), afwImage.XYTransformFromWcsPair(wcs, calExp.getWcs()))
+            else:
+                psf = None
+            warps[warpType] = _unpackWarpedExposure(packed, calExp, wcs, psf)
+        return calExpRef, calExp, ccdId, pipeBase.Struct(direct=warps.get("direct"),
+                                                         psfMatched=warps.get("psfMatched"))
+
+    def _readCalExp(self, calExpRef, skyInfo, calExpInd):
+        """Read a calexp to warp
+
+        @param calExpRef: data reference for the calexp
+        @param skyInfo: Struct from CoaddBaseTask.getSkyInfo() for the tract
+        @param calExpInd: index of the calexp in its warp, used as its ID if it has no ccdExposureId
+        @return the data reference augmented with the tract, the calexp and its ID,
+            or None if the calexp cannot be read
+        """
+        try:
+            ccdId = calExpRef.get("ccdExposureId", immediate=True)
+        except Exception:
+            ccdId = calExpInd
+        try:
+            # We augment the dataRef here with the tract, which is harmless for loading things
+            # like calexps that don't need the tract, and necessary for meas_mosaic outputs,
+            # which do.
+            calExpRef = calExpRef.butlerSubset.butler.dataRef("calexp", dataId=calExpRef.dataId,
+                                                              tract=skyInfo.tractInfo.getId())
+            calExp = self.getCalExp(calExpRef, bgSubtracted=self.config.bgSubtracted)
+        except Exception as e:
+            self.log.warn("Cannot read calexp %s; skipping it: %s", calExpRef.dataId, e)
+            return None
+        return calExpRef, calExp, ccdId
+
+    def _makeWarpState(self, skyInfo, visitId, numCalExps):
+        """Make the empty warps of a patch and the state used to fill them with _addWarpedCalExp
+
+        @param skyInfo: Struct from CoaddBaseTask.getSkyInfo() for the patch
+        @param visitId: integer identifier for visit, for the table that will produce the CoaddPsf
+        @param numCalExps: number of calexps that may contribute to the warp
+        @return a pipeBase Struct to pass to _addWarpedCalExp and _finishWarps
+        """
+        warpTypeList = self.getWarpTypeList()
+        return pipeBase.Struct(
+            skyInfo=skyInfo,
+            warpTypeList=warpTypeList,
+            totGoodPix={warpType: 0 for warpType in warpTypeList},
+            didSetMetadata={warpType: False for warpType in warpTypeList},
+            coaddTempExps={warpType: self._prepareEmptyExposure(skyInfo) for warpType in warpTypeList},
+            inputRecorder={warpType: self.inputRecorder.makeCoaddTempExpRecorder(visitId, numCalExps)
+                           for warpType in warpTypeList},
+        )
+
+    def _addWarpedCalExp(self, warpState, calExpRef, calExp, ccdId, warpedAndMatched, inPlace=True):
+        """Copy the good pixels of a warped calexp into the warps of a patch
+
+        The first calexp with good pixels in the patch sets the Calib of the warp; the pixels of later
+        calexps are scaled to it.
+
+        @param warpState: Struct returned by _makeWarpState for the patch
+        @param calExpRef: data reference for the calexp
+        @param calExp: the calexp
+        @param ccdId: ID of the calexp
+        @param warpedAndMatched: Struct returned by warpAndPsfMatch.run for the calexp
+        @param inPlace: may the warped exposures be scaled in place? Must be False if they are also copied
+            into the warps of other patches.
+        """
+        skyInfo = warpState.skyInfo
+        try:
+            numGoodPix = {warpType: 0 for warpType in warpState.warpTypeList}
+            for warpType in warpState.warpTypeList:
+                exposure = warpedAndMatched.getDict()[warpType]
+                if exposure is None:
+                    continue
+                coaddTempExp = warpState.coaddTempExps[warpType]
+                if warpState.didSetMetadata[warpType]:
+                    if not inPlace:
+                        overlapBBox = exposure.getBBox()
+                        overlapBBox.clip(skyInfo.bbox)
+                        if overlapBBox.isEmpty():
+                            exposure = None
+                        else:
+                            exposure = exposure.Factory(exposure, overlapBBox, afwImage.PARENT, True)
+                    if exposure is not None:
                         mimg = exposure.getMaskedImage()
                         mimg *= (coaddTempExp.getCalib().getFluxMag0()[0] /
                                  exposure.getCalib().getFluxMag0()[0])
                         del mimg
+                if exposure is not None:
                     numGoodPix[warpType] = coaddUtils.copyGoodPixels(
                         coaddTempExp.getMaskedImage(), exposure.getMaskedImage(), self.getBadPixelMask())
-                    totGoodPix[warpType] += numGoodPix[warpType]
-                    self.log.debug("Calexp %s has %d good pixels in this patch (%.1f%%) for %s",
-                                   calExpRef.dataId, numGoodPix[warpType],
-                                   100.0*numGoodPix[warpType]/skyInfo.bbox.getArea(), warpType)
-                    if numGoodPix[warpType] > 0 and not didSetMetadata[warpType]:
-                        coaddTempExp.setCalib(exposure.getCalib())
-                        coaddTempExp.setFilter(exposure.getFilter())
-                        # PSF replaced with CoaddPsf after loop if and only if creating direct warp
-                        coaddTempExp.setPsf(exposure.getPsf())
-                        didSetMetadata[warpType] = True
-
-                    # Need inputRecorder for CoaddApCorrMap for both direct and PSF-matched
-                    inputRecorder[warpType].addCalExp(calExp, ccdId, numGoodPix[warpType])
-
-            except Exception as e:
-                self.log.warn("Error processing calexp %s; skipping it: %s", calExpRef.dataId, e)
-                continue
-
-        for warpType in warpTypeList:
+                warpState.totGoodPix[warpType] += numGoodPix[warpType]
+                self.log.debug("Calexp %s has %d good pixels in this patch (%.1f%%) for %s",
+                               calExpRef.dataId, numGoodPix[warpType],
+                               100.0*numGoodPix[warpType]/skyInfo.bbox.getArea(), warpType)
+                if numGoodPix[warpType] > 0 and not warpState.didSetMetadata[warpType]:
+                    coaddTempExp.setCalib(exposure.getCalib())
+                    coaddTempExp.setFilter(exposure.getFilter())
+                    # PSF replaced with CoaddPsf after loop if and only if creating direct warp
+                    coaddTempExp.setPsf(exposure.getPsf())
+                    warpState.didSetMetadata[warpType] = True
+
+                # Need inputRecorder for CoaddApCorrMap for both direct and PSF-matched
+                warpState.inputRecorder[warpType].addCalExp(calExp, ccdId, numGoodPix[warpType])
+
+        except Exception as e:
+            self.log.warn("Error processing calexp %s; skipping it: %s", calExpRef.dataId, e)
+
+    def _finishWarps(self, warpState):
+        """Finish the warps of a patch once all calexps have been added
+
+        @param warpState: Struct returned by _makeWarpState for the patch
+        @return a dictionary of warp type: warp, or None if the warp has no good pixels
+        """
+        skyInfo = warpState.skyInfo
+        coaddTempExps = warpState.coaddTempExps
+        for warpType in warpState.warpTypeList:
+            totGoodPix = warpState.totGoodPix[warpType]
             self.log.info("%sWarp has %d good pixels (%.1f%%)",
-                          warpType, totGoodPix[warpType], 100.0*totGoodPix[warpType]/skyInfo.bbox.getArea())
+                          warpType, totGoodPix, 100.0*totGoodPix/skyInfo.bbox.getArea())
 
-            if totGoodPix[warpType] > 0 and didSetMetadata[warpType]:
-                inputRecorder[warpType].finish(coaddTempExps[warpType], totGoodPix[warpType])
+            if totGoodPix > 0 and warpState.didSetMetadata[warpType]:
+                inputRecorder = warpState.inputRecorder[warpType]
+                inputRecorder.finish(coaddTempExps[warpType], totGoodPix)
                 if warpType == "direct":
                     coaddTempExps[warpType].setPsf(
-                        CoaddPsf(inputRecorder[warpType].coaddInputs.ccds, skyInfo.wcs,
+                        CoaddPsf(inputRecorder.coaddInputs.ccds, skyInfo.wcs,
                                  self.config.coaddPsf.makeControl()))
+                if self.config.doWeightStats:
+                    self.measureWeightStats(coaddTempExps[warpType])
             else:
                 # No good pixels. Exposure still empty
                 coaddTempExps[warpType] = None
+        return coaddTempExps
 
-        result = pipeBase.Struct(exposures=coaddTempExps)
-        return result
+    def measureWeightStats(self, exposure):
+        """Measure the clipped mean variance of a warp and record it in the warp metadata
+
+        The variance is measured before any photometric scaling, so that assembleCoadd can apply its own
+        zero point: with a scalar scale factor s, the clipped mean of the scaled variance is s**2 times
+        the clipped mean recorded here. The clipping parameters and ignored mask planes are recorded as
+        well, so that assembleCoadd uses the measurement only if it would have measured it the same way.
+
+        @param[in,out] exposure: warp whose metadata is to be updated
+        """
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setNumSigmaClip(self.config.weightSigmaClip)
+        statsCtrl.setNumIter(self.config.weightClipIter)
+        statsCtrl.setAndMask(afwImage.Mask.getPlaneBitMask(self.config.weightBadMaskPlanes))
+        statsCtrl.setNanSafe(True)
+        maskedImage = exposure.getMaskedImage()
+        statObj = afwMath.makeStatistics(maskedImage.getVariance(), maskedImage.getMask(),
+                                         afwMath.MEANCLIP, statsCtrl)
+        meanVar, meanVarErr = statObj.getResult(afwMath.MEANCLIP)
+        if not numpy.isfinite(meanVar):
+            self.log.warn("Non-finite clipped mean variance for warp; not recording it")
+            return
+        metadata = exposure.getMetadata()
+        metadata.set(WARP_WEIGHT_KEYS.meanVar, float(meanVar))
+        metadata.set(WARP_WEIGHT_KEYS.sigmaClip, float(self.config.weightSigmaClip))
+        metadata.set(WARP_WEIGHT_KEYS.clipIter, int(self.config.weightClipIter))
+        metadata.set(WARP_WEIGHT_KEYS.badMaskPlanes, ",".join(sorted(self.config.weightBadMaskPlanes)))
 
     def _prepareEmptyExposure(cls, skyInfo):
         """Produce an empty exposure for a given patch"""
@@ -432,6 +1072,15 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
                                  .getPlaneBitMask("NO_DATA"), numpy.inf)
         return exp
 
+    def getPrimaryWarpDatasetName(self):
+        """Return the name of the warp dataset whose data references are returned by run
+
+        This is *_directWarp unless only *_psfMatchedWarp is requested.
+        """
+        if self.config.makePsfMatched and not self.config.makeDirect:
+            return self.getTempExpDatasetName("psfMatched")
+        return self.getTempExpDatasetName("direct")
+
     def getWarpTypeList(self):
         """Return list of requested warp types per the config.
         """
@@ -441,3 +1090,320 @@ class MakeCoaddTempExpTask(CoaddBaseTask):
         if self.config.makePsfMatched:
             warpTypeList.append("psfMatched")
         return warpTypeList
+
+
+class MakeTractCoaddTempExpConfig(MakeCoaddTempExpConfig):
+    """Config for MakeTractCoaddTempExpTask
+    """
+    maxPatchesPerBatch = pexConfig.RangeField(
+        doc="Maximum number of patches whose warps of a visit are made at once. Each calexp is read and "
+        "warped once for each batch of patches it overlaps, and the warps of a batch are held in memory "
+        "until all its calexps are warped: 10 bytes per pixel of the outer bounding box of each patch for "
+        "each warp type (about 180 MB for a 4200x4200 patch, so 700 MB per warp type at the default), plus "
+        "the calexps warped over the union of the patches of the batch.",
+        dtype=int,
+        default=4,
+        min=1,
+    )
+    doCacheKernels = pexConfig.Field(
+        doc="Solve the PSF-matching kernel of a calexp that overlaps several batches of patches once for "
+        "the visit, over the union of the patches it overlaps, and reuse it for each of its batches? The "
+        "PSF-matched warps of such calexps then do not depend on maxPatchesPerBatch, but differ slightly "
+        "from those made without caching. Ignored if numWarpWorkers > 1, as the workers cannot share "
+        "kernels.",
+        dtype=bool,
+        default=False,
+    )
+
+
+class MakeTractCoaddTempExpRunner(CoaddTaskRunner):
+    """Task runner for MakeTractCoaddTempExpTask, which is run on the list of patch references of each tract
+    """
+
+    @staticmethod
+    def getTargetList(parsedCmd, **kwargs):
+        """Provide a list of patch references for each tract and filter
+
+        @param parsedCmd: the parsed command
+        @param **kwargs: key word arguments passed to the task's run method
+        """
+        refList = {}
+        for ref in parsedCmd.id.refList:
+            tractKey = tuple(sorted((key, value) for key, value in ref.dataId.items() if key != "patch"))
+            refList.setdefault(tractKey, []).append(ref)
+        return [(patchRefList, dict(selectDataList=parsedCmd.selectId.dataList, **kwargs))
+                for patchRefList in refList.values()]
+
+
+class MakeTractCoaddTempExpTask(MakeCoaddTempExpTask):
+    """!Make the warps of many patches of a tract, reading and warping each calexp once
+
+    MakeCoaddTempExpTask reads, calibrates and warps a calexp once for every patch it overlaps. This task
+    makes the warps of a visit for a batch of patches (of up to config.maxPatchesPerBatch) together: each
+    calexp is read once and warped once onto the tract Wcs over the union of the outer bounding boxes of
+    the patches of the batch that it overlaps, and its good pixels are copied into the warp of each of
+    those patches as MakeCoaddTempExpTask would.
+
+    Warping is done pixel by pixel, so direct warps are the same as those of MakeCoaddTempExpTask, up to the
+    interpolation of the Wcs over a grid anchored to the warped bounding box (exactly the same with
+    warpAndPsfMatch.warp.interpLength = 0).
+    PSF-matched warps are not exactly the same: the PSF-matching kernel is solved over the cells of the
+    larger warped calexp. With config.doCacheKernels, the kernel of a calexp that overlaps several batches
+    is solved once, over all the patches of the visit it overlaps, and kept for the visit.
+    """
+    ConfigClass = MakeTractCoaddTempExpConfig
+    RunnerClass = MakeTractCoaddTempExpRunner
+    _DefaultName = "makeTractCoaddTempExp"
+
+    @pipeBase.timeMethod
+    def run(self, patchRefList, selectDataList=[]):
+        """!Produce <coaddName>Coadd_<warpType>Warp images of a list of patches of one tract
+
+        @param[in] patchRefList: data references for sky map patches of one tract and filter
+        @param[in] selectDataList: list of SelectStruct of the calexps to consider
+        @return: dataRefList: a list of data references for the new primary warps (see
+            getPrimaryWarpDatasetName) of all patches
+        """
+        primaryWarpDataset = self.getPrimaryWarpDatasetName()
+        dataRefList = []
+        calExpExists = {}
+        visitPatchInputs = {}  # Will index this as visitPatchInputs[visit key] = list of patch inputs
+        for patchRef in patchRefList:
+            skyInfo = self.getSkyInfo(patchRef)
+            calExpRefList = self.selectExposures(patchRef, skyInfo, selectDataList=selectDataList)
+            manifest = None
+            if self.config.doUseManifest:
+                manifest = self.readManifest(patchRef)
+                calExpRefList = self.removeCompletedWarps(manifest, patchRef, calExpRefList, dataRefList)
+            if self.config.doCacheExistence:
+                existingRefList = self.selectExistingCalExps(calExpRefList)
+            else:
+                existingRefList = []
+                for calExpRef in calExpRefList:
+                    calExpKey = tuple(sorted(calExpRef.dataId.items()))
+                    if calExpKey not in calExpExists:
+                        calExpExists[calExpKey] = calExpRef.datasetExists("calexp")
+                    if calExpExists[calExpKey]:
+                        existingRefList.append(calExpRef)
+            if self.config.doPredictCoverage:
+                existingRefList = self.selectCoveringCalExps(existingRefList, skyInfo)
+            if manifest is not None:
+                self.recordUnmadeWarpsInManifest(manifest, patchRef, existingRefList)
+            self.log.info("Selected %d existing calexps for patch %s", len(existingRefList), patchRef.dataId)
+            if len(existingRefList) == 0:
+                continue
+
+            groupData = groupPatchExposures(patchRef, existingRefList, self.getCoaddDatasetName(),
+                                            primaryWarpDataset)
+            tempExpRefList = [getGroupDataRef(patchRef.getButler(), primaryWarpDataset, tempExpTuple,
+                                              groupData.keys) for tempExpTuple in groupData.groups]
+            self.prefetchWarpExistence(tempExpRefList, primaryWarpDataset)
+            groupList = zip(tempExpRefList, groupData.groups.items())
+            for i, (tempExpRef, (tempExpTuple, calexpRefList)) in enumerate(groupList):
+                if not self.config.doOverwrite and self.warpExists(tempExpRef, primaryWarpDataset):
+                    self.log.info("Warp %s exists; skipping", tempExpRef.dataId)
+                    dataRefList.append(tempExpRef)
+                    if manifest is not None:
+                        self.recordWarpInManifest(manifest, tempExpRef, True)
+                    continue
+                try:
+                    visitId = int(tempExpRef.dataId["visit"])
+                except (KeyError, ValueError):
+                    visitId = i
+                visitKey = tuple((key, value) for key, value in zip(groupData.keys, tempExpTuple)
+                                 if key not in patchRef.dataId)
+                visitPatchInputs.setdefault(visitKey, []).append(pipeBase.Struct(
+                    tempExpRef=tempExpRef,
+                    skyInfo=skyInfo,
+                    calExpRefList=calexpRefList,
+                    visitId=visitId,
+                    manifest=manifest,
+                ))
+
+        for i, (visitKey, patchInputList) in enumerate(visitPatchInputs.items()):
+            self.log.info("Processing visit %d/%d: %s, overlapping %d patches", i + 1, len(visitPatchInputs),
+                          dict(visitKey), len(patchInputList))
+            # Batch neighbouring patches together, so that few calexps overlap several batches
+            patchInputList.sort(key=lambda patchInput: patchInput.skyInfo.patchInfo.getIndex()[::-1])
+            batchSize = self.config.maxPatchesPerBatch
+            batchList = [patchInputList[start:start + batchSize]
+                         for start in range(0, len(patchInputList), batchSize)]
+            kernelCache = None
+            solveBBoxes = None
+            if self.config.doCacheKernels and self.config.makePsfMatched and self.config.numWarpWorkers == 1:
+                solveBBoxes = self.getSharedCalExpBBoxes(batchList)
+                if solveBBoxes:
+                    kernelCache = PsfMatchingKernelCache(len(solveBBoxes))
+            for batch in batchList:
+                dataRefList += self.makeBatchTempExps(batch, kernelCache=kernelCache, solveBBoxes=solveBBoxes)
+
+        return dataRefList
+
+    def getSharedCalExpBBoxes(self, batchList):
+        """Find the calexps of a visit that overlap more than one batch of patches
+
+        @param batchList: list of the batches of patches of a visit, each a list of Structs as passed to
+            makeBatchTempExps
+        @return dict of calexp key: union of the bounding boxes of all the patches the calexp overlaps,
+            for each calexp that overlaps more than one batch
+        """
+        calExpBatches = {}
+        calExpBBoxes = {}
+        for batchIndex, batch in enumerate(batchList):
+            for patchInput in batch:
+                for calExpRef in patchInput.calExpRefList:
+                    calExpKey = tuple(sorted(calExpRef.dataId.items()))
+                    calExpBatches.setdefault(calExpKey, set()).add(batchIndex)
+                    calExpBBoxes.setdefault(calExpKey, afwGeom.Box2I()).include(patchInput.skyInfo.bbox)
+        return {calExpKey: calExpBBoxes[calExpKey] for calExpKey, batches in calExpBatches.items()
+                if len(batches) > 1}
+
+    def makeBatchTempExps(self, patchInputList, kernelCache=None, solveBBoxes=None):
+        """Make and write the warps of one visit for a batch of patches
+
+        @param patchInputList: list of Structs for each patch, with:
+            - tempExpRef: data reference for the warp of the patch
+            - skyInfo: Struct from CoaddBaseTask.getSkyInfo() for the patch
+            - calExpRefList: List of data references for calexps that (may) overlap the patch
+            - visitId: integer identifier for the visit
+            - manifest: manifest of the patch (see readManifest), or None
+        @param kernelCache: PsfMatchingKernelCache in which to keep the PSF-matching kernels of the calexps
+            in solveBBoxes for other batches, or None
+        @param solveBBoxes: dict of calexp key: bounding box over which the PSF-matching kernel of the
+            calexp is solved, for the calexps whose kernels are cached (see getSharedCalExpBBoxes), or None
+        @return a list of data references for the warps made
+        """
+        warpStateList = [self._makeWarpState(patchInput.skyInfo, patchInput.visitId,
+                                             len(patchInput.calExpRefList)) for patchInput in patchInputList]
+        # Keep the calexps in the order in which each patch lists them, so the same calexp wins where
+        # calexps overlap, and find the patches each calexp overlaps
+        calExpList = []
+        calExpIndex = {}
+        for patchIndex, patchInput in enumerate(patchInputList):
+            for calExpRef in patchInput.calExpRefList:
+                calExpKey = tuple(sorted(calExpRef.dataId.items()))
+                if calExpKey not in calExpIndex:
+                    calExpIndex[calExpKey] = len(calExpList)
+                    calExpList.append((calExpRef, []))
+                calExpList[calExpIndex[calExpKey]][1].append(patchIndex)
+
+        maxBBoxList = []
+        solveBBoxList = []
+        for calExpRef, patchIndexList in calExpList:
+            unionBBox = afwGeom.Box2I()
+            for patchIndex in patchIndexList:
+                unionBBox.include(patchInputList[patchIndex].skyInfo.bbox)
+            maxBBoxList.append(unionBBox)
+            if solveBBoxes is not None:
+                solveBBoxList.append(solveBBoxes.get(tuple(sorted(calExpRef.dataId.items()))))
+
+        warpedIter = self._iterWarpedCalExps([calExpRef for calExpRef, patchIndexList in calExpList],
+                                             patchInputList[0].skyInfo, maxBBoxList, kernelCache=kernelCache,
+                                             solveBBoxList=solveBBoxList if solveBBoxes is not None else None)
+        for (calExpRef, patchIndexList), warped in zip(calExpList, warpedIter):
+            if warped is None:
+                continue
+            for patchIndex in patchIndexList:
+                self._addWarpedCalExp(warpStateList[patchIndex], *warped, inPlace=len(patchIndexList) == 1)
+            del warped
+
+        dataRefList = []
+        for patchInput, warpState in zip(patchInputList, warpStateList):
+            tempExpRef = patchInput.tempExpRef
+            exps = self._finishWarps(warpState)
+            if any(exps.values()):
+                dataRefList.append(tempExpRef)
+            else:
+                self.log.warn("Warp %s could not be created", tempExpRef.dataId)
+
+            if self.config.doWrite:
+                self.writeWarps(tempExpRef, exps)
+                if patchInput.manifest is not None:
+                    self.recordWarpInManifest(patchInput.manifest, tempExpRef, any(exps.values()))
+        return dataRefList
+
+    def _getConfigName(self):
+        """Do not persist the configuration: there is no dataset for it
+        """
+        return None
+
+    def _getMetadataName(self):
+        return None
+
+    def writeMetadata(self, dataRefList):
+        """No metadata to write for a list of dataRefs
+        """
+        pass
+
+
+def _getForkContext():
+    """Return a multiprocessing context that forks its processes
+    """
+    try:
+        return multiprocessing.get_context("fork")
+    except AttributeError:  # Python 2 always forks
+        return multiprocessing
+
+
+def _packWarpedExposure(exposure, withPsf=False):
+    """Return the bounding box, pixels and optionally PSF kernel image of a warped calexp, to be sent to
+    another process and rebuilt by _unpackWarpedExposure
+
+    The PSF of a PSF-matched warp is the spatially invariant model PSF, so it is fully described by its
+    kernel image.
+
+    @param exposure: warped calexp, or None
+    @param withPsf: include the kernel image of the PSF?
+    @return tuple of the minimum and dimensions of the bounding box, the image, mask and variance arrays and
+        the kernel image array of the PSF (None unless withPsf), or None
+    """
+    if exposure is None:
+        return None
+    bbox = exposure.getBBox()
+    maskedImage = exposure.getMaskedImage()
+    psfArr = exposure.getPsf().computeKernelImage().getArray() if withPsf else None
+    return ((bbox.getMinX(), bbox.getMinY()), (bbox.getWidth(), bbox.getHeight()),
+            maskedImage.getImage().getArray(),
+            maskedImage.getMask().getArray(), maskedImage.getVariance().getArray(), psfArr)
+
+
+def _unpackWarpedExposure(packed, calExp, wcs, psf=None):
+    """Rebuild a warped calexp packed by _packWarpedExposure
+
+    @param packed: tuple returned by _packWarpedExposure
+    @param calExp: the calexp that was warped, from which the Calib, Filter and VisitInfo are copied
+    @param wcs: Wcs of the warp
+    @param psf: PSF of the warp; if None, a KernelPsf of the packed kernel image
+    @return the warped calexp
+    """
+    xy0, dimensions, imageArr, maskArr, varianceArr, psfArr = packed
+    exposure = afwImage.ExposureF(afwGeom.Box2I(afwGeom.Point2I(*xy0), afwGeom.Extent2I(*dimensions)), wcs)
+    maskedImage = exposure.getMaskedImage()
+    maskedImage.getImage().getArray()[:] = imageArr
+    maskedImage.getMask().getArray()[:] = maskArr
+    maskedImage.getVariance().getArray()[:] = varianceArr
+    exposure.setCalib(calExp.getCalib())
+    exposure.setFilter(calExp.getFilter())
+    exposure.getInfo().setVisitInfo(calExp.getInfo().getVisitInfo())
+    if psf is None:
+        psfImage = afwImage.ImageD(psfArr.astype(numpy.float64))
+        psf = KernelPsf(afwMath.FixedKernel(psfImage))
+    exposure.setPsf(psf)
+    return exposure
+
+
+# Polygons of calexps in the pixels of a tract, mapped by MakeCoaddTempExpTask.getCalExpTractPolygon;
+# see getCalExpPolygonCache
+_calExpPolygonCache = None
+
+
+def getCalExpPolygonCache():
+    """Return the process-wide dict of calexp key: polygon of the calexp in the pixels of a tract
+
+    The same calexp is selected for every patch it overlaps, and warp tasks are constructed afresh for
+    each patch; with this cache its header is read and mapped onto the tract once.
+    """
+    global _calExpPolygonCache
+    if _calExpPolygonCache is None:
+        _calExpPolygonCache = {}
+    return _calExpPolygonCache
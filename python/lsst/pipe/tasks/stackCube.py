@@ -0,0 +1,186 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import range
+
+import numpy
+
+__all__ = ["stackCube", "CUBE_STATISTICS"]
+
+# Statistics implemented by stackCube
+CUBE_STATISTICS = ("MEAN", "MEANCLIP", "MEDIAN")
+
+# Ratio of the standard deviation to the interquartile range of a Gaussian, as used by afw.math.Statistics
+IQ_TO_STDEV = 0.741301109
+
+# Cube temporaries are kept in single precision; the reductions are done in double precision
+_ZERO = numpy.float32(0.0)
+
+
+def _weightedMean(weights, keep, values, variances, work):
+    """Return the weighted mean of the kept values and its variance from the input variances
+
+    @param[in] weights: 1-d array of the weight of each plane of the cube
+    @param[in] keep: boolean cube of the values to use
+    @param[in] values: cube of values
+    @param[in] variances: cube of variances
+    @param[out] work: float32 cube in which to select the kept values and variances
+    @return weighted mean, variance of the weighted mean, and sum of weights, as 2-d float64 arrays
+    """
+    weightSum = numpy.einsum("i,ijk->jk", weights, keep)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        _selectInto(work, values, keep)
+        mean = numpy.einsum("i,ijk->jk", weights, work)/weightSum
+        _selectInto(work, variances, keep)
+        variance = numpy.einsum("i,ijk->jk", weights**2, work)/weightSum**2
+    return mean, variance, weightSum
+
+
+def _selectInto(out, values, keep, fill=_ZERO):
+    """Copy the kept values into out, and fill elsewhere, without allocating a cube
+    """
+    numpy.copyto(out, fill)
+    numpy.copyto(out, values, where=keep)
+    return out
+
+
+def _sortedQuantile(sortedValues, count, quantile):
+    """Return a quantile of the first values of each pixel of a cube sorted along its first axis
+
+    The quantile is interpolated linearly between values, as by numpy.percentile.
+
+    @param[in] sortedValues: cube sorted along its first axis
+    @param[in] count: 2-d array of the number of values of each pixel to use
+    @param[in] quantile: quantile to compute, between 0 and 1
+    @return 2-d float64 array of the quantile, NaN where count is 0
+    """
+    position = quantile*(count - 1.0)
+    lower = numpy.clip(numpy.floor(position).astype(int), 0, None)
+    upper = numpy.clip(numpy.minimum(lower + 1, count - 1), 0, None)
+    rows, cols = numpy.ogrid[:count.shape[0], :count.shape[1]]
+    lowerValues = sortedValues[lower, rows, cols].astype(numpy.float64)
+    upperValues = sortedValues[upper, rows, cols].astype(numpy.float64)
+    result = lowerValues + (position - lower)*(upperValues - lowerValues)
+    result[count == 0] = numpy.nan
+    return result
+
+
+def stackCube(imageCube, maskCube, varianceCube, weights, statistic, andMask, numSigmaClip=3.0, numIter=2,
+              maskPropagationThresholds=None, totalWeight=None, noGoodPixelsMask=0):
+    """Stack a cube of warp subregions with vectorized reductions, as afw.math.statisticsStack would
+
+    Pixels with any bit of andMask set, or with a non-finite value, are not used. With the statistics
+    control used for coadds (weighted, NaN-safe, errors computed from the input variance):
+    - MEAN is the weighted mean, and its variance sum(w**2*var)/sum(w)**2;
+    - MEANCLIP starts from the median and clips at numSigmaClip times the interquartile-range sigma, then
+      iterates numIter times on the weighted mean and standard deviation of the values kept, and has the
+      variance of the weighted mean of the values kept last;
+    - MEDIAN is the (unweighted) median, with pi/2 times the variance of the weighted mean.
+    The mask is the OR of the masks of the pixels used, plus each mask bit of maskPropagationThresholds
+    for which the weight of the unused pixels with that bit set exceeds the threshold times the total
+    weight. Pixels with no usable values are NaN with mask noGoodPixelsMask.
+
+    The cubes are not modified.
+
+    @param[in] imageCube: (nInputs, height, width) array of the image pixels
+    @param[in] maskCube: (nInputs, height, width) array of the mask pixels
+    @param[in] varianceCube: (nInputs, height, width) array of the variance pixels
+    @param[in] weights: sequence of the weight of each input
+    @param[in] statistic: one of CUBE_STATISTICS
+    @param[in] andMask: mask bits of pixels not to use
+    @param[in] numSigmaClip: number of sigma at which to clip, for MEANCLIP
+    @param[in] numIter: number of clipping iterations, for MEANCLIP
+    @param[in] maskPropagationThresholds: dict of mask bit: threshold, or None
+    @param[in] totalWeight: total weight for the mask propagation thresholds; defaults to sum(weights)
+    @param[in] noGoodPixelsMask: mask bits to set in pixels with no usable values
+    @return image (float32), mask (of the dtype of maskCube) and variance (float32) 2-d arrays
+    """
+    if statistic not in CUBE_STATISTICS:
+        raise ValueError("Statistic %s is not one of %s" % (statistic, CUBE_STATISTICS))
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    if totalWeight is None:
+        totalWeight = weights.sum()
+    good = numpy.empty(imageCube.shape, dtype=bool)
+    for goodPlane, imagePlane, maskPlane in zip(good, imageCube, maskCube):
+        numpy.equal(maskPlane & andMask, 0, out=goodPlane)
+        goodPlane &= numpy.isfinite(imagePlane)
+    # Work buffers, reused for every selection so that no further cube is allocated
+    work = numpy.empty(imageCube.shape, dtype=numpy.float32)
+
+    if statistic == "MEAN":
+        image, variance, weightSum = _weightedMean(weights, good, imageCube, varianceCube, work)
+    else:
+        # Sort the good values of each pixel in place, ahead of the unused (NaN) ones, rather than
+        # calling numpy.nanmedian, which makes several copies of the cube
+        values = _selectInto(work, imageCube, good, fill=numpy.float32(numpy.nan))
+        values.sort(axis=0)
+        numGood = good.sum(axis=0)
+        median = _sortedQuantile(values, numGood, 0.5)
+        if statistic == "MEANCLIP":
+            q1 = _sortedQuantile(values, numGood, 0.25)
+            q3 = _sortedQuantile(values, numGood, 0.75)
+        del values
+        if statistic == "MEDIAN":
+            image = median
+            variance, weightSum = _weightedMean(weights, good, imageCube, varianceCube, work)[1:]
+            variance *= numpy.pi/2
+        else:
+            center = median
+            halfWidth = numSigmaClip*IQ_TO_STDEV*(q3 - q1)
+            keep = numpy.empty(imageCube.shape, dtype=bool)
+            for i in range(numIter):
+                with numpy.errstate(invalid="ignore"):
+                    # keep = good & (|value - center| <= halfWidth), in the work buffers
+                    numpy.subtract(imageCube, center, out=work, casting="same_kind")
+                    numpy.absolute(work, out=work)
+                    numpy.less_equal(work, halfWidth, out=keep)
+                    keep &= good
+                image, variance, weightSum = _weightedMean(weights, keep, imageCube, varianceCube, work)
+                numKept = keep.sum(axis=0)
+                with numpy.errstate(invalid="ignore", divide="ignore"):
+                    work.fill(_ZERO)
+                    numpy.subtract(imageCube, image.astype(numpy.float32), out=work, where=keep)
+                    numpy.multiply(work, work, out=work)
+                    spread = numpy.einsum("i,ijk->jk", weights, work)/weightSum
+                    spread *= numKept/(numKept - 1.0)
+                center = image
+                # Keep the previous width where there are too few values to measure a spread
+                halfWidth = numpy.where(numKept > 1, numSigmaClip*numpy.sqrt(spread), halfWidth)
+            del keep
+    del work
+
+    # The mask and the rejected weights are accumulated one input at a time, to allocate no cube
+    mask = numpy.zeros(imageCube.shape[1:], dtype=maskCube.dtype)
+    for goodPlane, maskPlane in zip(good, maskCube):
+        mask |= numpy.where(goodPlane, maskPlane, 0).astype(maskCube.dtype)
+    if maskPropagationThresholds:
+        for bit, threshold in maskPropagationThresholds.items():
+            rejectedWeight = numpy.zeros(imageCube.shape[1:], dtype=numpy.float64)
+            for weight, goodPlane, maskPlane in zip(weights, good, maskCube):
+                rejectedWeight[~goodPlane & ((maskPlane & bit) != 0)] += weight
+            mask[rejectedWeight > threshold*totalWeight] |= bit
+
+    noData = ~(weightSum > 0)
+    image = numpy.where(noData, numpy.nan, image).astype(numpy.float32)
+    variance = numpy.where(noData, numpy.nan, variance).astype(numpy.float32)
+    mask[noData] = noGoodPixelsMask
+    return image, mask, variance
@@ -20,6 +20,11 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 from __future__ import absolute_import, division, print_function
+from builtins import object
+import collections
+import hashlib
+import threading
+
 import lsst.pex.config as pexConfig
 import lsst.afw.math as afwMath
 import lsst.afw.image as afwImage
@@ -28,7 +33,48 @@ import lsst.pipe.base as pipeBase
 from lsst.ip.diffim import ModelPsfMatchTask
 from lsst.meas.algorithms import WarpedPsf
 
-__all__ = ["WarpAndPsfMatchTask"]
+__all__ = ["WarpAndPsfMatchTask", "PsfMatchingKernelCache"]
+
+
+class PsfMatchingKernelCache(object):
+    """A least-recently-used cache of PSF-matching kernels
+
+    Entries are Structs with the spatially-varying matching kernel (psfMatchingKernel) and the model PSF
+    it matches to (referencePsfModel), as returned by ModelPsfMatchTask.run. The caller decides which
+    exposures are worth caching, and how long to keep the cache; see MakeTractCoaddTempExpTask.
+    """
+
+    def __init__(self, maxSize):
+        """Construct an empty cache holding up to maxSize kernels
+        """
+        self.maxSize = maxSize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached entry for key, or None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        """Cache an entry, dropping the least recently used entries beyond maxSize
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
 
 
 class WarpAndPsfMatchConfig(pexConfig.Config):
@@ -55,7 +101,7 @@ class WarpAndPsfMatchTask(pipeBase.Task):
         self.warper = afwMath.Warper.fromConfig(self.config.warp)
 
     def run(self, exposure, wcs, modelPsf=None, maxBBox=None, destBBox=None,
-            makeDirect=True, makePsfMatched=False):
+            makeDirect=True, makePsfMatched=False, kernelCache=None, cacheKey=None, solveBBox=None):
         """Warp and optionally PSF-match exposure
 
         Parameters
@@ -78,6 +124,17 @@ class WarpAndPsfMatchTask(pipeBase.Task):
             Return an exposure that has been only warped?
         makePsfMatched : bool
             Return an exposure that has been warped and PSF-matched?
+        kernelCache : `PsfMatchingKernelCache` or None
+            Cache of PSF-matching kernels in which to look up and keep the kernel of the exposure;
+            None to solve the kernel without caching it.
+        cacheKey : hashable or None
+            Identity of the exposure, under which its PSF-matching kernel is cached; ignored unless
+            kernelCache is provided.
+        solveBBox : :cpp:class:`lsst::afw::geom::Box2I` or None
+            Parent bbox of the warp over which a kernel that is not cached is solved, which should contain
+            every maxBBox with which the exposure will be PSF-matched using the cached kernel, so that the
+            kernel does not depend on which maxBBox it is first solved for; ignored unless kernelCache is
+            provided. None to solve over the whole warped exposure.
 
         Returns
         -------
@@ -98,6 +155,11 @@ class WarpAndPsfMatchTask(pipeBase.Task):
         xyTransform = afwImage.XYTransformFromWcsPair(wcs, exposure.getWcs())
         psfWarped = WarpedPsf(exposure.getPsf(), xyTransform)
 
+        if (makePsfMatched and kernelCache is not None and cacheKey is not None and
+                destBBox is None and maxBBox is not None):
+            return self._runCached(exposure, wcs, psfWarped, modelPsf, maxBBox, makeDirect, kernelCache,
+                                   cacheKey, solveBBox)
+
         if makePsfMatched and maxBBox is not None:
             # grow warped region to provide sufficient area for PSF-matching
             pixToGrow = 2 * max(self.psfMatch.kConfig.sizeCellX,
@@ -121,3 +183,82 @@ class WarpAndPsfMatchTask(pipeBase.Task):
             direct=exposure if makeDirect else None,
             psfMatched=exposurePsfMatched if makePsfMatched else None
         )
+
+    def _runCached(self, exposure, wcs, psfWarped, modelPsf, maxBBox, makeDirect, kernelCache, cacheKey,
+                   solveBBox):
+        """Warp and PSF-match an exposure, reusing its cached PSF-matching kernel
+
+        If the kernel is not cached, the exposure is warped over solveBBox (grown for PSF-matching) and
+        PSF-matched, so that the kernel is solved over all the pixels it will be applied to, and the kernel
+        is cached; the warps returned are clipped to maxBBox (grown for PSF-matching). Otherwise only the
+        warp within the grown maxBBox is made and convolved with the cached kernel. Parameters are as for
+        run.
+        """
+        key = (cacheKey, self._getModelPsfKey(modelPsf), self._getWcsKey(wcs))
+        entry = kernelCache.get(key)
+        pixToGrow = 2 * max(self.psfMatch.kConfig.sizeCellX, self.psfMatch.kConfig.sizeCellY)
+        grownBBox = afwGeom.Box2I(maxBBox)
+        grownBBox.grow(pixToGrow)
+
+        if entry is None:
+            grownSolveBBox = None
+            if solveBBox is not None:
+                grownSolveBBox = afwGeom.Box2I(solveBBox)
+                grownSolveBBox.include(maxBBox)
+                grownSolveBBox.grow(pixToGrow)
+            with self.timer("warp"):
+                warped = self.warper.warpExposure(wcs, exposure, maxBBox=grownSolveBBox)
+                warped.setPsf(psfWarped)
+            try:
+                result = self.psfMatch.run(warped, modelPsf)
+            except Exception as e:
+                exposurePsfMatched = None
+                self.log.info("Cannot PSF-Match: %s" % (e))
+            else:
+                kernelCache.put(key, pipeBase.Struct(psfMatchingKernel=result.psfMatchingKernel,
+                                                     referencePsfModel=result.psfMatchedExposure.getPsf()))
+                exposurePsfMatched = self._clipExposure(result.psfMatchedExposure, grownBBox)
+            return pipeBase.Struct(
+                direct=self._clipExposure(warped, maxBBox, deep=True) if makeDirect else None,
+                psfMatched=exposurePsfMatched,
+            )
+
+        with self.timer("warp"):
+            warped = self.warper.warpExposure(wcs, exposure, maxBBox=grownBBox)
+            warped.setPsf(psfWarped)
+        with self.timer("convolve"):
+            exposurePsfMatched = afwImage.ExposureF(warped.getBBox(), warped.getWcs())
+            exposurePsfMatched.setFilter(warped.getFilter())
+            exposurePsfMatched.setCalib(warped.getCalib())
+            exposurePsfMatched.getInfo().setVisitInfo(warped.getInfo().getVisitInfo())
+            exposurePsfMatched.setPsf(entry.referencePsfModel)
+            afwMath.convolve(exposurePsfMatched.getMaskedImage(), warped.getMaskedImage(),
+                             entry.psfMatchingKernel, True)
+        return pipeBase.Struct(
+            direct=self._clipExposure(warped, maxBBox, deep=True) if makeDirect else None,
+            psfMatched=exposurePsfMatched,
+        )
+
+    @staticmethod
+    def _clipExposure(exposure, bbox, deep=False):
+        """Return the part of an exposure within bbox, or the exposure itself if they do not overlap
+        """
+        clippedBBox = exposure.getBBox()
+        clippedBBox.clip(bbox)
+        if clippedBBox.isEmpty() or clippedBBox == exposure.getBBox():
+            return exposure
+        return exposure.Factory(exposure, clippedBBox, afwImage.PARENT, deep)
+
+    @staticmethod
+    def _getModelPsfKey(modelPsf):
+        """Return a string identifying a model PSF by its kernel image
+        """
+        kernelImage = modelPsf.computeKernelImage()
+        return hashlib.sha1(str(kernelImage.getDimensions()).encode("utf-8") +
+                            kernelImage.getArray().tobytes()).hexdigest()
+
+    @staticmethod
+    def _getWcsKey(wcs):
+        """Return a string identifying a Wcs by its FITS representation
+        """
+        return hashlib.sha1(wcs.getFitsMetadata().toString().encode("utf-8")).hexdigest()
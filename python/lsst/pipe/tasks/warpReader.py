@@ -0,0 +1,338 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+from builtins import object
+from builtins import range
+import os
+import threading
+import numpy
+
+import lsst.afw.fits as afwFits
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.pipe.base as pipeBase
+
+__all__ = ["WarpReader", "WarpReaderCache", "readFitsHduLayout", "writeCompressedWarp"]
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+
+
+def _parseFitsCardValue(valueStr):
+    """Parse the value field of a FITS header card
+
+    @param[in] valueStr: characters following the "= " value indicator of the card
+    @return value as a str, bool, int or float
+    """
+    valueStr = valueStr.strip()
+    if valueStr.startswith("'"):
+        # Strings are quoted with ' and embedded quotes are doubled
+        value = []
+        i = 1
+        while i < len(valueStr):
+            if valueStr[i] == "'":
+                if valueStr[i + 1:i + 2] == "'":
+                    value.append("'")
+                    i += 2
+                    continue
+                break
+            value.append(valueStr[i])
+            i += 1
+        return "".join(value).rstrip()
+    valueStr = valueStr.split("/", 1)[0].strip()
+    if valueStr == "T":
+        return True
+    if valueStr == "F":
+        return False
+    for dtype in (int, float):
+        try:
+            return dtype(valueStr)
+        except ValueError:
+            pass
+    return valueStr
+
+
+def readFitsHduLayout(filename):
+    """Read the headers of all HDUs in a FITS file and locate their data
+
+    Only the cards with a value are kept (COMMENT, HISTORY and CONTINUE cards are ignored), which is all
+    that is needed to locate and interpret the data of an HDU. HIERARCH cards, used for the keywords longer
+    than 8 characters (such as many of the MP_ mask plane cards), are kept without their HIERARCH prefix.
+
+    @param[in] filename: name of FITS file
+    @return list with an lsst.pipe.base.Struct for each HDU, with fields:
+    - header: dict of keyword: value
+    - dataOffset: offset of the data of the HDU from the start of the file, in bytes
+    - dataSize: size of the data of the HDU, in bytes, not including padding
+    """
+    hduList = []
+    with open(filename, "rb") as fitsFile:
+        fileSize = os.fstat(fitsFile.fileno()).st_size
+        offset = 0
+        while offset < fileSize:
+            header = {}
+            foundEnd = False
+            while not foundEnd:
+                block = fitsFile.read(FITS_BLOCK_SIZE)
+                if len(block) < FITS_BLOCK_SIZE:
+                    raise RuntimeError("Truncated FITS header in %s" % (filename,))
+                offset += FITS_BLOCK_SIZE
+                for start in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+                    card = block[start:start + FITS_CARD_SIZE].decode("ascii", "replace")
+                    key = card[:8].strip()
+                    if key == "END":
+                        foundEnd = True
+                        break
+                    if key == "HIERARCH":
+                        keyword, equals, valueStr = card[9:].partition("=")
+                        if equals:
+                            header[keyword.strip()] = _parseFitsCardValue(valueStr)
+                    elif card[8:10] == "= ":
+                        header[key] = _parseFitsCardValue(card[10:])
+            naxis = header.get("NAXIS", 0)
+            dataSize = 0
+            if naxis > 0:
+                dataSize = abs(header["BITPIX"])//8
+                for i in range(1, naxis + 1):
+                    dataSize *= header["NAXIS%d" % i]
+                dataSize = (dataSize + header.get("PCOUNT", 0))*header.get("GCOUNT", 1)
+            hduList.append(pipeBase.Struct(header=header, dataOffset=offset, dataSize=dataSize))
+            offset += -(-dataSize//FITS_BLOCK_SIZE)*FITS_BLOCK_SIZE
+            fitsFile.seek(offset)
+    return hduList
+
+
+def writeCompressedWarp(exposure, filename, algorithm="GZIP_SHUFFLE", tileSize=128, quantizeLevel=0.0):
+    """Write a warp with tiled compression
+
+    The mask is compressed losslessly. The image and variance are compressed losslessly if quantizeLevel
+    is 0, and are otherwise quantized with quantizeLevel steps per standard deviation of their values
+    (ignoring NO_DATA pixels) before being compressed. The image and variance of NO_DATA pixels are set to
+    NaN, so that they compress to almost nothing; this modifies the exposure.
+
+    The tiles are square, so that reading a subregion (e.g. with WarpReader.readSubregion) only
+    decompresses the tiles it overlaps.
+
+    @param[in,out] exposure: ExposureF to write
+    @param[in] filename: name of the FITS file to write
+    @param[in] algorithm: name of the compression algorithm, e.g. GZIP_SHUFFLE or RICE
+    @param[in] tileSize: width and height of the compression tiles, in pixels
+    @param[in] quantizeLevel: number of quantization steps per standard deviation of the image and
+                              variance; 0 for lossless compression
+    """
+    maskedImage = exposure.getMaskedImage()
+    noData = (maskedImage.getMask().getArray() & afwImage.Mask.getPlaneBitMask("NO_DATA")) != 0
+    maskedImage.getImage().getArray()[noData] = numpy.nan
+    maskedImage.getVariance().getArray()[noData] = numpy.nan
+
+    compressionAlgorithm = afwFits.compressionAlgorithmFromString(algorithm)
+    tiles = numpy.array([tileSize, tileSize], dtype=numpy.int64)
+    losslessOptions = afwFits.ImageWriteOptions(afwFits.ImageCompressionOptions(compressionAlgorithm, tiles))
+    if quantizeLevel > 0:
+        def makeQuantizedOptions(scalingName):
+            scaling = afwFits.ImageScalingOptions(afwFits.scalingAlgorithmFromString(scalingName), 32,
+                                                  ["NO_DATA"], quantizeLevel=quantizeLevel)
+            return afwFits.ImageWriteOptions(afwFits.ImageCompressionOptions(compressionAlgorithm, tiles),
+                                             scaling)
+        imageOptions = makeQuantizedOptions("STDEV_BOTH")
+        varianceOptions = makeQuantizedOptions("STDEV_POSITIVE")
+    else:
+        imageOptions = varianceOptions = losslessOptions
+    exposure.writeFits(filename, imageOptions, losslessOptions, varianceOptions)
+
+
+class WarpReader(object):
+    """Read a warp, and subregions of it, opening and parsing the file only once
+
+    The metadata, Wcs, Psf, Calib, filter and CoaddInputs of the warp are read once, by a single-pixel
+    read, and attached to every exposure returned. The image, mask and variance planes are memory-mapped
+    when they are stored uncompressed with the pixel types and mask plane definitions of an ExposureF in
+    this process, so a subregion costs no more than copying its pixels. Otherwise (e.g. for tile-compressed
+    warps) subregions are read with the afw FITS reader, which only decompresses the tiles that overlap the
+    requested subregion.
+
+    WarpReaders are safe to use from several threads.
+    """
+    # HDU index, FITS dtype and BITPIX of the image, mask and variance planes of an ExposureF
+    _planeFormats = ((1, ">f4", -32), (2, ">i4", 32), (3, ">f4", -32))
+
+    def __init__(self, filename):
+        """Construct a WarpReader
+
+        @param[in] filename: name of the FITS file containing the warp
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._infoExposure = None
+        self._planes = None
+        self._bbox = None
+        self._isMapped = None
+
+    def getInfo(self):
+        """Return a single-pixel ExposureF carrying the non-pixel components of the warp
+
+        @return ExposureF with the metadata, Wcs, Psf, Calib, filter and CoaddInputs of the warp
+        """
+        with self._lock:
+            if self._infoExposure is None:
+                bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(1, 1))
+                self._infoExposure = afwImage.ExposureF(self.filename, bbox=bbox, origin=afwImage.LOCAL)
+            return self._infoExposure
+
+    def isMapped(self):
+        """Are the pixel planes of the warp memory-mapped?
+        """
+        with self._lock:
+            if self._isMapped is None:
+                self._isMapped = self._mapPlanes()
+            return self._isMapped
+
+    def getBBox(self):
+        """Return the parent bounding box of the warp
+        """
+        if self.isMapped() or self._bbox is not None:
+            return afwGeom.Box2I(self._bbox)
+        return self.read().getBBox()
+
+    def readSubregion(self, bbox):
+        """Read a subregion of the warp
+
+        @param[in] bbox: parent bounding box of the subregion
+        @return ExposureF containing the subregion
+        """
+        if not self.isMapped():
+            return afwImage.ExposureF(self.filename, bbox=bbox, origin=afwImage.PARENT)
+        if not self._bbox.contains(bbox):
+            raise RuntimeError("Subregion %s is not contained in %s of %s" %
+                               (bbox, self._bbox, self.filename))
+        rows = slice(bbox.getMinY() - self._bbox.getMinY(), bbox.getMaxY() + 1 - self._bbox.getMinY())
+        cols = slice(bbox.getMinX() - self._bbox.getMinX(), bbox.getMaxX() + 1 - self._bbox.getMinX())
+        maskedImage = afwImage.MaskedImageF(bbox)
+        imagePlane, maskPlane, variancePlane = self._planes
+        maskedImage.getImage().getArray()[:] = imagePlane[rows, cols]
+        maskedImage.getMask().getArray()[:] = maskPlane[rows, cols]
+        maskedImage.getVariance().getArray()[:] = variancePlane[rows, cols]
+        return self._makeExposure(maskedImage)
+
+    def read(self):
+        """Read the full warp
+
+        @return ExposureF containing the warp
+        """
+        if not self.isMapped():
+            return afwImage.ExposureF(self.filename)
+        return self.readSubregion(self._bbox)
+
+    def _makeExposure(self, maskedImage):
+        """Make an ExposureF from a MaskedImageF and the non-pixel components of the warp
+        """
+        info = self.getInfo()
+        exposure = afwImage.ExposureF(maskedImage, info.getWcs())
+        exposure.setMetadata(info.getMetadata())
+        exposure.setCalib(info.getCalib())
+        exposure.setFilter(info.getFilter())
+        if info.hasPsf():
+            exposure.setPsf(info.getPsf())
+        exposure.getInfo().setCoaddInputs(info.getInfo().getCoaddInputs())
+        exposure.getInfo().setApCorrMap(info.getInfo().getApCorrMap())
+        exposure.getInfo().setVisitInfo(info.getInfo().getVisitInfo())
+        return exposure
+
+    def _mapPlanes(self):
+        """Memory-map the image, mask and variance planes, if they are stored in a form we can map
+
+        @return True if the planes were mapped
+        """
+        try:
+            hduList = readFitsHduLayout(self.filename)
+        except Exception:
+            return False
+        if len(hduList) < len(self._planeFormats) + 1:
+            return False
+        # All planes share the xy0 of the image plane; tile-compressed planes keep their image
+        # dimensions in ZNAXISn
+        imageHeader = hduList[self._planeFormats[0][0]].header
+        prefix = "Z" if imageHeader.get("ZIMAGE", False) else ""
+        try:
+            x0 = int(imageHeader.get("CRVAL1A", -imageHeader.get("LTV1", 0)))
+            y0 = int(imageHeader.get("CRVAL2A", -imageHeader.get("LTV2", 0)))
+            self._bbox = afwGeom.Box2I(afwGeom.Point2I(x0, y0),
+                                       afwGeom.Extent2I(imageHeader[prefix + "NAXIS1"],
+                                                        imageHeader[prefix + "NAXIS2"]))
+        except (KeyError, TypeError, ValueError):
+            return False
+        planes = []
+        for hduIndex, dtype, bitpix in self._planeFormats:
+            header = hduList[hduIndex].header
+            if (header.get("XTENSION") != "IMAGE" or header.get("NAXIS") != 2 or
+                    header.get("BITPIX") != bitpix or header.get("BZERO", 0) != 0 or
+                    header.get("BSCALE", 1) != 1):
+                return False
+            planes.append(numpy.memmap(self.filename, dtype=dtype, mode="r",
+                                       offset=hduList[hduIndex].dataOffset,
+                                       shape=(header["NAXIS2"], header["NAXIS1"])))
+        # The mask bits in the file must mean what they mean in this process: every plane of the file
+        # must be defined here, with the same bit
+        maskPlaneDict = afwImage.Mask.getMaskPlaneDict()
+        maskHeader = hduList[self._planeFormats[1][0]].header
+        filePlaneDict = dict((key[3:], value) for key, value in maskHeader.items() if key.startswith("MP_"))
+        if not filePlaneDict:
+            return False
+        for plane, bit in filePlaneDict.items():
+            if plane not in maskPlaneDict or maskPlaneDict[plane] != bit:
+                return False
+        if any(plane.shape != planes[0].shape for plane in planes):
+            return False
+        self._planes = planes
+        return True
+
+
+class WarpReaderCache(object):
+    """A cache of WarpReaders, so that each warp of a patch is opened and parsed only once
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._readers = {}
+
+    def get(self, dataRef, datasetType):
+        """Return the WarpReader for a warp
+
+        @param[in] dataRef: data reference to the warp
+        @param[in] datasetType: dataset type of the warp, e.g. deepCoadd_directWarp
+        @return WarpReader
+        """
+        key = (datasetType, tuple(sorted(dataRef.dataId.items())))
+        with self._lock:
+            reader = self._readers.get(key)
+            if reader is None:
+                reader = WarpReader(dataRef.get(datasetType + "_filename")[0])
+                self._readers[key] = reader
+        return reader
+
+    def clear(self):
+        """Forget all WarpReaders, closing their files
+        """
+        with self._lock:
+            self._readers = {}
@@ -0,0 +1,172 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test selecting the calexps of each band and running the bands in MultiBandAssembleCoaddTask
+"""
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import lsst.utils.tests
+import lsst.pipe.base as pipeBase
+from lsst.pipe.tasks.assembleCoaddMultiBand import (MultiBandAssembleCoaddTask,
+                                                    MultiBandAssembleCoaddRunner)
+from lsst.pipe.tasks.selectImages import BaseSelectImagesTask
+
+
+class DummyDataRef(object):
+    """Quacks like a ButlerDataRef, for its data ID only"""
+
+    def __init__(self, **dataId):
+        self.dataId = dataId
+
+    def __repr__(self):
+        return "DummyDataRef(%s)" % (self.dataId,)
+
+
+class FilterSelectImagesTask(BaseSelectImagesTask):
+    """Select the calexps whose filter is that of the patch data reference"""
+
+    def runDataRef(self, dataRef, coordList, makeDataRefList=True, selectDataList=[]):
+        dataRefList = [data.dataRef for data in selectDataList
+                       if data.dataRef.dataId["filter"] == dataRef.dataId["filter"]]
+        return pipeBase.Struct(dataRefList=dataRefList, exposureInfoList=[])
+
+
+class MultiBandAssembleCoaddTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.patchRefList = [DummyDataRef(tract=0, patch="1,1", filter=filterName)
+                             for filterName in ("g", "r")]
+        self.calExpRefList = [DummyDataRef(visit=visit, ccd=0, filter=filterName)
+                              for visit, filterName in ((1, "g"), (2, "r"), (3, "g"))]
+        self.selectDataList = [pipeBase.Struct(dataRef=dataRef) for dataRef in self.calExpRefList]
+
+    def makeTask(self, selectTarget=None, doSelectPerBand=False):
+        """Make a task whose assembleCoadd subtask records what it is asked to select and assemble"""
+        config = MultiBandAssembleCoaddTask.ConfigClass()
+        if selectTarget is not None:
+            config.assembleCoadd.select.retarget(selectTarget)
+        config.doSelectPerBand = doSelectPerBand
+        task = MultiBandAssembleCoaddTask(config=config)
+        assembleCoadd = task.assembleCoadd
+        self.selected = []
+        self.assembled = {}
+        skyInfo = pipeBase.Struct(name="skyInfo")
+
+        def selectExposures(patchRef, skyInfo=None, selectDataList=[]):
+            self.selected.append(patchRef.dataId["filter"])
+            select = assembleCoadd.select
+            if isinstance(select, FilterSelectImagesTask):
+                return select.runDataRef(patchRef, [], selectDataList=selectDataList).dataRefList
+            return [data.dataRef for data in selectDataList]
+
+        def run(patchRef, selectDataList, skyInfo=None, calExpRefList=None):
+            self.assembled[patchRef.dataId["filter"]] = calExpRefList
+            return pipeBase.Struct(skyInfo=skyInfo)
+
+        assembleCoadd.getSkyInfo = lambda patchRef: skyInfo
+        assembleCoadd.selectExposures = selectExposures
+        assembleCoadd.run = run
+        return task
+
+    def checkBands(self):
+        """Check that each band was assembled from the calexps of its filter"""
+        self.assertEqual(sorted(self.assembled.keys()), ["g", "r"])
+        for filterName, calExpRefList in self.assembled.items():
+            self.assertEqual([calExpRef.dataId["visit"] for calExpRef in calExpRefList],
+                             [calExpRef.dataId["visit"] for calExpRef in self.calExpRefList
+                              if calExpRef.dataId["filter"] == filterName])
+
+    def testWcsSelectOnce(self):
+        """The default Wcs selection is run once for the patch and split by filter"""
+        task = self.makeTask()
+        result = task.run(self.patchRefList, selectDataList=self.selectDataList)
+        self.assertEqual(self.selected, ["g"])
+        self.checkBands()
+        self.assertEqual(sorted(result.results.keys()), ["g", "r"])
+
+    def testFilterSelectPerBand(self):
+        """A select task that uses the filter of the patch is run for each band"""
+        task = self.makeTask(selectTarget=FilterSelectImagesTask)
+        task.run(self.patchRefList, selectDataList=self.selectDataList)
+        self.assertEqual(self.selected, ["g", "r"])
+        self.checkBands()
+
+    def testDoSelectPerBand(self):
+        """doSelectPerBand runs even the Wcs selection for each band"""
+        task = self.makeTask(doSelectPerBand=True)
+        task.run(self.patchRefList, selectDataList=self.selectDataList)
+        self.assertEqual(self.selected, ["g", "r"])
+        # The mock Wcs selection keeps every calexp, as if their data IDs had no filter
+        for calExpRefList in self.assembled.values():
+            self.assertEqual(calExpRefList, self.calExpRefList)
+
+    def testBandCalExpRefListWithoutFilter(self):
+        """Every band is given all calexps if their data IDs have no filter"""
+        task = self.makeTask()
+        calExpRefList = [DummyDataRef(visit=visit, ccd=0) for visit in (1, 2)]
+        self.assertEqual(task.getBandCalExpRefList(self.patchRefList[1], calExpRefList), calExpRefList)
+
+    def testFailedBand(self):
+        """A failed band does not stop the others, but fails the patch"""
+        task = self.makeTask()
+        run = task.assembleCoadd.run
+
+        def failingRun(patchRef, selectDataList, skyInfo=None, calExpRefList=None):
+            if patchRef.dataId["filter"] == "g":
+                raise RuntimeError("Failed band")
+            return run(patchRef, selectDataList, skyInfo=skyInfo, calExpRefList=calExpRefList)
+
+        task.assembleCoadd.run = failingRun
+        with self.assertRaises(RuntimeError):
+            task.run(self.patchRefList, selectDataList=self.selectDataList)
+        self.assertEqual(list(self.assembled.keys()), ["r"])
+
+    def testGetTargetList(self):
+        """The runner groups the data references by patch, and rejects duplicate bands"""
+        refList = [DummyDataRef(tract=0, patch=patch, filter=filterName)
+                   for patch in ("1,1", "1,2") for filterName in ("g", "r")]
+        parsedCmd = pipeBase.Struct(id=pipeBase.Struct(refList=refList),
+                                    selectId=pipeBase.Struct(dataList=self.selectDataList))
+        targetList = MultiBandAssembleCoaddRunner.getTargetList(parsedCmd)
+        self.assertEqual(len(targetList), 2)
+        for patchRefList, kwargs in targetList:
+            self.assertEqual(sorted(ref.dataId["filter"] for ref in patchRefList), ["g", "r"])
+            self.assertEqual(len(set(ref.dataId["patch"] for ref in patchRefList)), 1)
+            self.assertIs(kwargs["selectDataList"], self.selectDataList)
+
+        parsedCmd.id.refList.append(DummyDataRef(tract=0, patch="1,1", filter="g"))
+        with self.assertRaises(RuntimeError):
+            MultiBandAssembleCoaddRunner.getTargetList(parsedCmd)
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
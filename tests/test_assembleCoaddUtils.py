@@ -0,0 +1,251 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test the helper functions of assembleCoadd that do not need a butler
+"""
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.detection as afwDet
+from lsst.pipe.tasks.assembleCoadd import (applyAltMaskPlanes, labelSpanSets, countMaskInLabels,
+                                           countMaskFromFootprint, spanSetFromBinaryArray,
+                                           spanArrayFromBinaryArray, spanSetFromSpanArray,
+                                           SpanSetListStore, subregionSizeForBudget,
+                                           CompareWarpAssembleCoaddTask)
+
+
+class ApplyAltMaskPlanesTestCase(lsst.utils.tests.TestCase):
+    """Test that alternative masks given as SpanSets match those rasterized on a full-patch mask"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(60, 50))
+        self.spanSetList = [
+            afwGeom.SpanSet.fromShape(4, afwGeom.Stencil.CIRCLE, offset=afwGeom.Point2I(110, 210)),
+            afwGeom.SpanSet.fromShape(6, afwGeom.Stencil.BOX, offset=afwGeom.Point2I(155, 245)),
+            afwGeom.SpanSet.fromShape(3, afwGeom.Stencil.BOX, offset=afwGeom.Point2I(0, 0)),
+        ]
+
+    def testSubregions(self):
+        altMaskSpans = {"CLIPPED": self.spanSetList}
+        fullMask = afwImage.Mask(self.bbox)
+        fullMask.set(afwImage.Mask.getPlaneBitMask("NO_DATA"))
+        applyAltMaskPlanes(fullMask, altMaskSpans)
+        clippedBit = afwImage.Mask.getPlaneBitMask("CLIPPED")
+        self.assertEqual((fullMask.getArray() & clippedBit != 0).sum(),
+                         sum(spanSet.clippedTo(self.bbox).getArea() for spanSet in self.spanSetList))
+        for subBBox in (afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(30, 25)),
+                        afwGeom.Box2I(afwGeom.Point2I(130, 225), afwGeom.Extent2I(30, 25))):
+            subMask = afwImage.Mask(subBBox)
+            subMask.set(afwImage.Mask.getPlaneBitMask("NO_DATA"))
+            applyAltMaskPlanes(subMask, altMaskSpans)
+            expected = fullMask.Factory(fullMask, subBBox, afwImage.PARENT)
+            np.testing.assert_array_equal(subMask.getArray(), expected.getArray())
+
+
+class CountMaskInLabelsTestCase(lsst.utils.tests.TestCase):
+    """Test that counting masks on labelled SpanSets matches countMaskFromFootprint"""
+
+    def testCounts(self):
+        np.random.seed(54321)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(-20, 30), afwGeom.Extent2I(80, 70))
+        mask = afwImage.Mask(bbox)
+        detected = afwImage.Mask.getPlaneBitMask("DETECTED")
+        noData = afwImage.Mask.getPlaneBitMask("NO_DATA")
+        mask.getArray()[:] = np.random.choice([0, detected, noData, detected | noData],
+                                              size=mask.getArray().shape)
+        footprints = [afwDet.Footprint(afwGeom.SpanSet.fromShape(r, afwGeom.Stencil.CIRCLE,
+                                                                 offset=afwGeom.Point2I(x, y)))
+                      for r, x, y in ((5, -18, 35), (8, 20, 60), (3, 58, 99), (4, 100, 100))]
+        labels = labelSpanSets([footprint.spans for footprint in footprints], bbox)
+        self.assertEqual(labels.count, len(footprints))
+        for bitmask, ignoreMask in ((detected, noData), (noData, 0)):
+            counts = countMaskInLabels(labels, mask.getArray(), bitmask, ignoreMask)
+            expected = [countMaskFromFootprint(mask, footprint, bitmask, ignoreMask)
+                        if footprint.getBBox().overlaps(bbox) else 0 for footprint in footprints]
+            np.testing.assert_array_equal(counts, expected)
+
+
+class FilterArtifactsTestCase(lsst.utils.tests.TestCase):
+    """Test that artifacts are filtered as by checking each SpanSet on its own"""
+
+    def setUp(self):
+        np.random.seed(13579)
+        self.task = CompareWarpAssembleCoaddTask()
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(-10, 40), afwGeom.Extent2I(70, 60))
+        self.epochCountImage = afwImage.ImageU(self.bbox)
+        # Most pixels left of x=30 are outliers in a single epoch
+        epochCountArray = self.epochCountImage.getArray()
+        epochCountArray[:, :40] = np.random.choice([0, 1, 2], size=(60, 40), p=[0.1, 0.8, 0.1])
+        epochCountArray[:, 40:] = np.random.choice([0, 1, 2, 3, 5], size=(60, 30),
+                                                   p=[0.2, 0.3, 0.2, 0.2, 0.1])
+        # Interior SpanSets, SpanSets clipped at each edge of the bbox (as the candidate artifacts are),
+        # and SpanSets smaller than minPixels
+        shapeList = [(5, afwGeom.Stencil.CIRCLE, 20, 70), (3, afwGeom.Stencil.BOX, 40, 55),
+                     (4, afwGeom.Stencil.CIRCLE, -10, 40), (6, afwGeom.Stencil.BOX, 59, 99),
+                     (3, afwGeom.Stencil.CIRCLE, 25, 40), (2, afwGeom.Stencil.BOX, -8, 80),
+                     (1, afwGeom.Stencil.CIRCLE, 0, 60), (1, afwGeom.Stencil.BOX, 59, 45),
+                     (0, afwGeom.Stencil.BOX, 30, 70)]
+        shapeList += [(np.random.randint(0, 4), afwGeom.Stencil.CIRCLE, np.random.randint(-10, 60),
+                       np.random.randint(40, 100)) for i in range(20)]
+        self.spanSetList = [afwGeom.SpanSet.fromShape(r, stencil,
+                                                      offset=afwGeom.Point2I(x, y)).clippedTo(self.bbox)
+                            for r, stencil, x, y in shapeList]
+
+    def tearDown(self):
+        del self.task
+
+    def filterEachSpanSet(self, maxNumEpochs, minPixels):
+        """Filter the SpanSets one at a time, as CompareWarpAssembleCoaddTask used to"""
+        maskSpanSetList = []
+        x0, y0 = self.epochCountImage.getXY0()
+        for span in self.spanSetList:
+            y, x = span.indices()
+            if len(y) < minPixels:
+                continue
+            counts = self.epochCountImage.array[[y1 - y0 for y1 in y], [x1 - x0 for x1 in x]]
+            idx = np.where((counts > 0) & (counts <= maxNumEpochs))
+            percentBelowThreshold = len(idx[0]) / len(counts)
+            if percentBelowThreshold > self.task.config.spatialThreshold:
+                maskSpanSetList.append(span)
+        return maskSpanSetList
+
+    def testEquivalence(self):
+        for maxNumEpochs in (1, 2, 3):
+            for minPixels in (1, 10, 30):
+                expected = self.filterEachSpanSet(maxNumEpochs, minPixels)
+                self.assertGreater(len(expected), 0)
+                self.assertEqual(self.task._filterArtifacts(self.spanSetList, self.epochCountImage,
+                                                            maxNumEpochs=maxNumEpochs, minPixels=minPixels),
+                                 expected)
+
+    def testMinPixelsOutsideImage(self):
+        """minPixels counts the pixels of a SpanSet outside the image too"""
+        self.epochCountImage.set(1)
+        # A 7x7 box centered on the corner of the image has 16 pixels in the image
+        spanSet = afwGeom.SpanSet.fromShape(3, afwGeom.Stencil.BOX, offset=self.bbox.getMin())
+        self.assertEqual(spanSet.clippedTo(self.bbox).getArea(), 16)
+        for minPixels, expected in ((16, [spanSet]), (49, [spanSet]), (50, [])):
+            self.assertEqual(self.task._filterArtifacts([spanSet], self.epochCountImage, maxNumEpochs=1,
+                                                        minPixels=minPixels), expected)
+
+
+class SpanSetStorageTestCase(lsst.utils.tests.TestCase):
+    """Test making SpanSets from binary arrays and storing them compactly"""
+
+    def setUp(self):
+        np.random.seed(2468)
+        self.xy0 = afwGeom.Point2I(-7, 12)
+        self.array = (np.random.uniform(size=(40, 50)) > 0.7).astype(np.uint8)
+        self.array[:, 0] = 1
+        self.array[-1, :] = 1
+
+    def testSpanSetFromBinaryArray(self):
+        spanSet = spanSetFromBinaryArray(self.array, self.xy0)
+        mask = afwImage.makeMaskFromArray(self.array.astype(afwImage.MaskPixel))
+        mask.setXY0(self.xy0)
+        expected = afwGeom.SpanSet.fromMask(mask)
+        self.assertEqual(spanSet.getArea(), self.array.sum())
+        self.assertEqual(spanSet, expected)
+        self.assertEqual(spanSetFromBinaryArray(np.zeros((3, 4)), self.xy0).getArea(), 0)
+
+    def testSpansOfSubregions(self):
+        """Runs found in sub-regions are joined across their boundaries"""
+        expected = spanSetFromBinaryArray(self.array, self.xy0)
+        spansList = []
+        for yStart in range(0, self.array.shape[0], 15):
+            for xStart in range(0, self.array.shape[1], 7):
+                subXY0 = afwGeom.Point2I(self.xy0.getX() + xStart, self.xy0.getY() + yStart)
+                spansList.append(spanArrayFromBinaryArray(self.array[yStart:yStart + 15, xStart:xStart + 7],
+                                                          subXY0))
+        spanSet = spanSetFromSpanArray(np.concatenate(spansList))
+        self.assertEqual(spanSet, expected)
+        self.assertEqual(spanSet.split(), expected.split())
+        self.assertEqual(spanSetFromSpanArray(np.zeros((0, 3))).getArea(), 0)
+
+    def testStore(self):
+        spanSetLists = [spanSetFromBinaryArray(self.array, self.xy0).split(), [],
+                        spanSetFromBinaryArray(self.array[5:20, 10:30], self.xy0).split()]
+        for maxMemory in (0, 10**9):
+            store = SpanSetListStore(maxMemory)
+            try:
+                for spanSetList in spanSetLists:
+                    store.append(spanSetList)
+                self.assertEqual(len(store), len(spanSetLists))
+                self.assertEqual(store.numSpilled, len(spanSetLists) if maxMemory == 0 else 0)
+                for i, spanSetList in enumerate(spanSetLists):
+                    self.assertEqual(store.get(i), spanSetList)
+            finally:
+                store.close()
+
+
+class SubregionSizeForBudgetTestCase(lsst.utils.tests.TestCase):
+    """Test choosing the subregion size from a memory budget"""
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(4000, 3000))
+
+    def checkFits(self, size, maxBytes, fixedBytes, bytesPerPixel):
+        self.assertGreater(size.getX(), 0)
+        self.assertGreater(size.getY(), 0)
+        self.assertLessEqual(size.getX(), self.bbox.getWidth())
+        self.assertLessEqual(size.getY(), self.bbox.getHeight())
+        self.assertLessEqual(fixedBytes + size.getX()*size.getY()*bytesPerPixel, maxBytes)
+
+    def testSquare(self):
+        size = subregionSizeForBudget(self.bbox, 10**6 + 1000*1000*12, 10**6, 12)
+        self.assertEqual(size, afwGeom.Extent2I(1000, 1000))
+        self.checkFits(size, 10**6 + 1000*1000*12, 10**6, 12)
+
+    def testWholePatch(self):
+        size = subregionSizeForBudget(self.bbox, 10**12, 0, 12)
+        self.assertEqual(size, self.bbox.getDimensions())
+
+    def testPartialRow(self):
+        """A budget smaller than a row gives a single row of the pixels that fit"""
+        for pixels in (1, 17, 3999):
+            maxBytes = 500 + pixels*24 + 23
+            size = subregionSizeForBudget(self.bbox, maxBytes, 500, 24)
+            self.assertEqual(size, afwGeom.Extent2I(pixels, 1))
+            self.checkFits(size, maxBytes, 500, 24)
+
+    def testTooSmall(self):
+        for maxBytes in (0, 499, 500, 523):
+            with self.assertRaises(RuntimeError):
+                subregionSizeForBudget(self.bbox, maxBytes, 500, 24)
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
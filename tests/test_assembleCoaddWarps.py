@@ -0,0 +1,397 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test weighting and assembling warps written to a directory with AssembleCoaddTask
+"""
+from __future__ import absolute_import, division, print_function
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.pipe.base as pipeBase
+from lsst.afw.coord import IcrsCoord
+from lsst.pipe.tasks.assembleCoadd import AssembleCoaddTask
+from lsst.pipe.tasks.coaddInputRecorder import CoaddInputRecorderTask
+from lsst.pipe.tasks.makeCoaddTempExp import MakeCoaddTempExpTask, WARP_WEIGHT_KEYS
+
+
+class WarpDataRef(object):
+    """Quacks like a ButlerDataRef to the warps of a visit, which are FITS files in a directory"""
+
+    def __init__(self, directory, **dataId):
+        self.directory = directory
+        self.dataId = dataId
+
+    def __repr__(self):
+        return "WarpDataRef(%s)" % (self.dataId,)
+
+    def getFilename(self, datasetType):
+        return os.path.join(self.directory, "%s-%d.fits" % (datasetType, self.dataId["visit"]))
+
+    def datasetExists(self, datasetType):
+        return os.path.exists(self.getFilename(datasetType))
+
+    def get(self, datasetType, bbox=None, imageOrigin="PARENT", immediate=True):
+        if datasetType.endswith("_filename"):
+            return [self.getFilename(datasetType[:-len("_filename")])]
+        if datasetType.endswith("_sub"):
+            return afwImage.ExposureF(self.getFilename(datasetType[:-len("_sub")]), bbox=bbox,
+                                      origin=getattr(afwImage, imageOrigin))
+        return afwImage.ExposureF(self.getFilename(datasetType))
+
+    def put(self, exposure, datasetType):
+        exposure.writeFits(self.getFilename(datasetType))
+
+
+class AssembleCoaddWarpsTestCase(lsst.utils.tests.TestCase):
+    """Base class for tests on warps of a patch written to a temporary directory
+
+    Each warp has a different photometric zero point and noise level, and NO_DATA outside the bounding
+    box of its single CCD.
+    """
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.directory = tempfile.mkdtemp()
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(1000, 2000), afwGeom.Extent2I(120, 90))
+        self.wcs = afwImage.makeWcs(IcrsCoord(10*afwGeom.degrees, 45*afwGeom.degrees),
+                                    afwGeom.Point2D(1060.0, 2045.0), 0.2/3600, 0.0, 0.0, 0.2/3600)
+        self.ccdBBoxes = {
+            1: afwGeom.Box2I(afwGeom.Point2I(1000, 2000), afwGeom.Extent2I(80, 90)),
+            2: afwGeom.Box2I(afwGeom.Point2I(1040, 2000), afwGeom.Extent2I(80, 90)),
+            3: afwGeom.Box2I(afwGeom.Point2I(1010, 2010), afwGeom.Extent2I(30, 25)),
+        }
+        self.refList = [WarpDataRef(self.directory, visit=visit, tract=0, patch="1,1")
+                        for visit in sorted(self.ccdBBoxes)]
+        self.tempExpName = AssembleCoaddTask(config=AssembleCoaddTask.ConfigClass()).getTempExpDatasetName()
+        for tempExpRef in self.refList:
+            self.writeWarp(tempExpRef)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def makeWarp(self, visit, noise=None):
+        """Make the warp of a visit, with noise proportional to its visit number unless given"""
+        if noise is None:
+            noise = 2.0*visit
+        fluxMag0 = 1e11*visit
+        ccdBBox = self.ccdBBoxes[visit]
+        exposure = afwImage.ExposureF(self.bbox, self.wcs)
+        exposure.setCalib(afwImage.Calib(fluxMag0))
+        maskedImage = exposure.getMaskedImage()
+        shape = maskedImage.getImage().getArray().shape
+        x0 = ccdBBox.getMinX() - self.bbox.getMinX()
+        y0 = ccdBBox.getMinY() - self.bbox.getMinY()
+        valid = np.zeros(shape, dtype=bool)
+        valid[y0:y0 + ccdBBox.getHeight(), x0:x0 + ccdBBox.getWidth()] = True
+        # The same sky in every warp, in the units of its zero point
+        imageArr = (100.0 + np.random.normal(0.0, noise, shape))*fluxMag0/1e11
+        varianceArr = np.random.uniform(0.5, 1.5, shape)*(noise*fluxMag0/1e11)**2
+        maskArr = np.zeros(shape, dtype=maskedImage.getMask().getArray().dtype)
+        # A few saturated pixels and an outlier in each warp
+        maskArr[y0 + 5 + visit:y0 + 8 + visit, x0 + 25:x0 + 28] = afwImage.Mask.getPlaneBitMask("SAT")
+        imageArr[y0 + 20, x0 + 12 + visit] += 1e4
+        maskArr[~valid] = afwImage.Mask.getPlaneBitMask("NO_DATA")
+        imageArr[~valid] = np.nan
+        varianceArr[~valid] = np.nan
+        maskedImage.getImage().getArray()[:] = imageArr
+        maskedImage.getMask().getArray()[:] = maskArr
+        maskedImage.getVariance().getArray()[:] = varianceArr
+
+        coaddInputs = CoaddInputRecorderTask().makeCoaddInputs()
+        ccdRecord = coaddInputs.ccds.addNew()
+        ccdRecord.setId(visit)
+        ccdRecord.setWcs(self.wcs)
+        ccdRecord.setBBox(ccdBBox)
+        exposure.getInfo().setCoaddInputs(coaddInputs)
+        return exposure
+
+    def writeWarp(self, tempExpRef, exposure=None):
+        if exposure is None:
+            exposure = self.makeWarp(tempExpRef.dataId["visit"])
+        tempExpRef.put(exposure, self.tempExpName)
+
+    def makeTask(self, zeroPoint=None, **config):
+        taskConfig = AssembleCoaddTask.ConfigClass()
+        for name, value in config.items():
+            setattr(taskConfig, name, value)
+        if zeroPoint is not None:
+            taskConfig.scaleZeroPoint.zeroPoint = zeroPoint
+        return AssembleCoaddTask(config=taskConfig)
+
+    def makeStatsCtrl(self, task):
+        """Make the statistics control object with which AssembleCoaddTask.prepareInputs weights warps"""
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setNumSigmaClip(task.config.sigmaClip)
+        statsCtrl.setNumIter(task.config.clipIter)
+        statsCtrl.setAndMask(task.getBadPixelMask())
+        statsCtrl.setNanSafe(True)
+        return statsCtrl
+
+
+class WeightCacheTestCase(AssembleCoaddWarpsTestCase):
+    """Test caching the weight and photometric scaling of warps in sidecar files"""
+
+    def getCacheFilename(self, task, tempExpRef):
+        return task.getWeightCacheFilename(tempExpRef)[1]
+
+    def assertWeightsEqual(self, warpWeight, expected):
+        self.assertEqual(warpWeight.status, expected.status)
+        self.assertFloatsAlmostEqual(warpWeight.weight, expected.weight, rtol=1e-12)
+        self.assertFloatsAlmostEqual(warpWeight.imageScaler._scale, expected.imageScaler._scale, rtol=1e-12)
+
+    def testCachedWeight(self):
+        """The weights read from the cache are those computed from the warps, which are not read again"""
+        task = self.makeTask(doWeightCache=True)
+        statsCtrl = self.makeStatsCtrl(task)
+        freshWeightList = [task.computeWarpWeight(tempExpRef, statsCtrl) for tempExpRef in self.refList]
+        for tempExpRef in self.refList:
+            self.assertFalse(os.path.exists(self.getCacheFilename(task, tempExpRef)))
+        inputs = task.prepareInputs(self.refList)
+        for tempExpRef in self.refList:
+            self.assertTrue(os.path.exists(self.getCacheFilename(task, tempExpRef)))
+
+        task = self.makeTask(doWeightCache=True)
+
+        def computeWarpWeight(tempExpRef, statsCtrl):
+            self.fail("Weight of %s was not read from the cache" % (tempExpRef,))
+
+        task.computeWarpWeight = computeWarpWeight
+        cachedInputs = task.prepareInputs(self.refList)
+        self.assertEqual(cachedInputs.tempExpRefList, self.refList)
+        for tempExpRef, warpWeight in zip(self.refList, freshWeightList):
+            self.assertWeightsEqual(task.readWeightCache(tempExpRef), warpWeight)
+        for result in (inputs, cachedInputs):
+            self.assertFloatsAlmostEqual(np.array(result.weightList),
+                                         np.array([warpWeight.weight for warpWeight in freshWeightList]),
+                                         rtol=1e-12)
+            self.assertFloatsAlmostEqual(np.array([imageScaler._scale for imageScaler in
+                                                   result.imageScalerList]),
+                                         np.array([warpWeight.imageScaler._scale for warpWeight in
+                                                   freshWeightList]),
+                                         rtol=1e-12)
+
+    def testConfigInvalidates(self):
+        """A cache entry is not used with a different configuration"""
+        tempExpRef = self.refList[0]
+        self.makeTask(doWeightCache=True).prepareInputs([tempExpRef])
+        self.assertIsNotNone(self.makeTask(doWeightCache=True).readWeightCache(tempExpRef))
+        for name, value in (("sigmaClip", 2.5), ("clipIter", 3), ("badMaskPlanes", ["NO_DATA", "BAD"])):
+            task = self.makeTask(doWeightCache=True, **{name: value})
+            self.assertIsNone(task.readWeightCache(tempExpRef), name)
+        self.assertIsNone(self.makeTask(doWeightCache=True, zeroPoint=30.0).readWeightCache(tempExpRef))
+
+        # The recomputed weight replaces the stale entry
+        task = self.makeTask(doWeightCache=True, clipIter=3)
+        inputs = task.prepareInputs([tempExpRef])
+        self.assertWeightsEqual(task.readWeightCache(tempExpRef),
+                                task.computeWarpWeight(tempExpRef, self.makeStatsCtrl(task)))
+        self.assertEqual(inputs.weightList, [task.readWeightCache(tempExpRef).weight])
+        self.assertIsNone(self.makeTask(doWeightCache=True).readWeightCache(tempExpRef))
+
+    def testWarpInvalidates(self):
+        """A cache entry is not used once its warp is written again"""
+        tempExpRef = self.refList[1]
+        task = self.makeTask(doWeightCache=True)
+        task.prepareInputs([tempExpRef])
+        oldWeight = task.readWeightCache(tempExpRef)
+        self.assertIsNotNone(oldWeight)
+
+        self.writeWarp(tempExpRef, self.makeWarp(tempExpRef.dataId["visit"], noise=10.0))
+        # Make sure the modification time changes, even on file systems with coarse timestamps
+        warpFilename = tempExpRef.get(self.tempExpName + "_filename")[0]
+        mtime = os.stat(warpFilename).st_mtime + 10
+        os.utime(warpFilename, (mtime, mtime))
+        self.assertIsNone(task.readWeightCache(tempExpRef))
+
+        inputs = task.prepareInputs([tempExpRef])
+        newWeight = task.computeWarpWeight(tempExpRef, self.makeStatsCtrl(task))
+        self.assertLess(newWeight.weight, oldWeight.weight)
+        self.assertFloatsAlmostEqual(inputs.weightList[0], newWeight.weight, rtol=1e-12)
+        self.assertWeightsEqual(task.readWeightCache(tempExpRef), newWeight)
+
+    def testFailuresNotCached(self):
+        """A warp whose weight cannot be computed is skipped, and retried on the next run"""
+        tempExpRef = self.refList[2]
+        exposure = self.makeWarp(tempExpRef.dataId["visit"])
+        exposure.getMaskedImage().getVariance().set(np.nan)
+        self.writeWarp(tempExpRef, exposure)
+        task = self.makeTask(doWeightCache=True)
+        self.assertEqual(task.computeWarpWeight(tempExpRef, self.makeStatsCtrl(task)).status,
+                         "nonFiniteWeight")
+        inputs = task.prepareInputs(self.refList)
+        self.assertEqual(inputs.tempExpRefList, self.refList[:2])
+        self.assertFalse(os.path.exists(self.getCacheFilename(task, tempExpRef)))
+
+        for status in ("scalingFailed", "nonFiniteWeight"):
+            task.writeWeightCache(tempExpRef, pipeBase.Struct(status=status, weight=None, imageScaler=None))
+            self.assertFalse(os.path.exists(self.getCacheFilename(task, tempExpRef)))
+
+        # Failures cached by earlier versions are ignored
+        warpFilename, cacheFilename = task.getWeightCacheFilename(tempExpRef)
+        with open(cacheFilename, "w") as cacheFile:
+            json.dump(dict(key=task.makeWeightCacheKey(tempExpRef, warpFilename), status="nonFiniteWeight",
+                           weight=None, scale=None), cacheFile)
+        self.assertIsNone(task.readWeightCache(tempExpRef))
+
+        # Once the warp is fixed its weight is computed and cached
+        self.writeWarp(tempExpRef)
+        inputs = task.prepareInputs(self.refList)
+        self.assertEqual(inputs.tempExpRefList, self.refList)
+        self.assertEqual(task.readWeightCache(tempExpRef).status, "ok")
+
+
+class WeightMetadataTestCase(AssembleCoaddWarpsTestCase):
+    """Test computing the weight of warps from the statistics recorded by MakeCoaddTempExpTask"""
+
+    def setUp(self):
+        AssembleCoaddWarpsTestCase.setUp(self)
+        self.task = self.makeTask()
+        statsCtrl = self.makeStatsCtrl(self.task)
+        self.pixelWeightList = [self.task.computeWarpWeight(tempExpRef, statsCtrl)
+                                for tempExpRef in self.refList]
+
+    def tearDown(self):
+        del self.task
+        AssembleCoaddWarpsTestCase.tearDown(self)
+
+    def recordWeightStats(self, tempExpRef, **metadataItems):
+        """Record the weight statistics of a warp in its metadata, overriding some of them if given"""
+        exposure = self.task.readWarp(tempExpRef)
+        MakeCoaddTempExpTask().measureWeightStats(exposure)
+        for name, value in metadataItems.items():
+            exposure.getMetadata().set(getattr(WARP_WEIGHT_KEYS, name), value)
+        self.writeWarp(tempExpRef, exposure)
+
+    def testMetadataWeight(self):
+        """The weight from the metadata is that measured from the pixels, which are not read"""
+        for tempExpRef in self.refList:
+            self.assertIsNone(self.task.computeWarpWeightFromMetadata(tempExpRef))
+            self.recordWeightStats(tempExpRef)
+
+        def readWarp(tempExpRef, warpType=None):
+            self.fail("Pixels of %s were read" % (tempExpRef,))
+
+        self.task.readWarp = readWarp
+        statsCtrl = self.makeStatsCtrl(self.task)
+        for tempExpRef, pixelWeight in zip(self.refList, self.pixelWeightList):
+            for warpWeight in (self.task.computeWarpWeightFromMetadata(tempExpRef),
+                               self.task.computeWarpWeight(tempExpRef, statsCtrl)):
+                self.assertEqual(warpWeight.status, "ok")
+                self.assertFloatsAlmostEqual(warpWeight.weight, pixelWeight.weight, rtol=1e-5)
+                self.assertFloatsAlmostEqual(warpWeight.imageScaler._scale, pixelWeight.imageScaler._scale,
+                                             rtol=1e-12)
+
+    def testMismatchedMetadata(self):
+        """Statistics measured with other clipping parameters or bad mask planes are measured again"""
+        tempExpRef = self.refList[1]
+        pixelWeight = self.pixelWeightList[1]
+        statsCtrl = self.makeStatsCtrl(self.task)
+        # The bogus mean variance is used when the parameters match
+        self.recordWeightStats(tempExpRef, meanVar=1.0)
+        warpWeight = self.task.computeWarpWeight(tempExpRef, statsCtrl)
+        self.assertFloatsAlmostEqual(warpWeight.weight, 1.0/pixelWeight.imageScaler._scale**2, rtol=1e-12)
+
+        for name, value in (("sigmaClip", 2.5), ("clipIter", 3), ("badMaskPlanes", "BAD,NO_DATA")):
+            self.recordWeightStats(tempExpRef, meanVar=1.0, **{name: value})
+            self.assertIsNone(self.task.computeWarpWeightFromMetadata(tempExpRef), name)
+            warpWeight = self.task.computeWarpWeight(tempExpRef, statsCtrl)
+            self.assertEqual(warpWeight.status, "ok")
+            self.assertFloatsAlmostEqual(warpWeight.weight, pixelWeight.weight, rtol=1e-12)
+
+
+class AssembleSubregionsTestCase(AssembleCoaddWarpsTestCase):
+    """Test that the ways of assembling the subregions of a patch all make the same coadd"""
+
+    def assemble(self, **config):
+        """Assemble MEAN and MEANCLIP coadds of the warps, with nImage, in subregions of 30x30 pixels"""
+        task = self.makeTask(subregionSize=[30, 30], doNImage=True, **config)
+        # The warps have no PSFs or aperture corrections to combine
+        task.assembleMetadata = lambda *args, **kwargs: None
+        inputs = task.prepareInputs(self.refList)
+        self.assertEqual(inputs.tempExpRefList, self.refList)
+        skyInfo = pipeBase.Struct(bbox=self.bbox, wcs=self.wcs)
+        return task.assembleStatistics(skyInfo, inputs.tempExpRefList, inputs.imageScalerList,
+                                       inputs.weightList, ["MEAN", "MEANCLIP"])
+
+    def assertAssembledEqual(self, result, expected):
+        self.assertEqual(len(result.coaddExposureList), len(expected.coaddExposureList))
+        for coaddExposure, expectedExposure in zip(result.coaddExposureList, expected.coaddExposureList):
+            self.assertEqual(coaddExposure.getBBox(), expectedExposure.getBBox())
+            maskedImage = coaddExposure.getMaskedImage()
+            expectedImage = expectedExposure.getMaskedImage()
+            for getPlane in ("getImage", "getMask", "getVariance"):
+                np.testing.assert_array_equal(getattr(maskedImage, getPlane)().getArray(),
+                                              getattr(expectedImage, getPlane)().getArray())
+        np.testing.assert_array_equal(result.nImage.getArray(), expected.nImage.getArray())
+
+    def testParallel(self):
+        """Assembling subregions in threads, in worker processes or with read-ahead makes the same coadd"""
+        expected = self.assemble()
+        # Every pixel is covered by at least one warp
+        self.assertGreater(expected.nImage.getArray().min(), 0)
+        self.assertEqual(expected.nImage.getArray().max(), 3)
+        for config in (dict(numWorkers=3, parallelType="thread"),
+                       dict(numWorkers=3, parallelType="process"),
+                       dict(numWorkers=20, parallelType="process"),
+                       dict(prefetchDepth=2, numIoThreads=2)):
+            self.assertAssembledEqual(self.assemble(**config), expected)
+
+    def testSkipNonOverlappingWarps(self):
+        """Skipping the warps that do not overlap a subregion makes the same coadd"""
+        validBBoxList = self.makeTask().makeValidRegionIndex(self.bbox, self.refList)
+        for tempExpRef, validBBox in zip(self.refList, validBBoxList):
+            self.assertTrue(validBBox.contains(self.ccdBBoxes[tempExpRef.dataId["visit"]]))
+            self.assertTrue(self.bbox.contains(validBBox))
+        # Visit 3 is skipped in the subregions right of x=1060, where visit 2 is saturated
+        self.assertFalse(validBBoxList[2].overlaps(afwGeom.Box2I(afwGeom.Point2I(1060, 2000),
+                                                                 afwGeom.Extent2I(30, 30))))
+        # Visit 2 has about 18% of the weight of all the warps, and 20% of that of the warps left in those
+        # subregions, so a SAT threshold of 0.19 is only honoured if it is rescaled to the warps left
+        for thresholds in ({"SAT": 0.1}, {"SAT": 0.19}):
+            expected = self.assemble(maskPropagationThresholds=thresholds)
+            for config in (dict(), dict(numWorkers=3, parallelType="thread"),
+                           dict(numWorkers=3, parallelType="process"), dict(prefetchDepth=2)):
+                self.assertAssembledEqual(self.assemble(doSkipNonOverlappingWarps=True,
+                                                        maskPropagationThresholds=thresholds, **config),
+                                          expected)
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,149 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test MeanCoaddAccumulator against afwMath.statisticsStack
+"""
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.pipe.tasks.coaddAccumulator import MeanCoaddAccumulator
+
+
+class MeanCoaddAccumulatorTestCase(lsst.utils.tests.TestCase):
+    """Test that the accumulated mean matches a weighted MEAN stack"""
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(60, 40))
+        self.badMaskPlanes = ["NO_DATA", "BAD"]
+        self.maskedImageList = []
+        self.weightList = []
+        shape = (self.bbox.getHeight(), self.bbox.getWidth())
+        for i in range(4):
+            maskedImage = afwImage.MaskedImageF(self.bbox)
+            maskedImage.getImage().getArray()[:] = np.random.normal(10.0, 3.0, shape)
+            maskedImage.getVariance().getArray()[:] = np.random.uniform(5.0, 15.0, shape)
+            maskedImage.getMask().getArray()[:, 10*i:10*i + 5] = afwImage.Mask.getPlaneBitMask("BAD")
+            maskedImage.getMask().getArray()[5*i:5*i + 3, :] |= afwImage.Mask.getPlaneBitMask("SAT")
+            self.maskedImageList.append(maskedImage)
+            self.weightList.append(1.0/(i + 1.0))
+
+    def tearDown(self):
+        del self.maskedImageList
+
+    def makeAccumulator(self, indices):
+        accumulator = MeanCoaddAccumulator(self.bbox, self.badMaskPlanes, {"SAT": 0.5})
+        subBBox = afwGeom.Box2I(self.bbox.getMin(), afwGeom.Extent2I(60, 25))
+        for i in indices:
+            for bbox in (subBBox, afwGeom.Box2I(afwGeom.Point2I(100, 225), afwGeom.Extent2I(60, 15))):
+                maskedImage = self.maskedImageList[i].Factory(self.maskedImageList[i], bbox, afwImage.PARENT)
+                accumulator.add(str(i), maskedImage, self.weightList[i])
+        return accumulator
+
+    def assertCoaddsEqual(self, accumulator, indices):
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setAndMask(afwImage.Mask.getPlaneBitMask(self.badMaskPlanes))
+        statsCtrl.setNanSafe(True)
+        statsCtrl.setWeighted(True)
+        statsCtrl.setCalcErrorFromInputVariance(True)
+        expected = afwMath.statisticsStack([self.maskedImageList[i] for i in indices], afwMath.MEAN,
+                                           statsCtrl, [self.weightList[i] for i in indices])
+        maskedImage, nImage = accumulator.makeCoadd()
+        self.assertFloatsAlmostEqual(maskedImage.getImage().getArray(), expected.getImage().getArray(),
+                                     rtol=1e-5)
+        self.assertFloatsAlmostEqual(maskedImage.getVariance().getArray(),
+                                     expected.getVariance().getArray(), rtol=1e-5)
+        expectedNImage = sum((self.maskedImageList[i].getMask().getArray() &
+                              statsCtrl.getAndMask() == 0).astype(int) for i in indices)
+        np.testing.assert_array_equal(nImage.getArray(), expectedNImage)
+
+    def testMean(self):
+        accumulator = self.makeAccumulator(range(4))
+        self.assertCoaddsEqual(accumulator, range(4))
+        self.assertAlmostEqual(accumulator.getTotalWeight(), sum(self.weightList))
+
+    def testRemove(self):
+        accumulator = self.makeAccumulator(range(4))
+        accumulator.remove("2", self.maskedImageList[2])
+        accumulator.forget("2")
+        self.assertEqual(sorted(accumulator.warps), ["0", "1", "3"])
+        self.assertCoaddsEqual(accumulator, [0, 1, 3])
+        expected = self.makeAccumulator([0, 1, 3])
+        for name in ("weightSum", "nImage"):
+            self.assertFloatsAlmostEqual(getattr(accumulator, name), getattr(expected, name), atol=1e-12)
+
+    def testRemoveOnlyCoveringWarps(self):
+        """Test that a region is NO_DATA once the only warps covering it have been removed
+
+        The weights 0.1 and 0.2 leave a rounding residue in the sum of weights when both are removed.
+        """
+        accumulator = self.makeAccumulator([0])
+        subBBox = afwGeom.Box2I(self.bbox.getMin(), afwGeom.Extent2I(5, 40))
+        subImages = {}
+        for key, i, weight in (("a", 1, 0.1), ("b", 2, 0.2)):
+            subImages[key] = self.maskedImageList[i].Factory(self.maskedImageList[i], subBBox,
+                                                             afwImage.PARENT, True)
+            subImages[key].getMask().getArray()[:] = afwImage.Mask.getPlaneBitMask("SAT")
+            subImages[key].getImage().getArray()[0, :] = np.nan
+            accumulator.add(key, subImages[key], weight)
+        for key, subImage in subImages.items():
+            accumulator.remove(key, subImage)
+            accumulator.forget(key)
+        # Warp 0 is BAD in the first 5 columns, which are now covered by no warp
+        maskedImage, nImage = accumulator.makeCoadd()
+        self.assertTrue(np.all(np.isnan(maskedImage.getImage().getArray()[:, :5])))
+        np.testing.assert_array_equal(maskedImage.getMask().getArray()[:, :5],
+                                      afwImage.Mask.getPlaneBitMask("NO_DATA"))
+        np.testing.assert_array_equal(nImage.getArray()[:, :5], 0)
+
+    def testPersistence(self):
+        accumulator = self.makeAccumulator(range(3))
+        with lsst.utils.tests.getTempFilePath(".npz") as filename:
+            accumulator.writeTo(filename, "key")
+            self.assertIsNone(MeanCoaddAccumulator.readFrom(filename, "otherKey"))
+            restored = MeanCoaddAccumulator.readFrom(filename, "key")
+        self.assertEqual(restored.bbox, self.bbox)
+        self.assertEqual(sorted(restored.warps), ["0", "1", "2"])
+        maskedImage = accumulator.makeCoadd()[0]
+        restoredMaskedImage = restored.makeCoadd()[0]
+        for getPlane in ("getImage", "getMask", "getVariance"):
+            np.testing.assert_array_equal(getattr(restoredMaskedImage, getPlane)().getArray(),
+                                          getattr(maskedImage, getPlane)().getArray())
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,100 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test staging a stack of warp subregions in a scratch file
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.pipe.tasks.coaddStaging import StagedStack
+
+
+class StagedStackTestCase(lsst.utils.tests.TestCase):
+    """Test that staged stacks are read back as written"""
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(50, 40))
+        self.maskedImage = afwImage.MaskedImageF(self.bbox)
+        shape = self.maskedImage.getImage().getArray().shape
+        self.maskedImage.getImage().getArray()[:] = np.random.normal(0.0, 10.0, shape)
+        self.maskedImage.getMask().getArray()[:] = np.random.randint(0, 16, shape)
+        self.maskedImage.getVariance().getArray()[:] = np.random.uniform(5.0, 15.0, shape)
+
+    def tearDown(self):
+        del self.maskedImage
+
+    def testStagedStack(self):
+        """Stacking bands of a staged stack gives the coadd of the whole stack"""
+        maskedImageList = []
+        for i in range(5):
+            maskedImage = self.maskedImage.Factory(self.maskedImage, True)
+            maskedImage.getImage().getArray()[:] += np.random.normal(0.0, 5.0, (40, 50))
+            maskedImageList.append(maskedImage)
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setAndMask(0x8)
+        statsCtrl.setNanSafe(True)
+        statsCtrl.setWeighted(True)
+        weightList = [1.0, 2.0, 0.5, 1.5, 1.0]
+        expected = afwMath.statisticsStack(maskedImageList, afwMath.MEDIAN, statsCtrl, weightList)
+
+        staged = StagedStack(self.bbox, len(maskedImageList))
+        try:
+            for i, maskedImage in enumerate(maskedImageList):
+                staged.assignInput(i, maskedImage.getImage().getArray(), maskedImage.getMask().getArray(),
+                                   maskedImage.getVariance().getArray())
+            for y0 in range(self.bbox.getMinY(), self.bbox.getMaxY() + 1, 15):
+                bandBBox = afwGeom.Box2I(afwGeom.Point2I(self.bbox.getMinX(), y0),
+                                         afwGeom.Extent2I(50, min(15, self.bbox.getMaxY() + 1 - y0)))
+                bandList = staged.getBandMaskedImages(bandBBox)
+                self.assertEqual(bandList[0].getBBox(), bandBBox)
+                band = afwMath.statisticsStack(bandList, afwMath.MEDIAN, statsCtrl, weightList)
+                rows = slice(y0 - self.bbox.getMinY(), bandBBox.getMaxY() + 1 - self.bbox.getMinY())
+                for getPlane in ("getImage", "getMask", "getVariance"):
+                    np.testing.assert_array_equal(getattr(band, getPlane)().getArray(),
+                                                  getattr(expected, getPlane)().getArray()[rows])
+                imageCube = staged.getBandCubes(bandBBox)[0]
+                self.assertEqual(imageCube.shape, (5, bandBBox.getHeight(), 50))
+        finally:
+            filename = staged.filename
+            staged.close()
+        self.assertFalse(os.path.exists(filename))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,134 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test that DatasetExistenceCache looks up each dataset once
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+from lsst.pipe.tasks.datasetExistence import DatasetExistenceCache
+
+
+class CountingDataRef(object):
+    """A data reference that counts the existence lookups made through it
+
+    Its dataset is stored in the file named by filename, if not None.
+    """
+
+    def __init__(self, dataId, exists, lookups, filename=None):
+        self.dataId = dataId
+        self._exists = exists
+        self._lookups = lookups
+        self._filename = filename
+
+    def datasetExists(self, datasetType):
+        self._lookups.append((datasetType, self.dataId["ccd"]))
+        return self._exists
+
+    def get(self, datasetType):
+        if self._filename is None or not datasetType.endswith("_filename"):
+            raise RuntimeError("No %s for %s" % (datasetType, self.dataId))
+        return [self._filename]
+
+
+class DatasetExistenceCacheTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.lookups = []
+        self.dataRefList = [CountingDataRef(dict(visit=1, ccd=ccd), ccd % 3 != 0, self.lookups)
+                            for ccd in range(10)]
+
+    def testExists(self):
+        cache = DatasetExistenceCache()
+        for i in range(2):
+            self.assertEqual([cache.exists(dataRef, "calexp") for dataRef in self.dataRefList],
+                             [ccd % 3 != 0 for ccd in range(10)])
+        self.assertEqual(len(self.lookups), 10)
+        # Other dataset types are looked up separately
+        self.assertTrue(cache.exists(self.dataRefList[1], "src"))
+        self.assertEqual(len(self.lookups), 11)
+
+    def testPrefetch(self):
+        """Datasets are looked up by listing their directories, or else one by one"""
+        directory = tempfile.mkdtemp()
+        try:
+            dataRefList = []
+            for ccd in range(10):
+                # The calexps of each visit are in their own directory, that of visit 2 is missing, and
+                # the file name of ccd 9 is unknown
+                visit = 1 + ccd//4
+                filename = os.path.join(directory, "%d" % (visit,), "calexp-%d.fits" % (ccd,))
+                exists = visit == 1 and ccd % 3 != 0
+                if exists:
+                    if not os.path.exists(os.path.dirname(filename)):
+                        os.makedirs(os.path.dirname(filename))
+                    open(filename, "w").close()
+                dataRefList.append(CountingDataRef(dict(visit=visit, ccd=ccd), exists, self.lookups,
+                                                   filename if ccd != 9 else None))
+            os.makedirs(os.path.join(directory, "3"))
+            cache = DatasetExistenceCache()
+            cache.prefetch(dataRefList, "calexp")
+            self.assertEqual(len(cache), 9)
+            self.assertEqual(self.lookups, [])
+            self.assertEqual([cache.exists(dataRef, "calexp") for dataRef in dataRefList],
+                             [ccd < 4 and ccd % 3 != 0 for ccd in range(10)])
+            self.assertEqual(self.lookups, [("calexp", 9)])
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def testPrefetchMultiExtension(self):
+        """The HDU of a dataset in a multi-extension file is ignored"""
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "calexp.fits")
+            open(filename, "w").close()
+            dataRef = CountingDataRef(dict(visit=1, ccd=0), True, self.lookups, filename + "[1]")
+            cache = DatasetExistenceCache()
+            cache.prefetch([dataRef], "calexp")
+            self.assertTrue(cache.exists(dataRef, "calexp"))
+            self.assertEqual(self.lookups, [])
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def testSetExists(self):
+        cache = DatasetExistenceCache()
+        self.assertFalse(cache.exists(self.dataRefList[3], "calexp"))
+        cache.setExists(self.dataRefList[3], "calexp")
+        self.assertTrue(cache.exists(self.dataRefList[3], "calexp"))
+        self.assertEqual(len(self.lookups), 1)
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -37,6 +37,7 @@ import unittest
 import numpy as np
 
 import lsst.utils.tests
+import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.afw.display.ds9 as ds9
 import lsst.ip.isr as ipIsr
@@ -141,6 +142,53 @@ class interpolationTestCase(unittest.TestCase):
                 interpTask.run(miInterp, planeName=pixelPlane, fwhmPixels=self.FWHM)
                 validateInterp(miInterp, useFallbackValueAtEdge, 0)
 
+    def testFallbackValue(self):
+        """Test interpolating bands of rows with a fallbackValue computed over the whole image"""
+        mi = afwImage.MaskedImageF(80, 30)
+        np.random.seed(666)
+        mi.getImage().getArray()[:] = np.random.uniform(-1, 1, (30, 80))
+        pixelPlane = "BAD"
+        badBit = afwImage.Mask.getPlaneBitMask(pixelPlane)
+        mi[0:10, 5:20] = (10, badBit, 0)
+        mi[40:43, 8:25] = (100, badBit, 0)
+        self.checkBands(mi, pixelPlane)
+
+    def testFallbackValueNonRectangular(self):
+        """Test interpolating bands of rows over defects that are not rectangles"""
+        mi = afwImage.MaskedImageF(80, 30)
+        np.random.seed(667)
+        mi.getImage().getArray()[:] = np.random.uniform(-1, 1, (30, 80))
+        pixelPlane = "BAD"
+        badBit = afwImage.Mask.getPlaneBitMask(pixelPlane)
+        yy, xx = np.mgrid[0:30, 0:80]
+        # A disk and a diagonal line, both crossing the boundary between the bands, and a ring
+        disk = (xx - 55)**2 + (yy - 14)**2 <= 36
+        line = (xx - yy == 10) & (yy < 25)
+        ring = ((xx - 20)**2 + (yy - 20)**2 <= 25) & ((xx - 20)**2 + (yy - 20)**2 > 4)
+        for pixels, value in ((disk, 50.0), (line, -20.0), (ring, 80.0)):
+            mi.getImage().getArray()[pixels] = value
+            mi.getMask().getArray()[pixels] |= badBit
+        self.checkBands(mi, pixelPlane)
+
+    def checkBands(self, mi, pixelPlane):
+        """Check that interpolating bands of rows with the fallbackValue of the whole image gives the
+        same result as interpolating the whole image"""
+        config = InterpImageTask.ConfigClass()
+        config.fallbackValueType = "MEAN"
+        config.negativeFallbackAllowed = True
+        interpTask = InterpImageTask(config)
+        fallbackValue = interpTask.computeFallbackValue(mi)
+
+        miInterp = mi.clone()
+        interpTask.run(miInterp, planeName=pixelPlane, fwhmPixels=self.FWHM)
+        # Defects are interpolated along rows, so bands of full rows give the same result
+        miBands = mi.clone()
+        for y0, y1 in ((0, 15), (15, 30)):
+            bbox = afwGeom.Box2I(afwGeom.Point2I(0, y0), afwGeom.Point2I(79, y1 - 1))
+            band = miBands.Factory(miBands, bbox, afwImage.PARENT, False)
+            interpTask.run(band, planeName=pixelPlane, fwhmPixels=self.FWHM, fallbackValue=fallbackValue)
+        np.testing.assert_array_equal(miBands.getImage().getArray(), miInterp.getImage().getArray())
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 
@@ -0,0 +1,447 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test making warps of calexps held in memory with MakeCoaddTempExpTask and MakeTractCoaddTempExpTask
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.pipe.base as pipeBase
+from lsst.afw.coord import IcrsCoord
+from lsst.afw.detection import GaussianPsf
+from lsst.afw.geom.polygon import Polygon
+from lsst.pipe.tasks.makeCoaddTempExp import (MakeCoaddTempExpTask, MakeTractCoaddTempExpTask,
+                                              getCalExpPolygonCache)
+
+
+class DummyDataRef(object):
+    """Quacks like a ButlerDataRef, for its data ID only"""
+
+    def __init__(self, **dataId):
+        self.dataId = dataId
+
+    def __repr__(self):
+        return "DummyDataRef(%s)" % (self.dataId,)
+
+
+class MetadataDataRef(DummyDataRef):
+    """A data reference to the headers of a calexp, recording the datasets read through it"""
+
+    def __init__(self, metadata, reads, **dataId):
+        DummyDataRef.__init__(self, **dataId)
+        self._metadata = metadata
+        self._reads = reads
+
+    def get(self, datasetType, immediate=True, **dataId):
+        self._reads.append((datasetType, self.dataId["ccd"], dataId))
+        if datasetType not in self._metadata:
+            raise RuntimeError("No %s for %s" % (datasetType, self.dataId))
+        return self._metadata[datasetType]
+
+
+class DummyButler(object):
+    """Quacks like a Butler, for the keys of coadds and warps and making data references"""
+
+    def getKeys(self, datasetType):
+        if datasetType.endswith("Warp"):
+            return dict(visit=int, tract=int, patch=str)
+        return dict(tract=int, patch=str)
+
+    def dataRef(self, datasetType, dataId):
+        return DummyDataRef(**dataId)
+
+
+class DummyPatchRef(DummyDataRef):
+    """Quacks like a ButlerDataRef to a patch, whose coadd is in a directory"""
+
+    def __init__(self, directory, **dataId):
+        DummyDataRef.__init__(self, **dataId)
+        self._directory = directory
+
+    def getButler(self):
+        return DummyButler()
+
+    def get(self, datasetType):
+        return [os.path.join(self._directory, "%s-%s.fits" % (datasetType, self.dataId["patch"]))]
+
+
+class DummyTractInfo(object):
+    """Quacks like a lsst.skymap.TractInfo, for its ID only"""
+
+    def getId(self):
+        return 0
+
+
+class InMemoryCalExpMixin(object):
+    """Read calexps from a dict of ccd: calexp, and keep the warps written instead of persisting them"""
+
+    def _readCalExp(self, calExpRef, skyInfo, calExpInd):
+        ccd = calExpRef.dataId["ccd"]
+        if ccd not in self.calExps:
+            return None
+        return calExpRef, self.calExps[ccd], ccd
+
+    def writeWarps(self, tempExpRef, exps):
+        self.written[tempExpRef.dataId["patch"]] = exps
+
+
+class InMemoryMakeCoaddTempExpTask(InMemoryCalExpMixin, MakeCoaddTempExpTask):
+    pass
+
+
+class InMemoryMakeTractCoaddTempExpTask(InMemoryCalExpMixin, MakeTractCoaddTempExpTask):
+    pass
+
+
+class WarpTestCase(lsst.utils.tests.TestCase):
+    """Three calexps of one visit on two overlapping patches
+
+    Calexp 1 lies in patch A only, calexp 2 spans both patches and calexp 3 lies in patch B only.
+    Each calexp has its own zero point, so calexp 2 is scaled to the zero point of calexp 1 in patch A
+    but sets the zero point of patch B.
+    """
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.tractWcs = afwImage.makeWcs(IcrsCoord(10*afwGeom.degrees, 45*afwGeom.degrees),
+                                         afwGeom.Point2D(0, 0), 5.0e-5, 0.0, 0.0, 5.0e-5)
+        self.patchBBoxes = dict(A=afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(110, 100)),
+                                B=afwGeom.Box2I(afwGeom.Point2I(90, 0), afwGeom.Extent2I(110, 100)))
+        self.calExps = {ccd: self.makeCalExp(afwGeom.Point2D(xCenter, 50.0), fluxMag0)
+                        for ccd, xCenter, fluxMag0 in ((1, 40.0, 1.0e12), (2, 100.0, 2.0e12),
+                                                       (3, 160.0, 1.5e12))}
+        self.patchCalExps = dict(A=[1, 2], B=[2, 3])
+
+    def tearDown(self):
+        del self.calExps
+
+    def makeCalExp(self, tractCenter, fluxMag0):
+        """Make a calexp of 60x60 slightly rotated pixels centered on a point of the tract"""
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(60, 60))
+        center = self.tractWcs.pixelToSky(tractCenter).toIcrs()
+        cd = 5.2e-5*np.array([[np.cos(0.1), -np.sin(0.1)], [np.sin(0.1), np.cos(0.1)]])
+        calExp = afwImage.ExposureF(bbox, afwImage.makeWcs(center, afwGeom.Point2D(30.0, 30.0),
+                                                           cd[0, 0], cd[0, 1], cd[1, 0], cd[1, 1]))
+        maskedImage = calExp.getMaskedImage()
+        shape = maskedImage.getImage().getArray().shape
+        maskedImage.getImage().getArray()[:] = np.random.normal(100.0, 10.0, shape)
+        maskedImage.getVariance().getArray()[:] = np.random.uniform(50.0, 150.0, shape)
+        calExp.setCalib(afwImage.Calib(fluxMag0))
+        calExp.setPsf(GaussianPsf(15, 15, 2.0))
+        return calExp
+
+    def makeTask(self, TaskClass, **config):
+        """Make a task that warps the calexps of this test case exactly (without interpolating the Wcs)"""
+        taskConfig = TaskClass.ConfigClass()
+        taskConfig.warpAndPsfMatch.warp.interpLength = 0
+        for name, value in config.items():
+            setattr(taskConfig, name, value)
+        task = TaskClass(config=taskConfig)
+        task.calExps = self.calExps
+        task.written = {}
+        return task
+
+    def makeSkyInfo(self, patch):
+        return pipeBase.Struct(wcs=self.tractWcs, bbox=self.patchBBoxes[patch], tractInfo=DummyTractInfo())
+
+    def makeCalExpRefList(self, patch):
+        return [DummyDataRef(visit=1, ccd=ccd) for ccd in self.patchCalExps[patch]]
+
+    def assertExposuresEqual(self, exposure, expected):
+        self.assertEqual(exposure.getBBox(), expected.getBBox())
+        for getPlane in ("getImage", "getMask", "getVariance"):
+            np.testing.assert_array_equal(getattr(exposure.getMaskedImage(), getPlane)().getArray(),
+                                          getattr(expected.getMaskedImage(), getPlane)().getArray())
+        self.assertEqual(exposure.getCalib().getFluxMag0(), expected.getCalib().getFluxMag0())
+        self.assertEqual(len(exposure.getInfo().getCoaddInputs().ccds),
+                         len(expected.getInfo().getCoaddInputs().ccds))
+
+    def makePatchWarps(self, **config):
+        """Make the direct warp of each patch with MakeCoaddTempExpTask"""
+        task = self.makeTask(InMemoryMakeCoaddTempExpTask, **config)
+        return {patch: task.createTempExp(self.makeCalExpRefList(patch), self.makeSkyInfo(patch),
+                                          visitId=1).exposures["direct"]
+                for patch in self.patchBBoxes}
+
+
+class MakeWarpTestCase(WarpTestCase):
+    """Test making the warps of the patches"""
+
+    def testTractWarpsEqualPatchWarps(self):
+        """A calexp warped once for both patches gives the same warps as warped for each patch
+
+        The calexp spanning both patches is scaled for patch A and copied unscaled into patch B, so
+        scaling it must not change the pixels copied into the other patch.
+        """
+        expected = self.makePatchWarps()
+        for patch in ("A", "B"):
+            self.assertIsNotNone(expected[patch])
+        # Calexp 2 is scaled into patch A
+        self.assertEqual(expected["A"].getCalib().getFluxMag0(), self.calExps[1].getCalib().getFluxMag0())
+
+        task = self.makeTask(InMemoryMakeTractCoaddTempExpTask)
+        patchInputList = [pipeBase.Struct(tempExpRef=DummyDataRef(visit=1, patch=patch),
+                                          skyInfo=self.makeSkyInfo(patch),
+                                          calExpRefList=self.makeCalExpRefList(patch),
+                                          visitId=1,
+                                          manifest=None) for patch in ("A", "B")]
+        dataRefList = task.makeBatchTempExps(patchInputList)
+        self.assertEqual([dataRef.dataId["patch"] for dataRef in dataRefList], ["A", "B"])
+        for patch in ("A", "B"):
+            self.assertExposuresEqual(task.written[patch]["direct"], expected[patch])
+
+    def testWorkersEqualSerial(self):
+        """Calexps warped by worker processes give the same warps as warped serially"""
+        expected = self.makePatchWarps()
+        warps = self.makePatchWarps(numWarpWorkers=2)
+        for patch in ("A", "B"):
+            self.assertExposuresEqual(warps[patch], expected[patch])
+            np.testing.assert_array_equal(warps[patch].getPsf().computeKernelImage().getArray(),
+                                          expected[patch].getPsf().computeKernelImage().getArray())
+
+    def testWorkersSkipUnreadCalExps(self):
+        """A calexp that cannot be read is skipped, in order, by the workers as when warping serially"""
+        task = self.makeTask(InMemoryMakeCoaddTempExpTask, numWarpWorkers=2)
+        calExpRefList = [DummyDataRef(visit=1, ccd=ccd) for ccd in (1, 4, 2)]
+        warpedList = list(task._iterWarpedCalExps(calExpRefList, self.makeSkyInfo("A"),
+                                                  [self.patchBBoxes["A"]]*len(calExpRefList)))
+        self.assertIsNone(warpedList[1])
+        self.assertEqual([warped[2] for warped in (warpedList[0], warpedList[2])], [1, 2])
+
+    def testSharedCalExpBBoxes(self):
+        """Only calexps that overlap more than one batch have their kernels cached, solved over all the
+        patches they overlap"""
+        task = self.makeTask(InMemoryMakeTractCoaddTempExpTask)
+        batchList = [[pipeBase.Struct(skyInfo=self.makeSkyInfo(patch),
+                                      calExpRefList=self.makeCalExpRefList(patch))] for patch in ("A", "B")]
+        solveBBoxes = task.getSharedCalExpBBoxes(batchList)
+        unionBBox = afwGeom.Box2I(self.patchBBoxes["A"])
+        unionBBox.include(self.patchBBoxes["B"])
+        self.assertEqual(solveBBoxes, {(("ccd", 2), ("visit", 1)): unionBBox})
+        self.assertEqual(task.getSharedCalExpBBoxes([batchList[0] + batchList[1]]), {})
+
+
+class SelectCoveringCalExpsTestCase(WarpTestCase):
+    """Test predicting the coverage of the patches by the calexps from their headers"""
+
+    def setUp(self):
+        WarpTestCase.setUp(self)
+        getCalExpPolygonCache().clear()
+        self.reads = []
+
+    def tearDown(self):
+        getCalExpPolygonCache().clear()
+        WarpTestCase.tearDown(self)
+
+    def getMetadata(self, calExp):
+        metadata = calExp.getWcs().getFitsMetadata()
+        metadata.set("NAXIS1", calExp.getWidth())
+        metadata.set("NAXIS2", calExp.getHeight())
+        return metadata
+
+    def makeMetadataRefList(self, ccdList, uberCalCcds={}, validPolygons={}):
+        """Make data references to the headers of calexps
+
+        @param ccdList: list of calexps (by ccd) to refer to; those not in self.calExps have no header
+        @param uberCalCcds: dict of ccd: ccd whose Wcs is the meas_mosaic Wcs of the first
+        @param validPolygons: dict of ccd: valid polygon of the calexp; the others have none
+        """
+        refList = []
+        for ccd in ccdList:
+            metadata = {}
+            if ccd in self.calExps:
+                calExp = self.calExps[ccd]
+                metadata["calexp_md"] = self.getMetadata(calExp)
+                pixelBBox = afwGeom.Box2I(calExp.getXY0(), afwGeom.Extent2I(1, 1))
+                metadata["calexp_sub"] = calExp.Factory(calExp, pixelBBox, afwImage.PARENT, True)
+                if ccd in validPolygons:
+                    metadata["calexp_sub"].getInfo().setValidPolygon(validPolygons[ccd])
+            if ccd in uberCalCcds:
+                metadata["wcs_md"] = self.getMetadata(self.calExps[uberCalCcds[ccd]])
+            refList.append(MetadataDataRef(metadata, self.reads, visit=1, ccd=ccd))
+        return refList
+
+    def selectCcds(self, task, patch, refList):
+        return [ref.dataId["ccd"] for ref in task.selectCoveringCalExps(refList, self.makeSkyInfo(patch))]
+
+    def testSelect(self):
+        """Calexps that do not overlap a patch are skipped, those that cannot be predicted are kept"""
+        task = self.makeTask(InMemoryMakeCoaddTempExpTask, doPredictCoverage=True)
+        refList = self.makeMetadataRefList([1, 2, 3, 4])
+        self.assertEqual(self.selectCcds(task, "A", refList), [1, 2, 4])
+        self.assertEqual(self.selectCcds(task, "B", refList), [2, 3, 4])
+        # The polygons are kept for other patches, and even for other tasks; failures are not
+        for readType, readCcds in (("calexp_md", [1, 2, 3, 4, 4]), ("calexp_sub", [1, 2, 3])):
+            self.assertEqual(sorted(ccd for datasetType, ccd, dataId in self.reads
+                                    if datasetType == readType), readCcds)
+        task = self.makeTask(InMemoryMakeCoaddTempExpTask, doPredictCoverage=True)
+        self.assertEqual(self.selectCcds(task, "A", refList), [1, 2, 4])
+        self.assertEqual(len(self.reads), 9)
+
+    def testValidPolygon(self):
+        """The valid polygon of a calexp, rather than its bounding box, is mapped onto the patches"""
+        task = self.makeTask(InMemoryMakeCoaddTempExpTask, doPredictCoverage=True)
+        # Only the 10 leftmost columns of calexp 2 are valid, and they miss patch B
+        validPolygon = Polygon(afwGeom.Box2D(afwGeom.Point2D(0.0, 0.0), afwGeom.Point2D(10.0, 60.0)))
+        refList = self.makeMetadataRefList([2], validPolygons={2: validPolygon})
+        self.assertEqual(self.selectCcds(task, "A", refList), [2])
+        self.assertEqual(self.selectCcds(task, "B", refList), [])
+        # Its bounding box overlaps patch B
+        getCalExpPolygonCache().clear()
+        self.assertEqual(self.selectCcds(task, "B", self.makeMetadataRefList([2])), [2])
+
+    def testMinPredictedCoverage(self):
+        """Calexps are skipped unless they are predicted to cover more than minPredictedCoverage"""
+        task = self.makeTask(InMemoryMakeCoaddTempExpTask, doPredictCoverage=True, minPredictedCoverage=0.3)
+        refList = self.makeMetadataRefList([2, 3])
+        # Calexp 3 covers about 35% of patch B, calexp 2 about 25%
+        self.assertEqual(self.selectCcds(task, "B", refList), [3])
+
+    def testUberCalWcs(self):
+        """With doApplyUberCal, the coverage is predicted with the Wcs the calexp is warped with"""
+        task = self.makeTask(InMemoryMakeCoaddTempExpTask, doPredictCoverage=True, doApplyUberCal=True)
+        # The meas_mosaic Wcs of calexp 1 puts it where calexp 3 is
+        refList = self.makeMetadataRefList([1], uberCalCcds={1: 3})
+        self.assertEqual(self.selectCcds(task, "A", refList), [])
+        self.assertEqual(self.selectCcds(task, "B", refList), [1])
+        self.assertIn(("wcs_md", 1, dict(tract=0)), self.reads)
+        # The polygon mapped with the header Wcs is not reused
+        task = self.makeTask(InMemoryMakeCoaddTempExpTask, doPredictCoverage=True)
+        self.assertEqual(self.selectCcds(task, "A", refList), [1])
+
+
+class WarpManifestTestCase(lsst.utils.tests.TestCase):
+    """Test reading, skipping and recording the warps of a patch in its manifest"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.patchRef = DummyPatchRef(self.directory, tract=0, patch="1,1")
+        # Visit 1 has two calexps, visit 2 one
+        self.calExpRefList = [DummyDataRef(visit=visit, ccd=ccd, tract=0, patch="1,1")
+                              for visit, ccd in ((1, 1), (1, 2), (2, 3))]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def makeTask(self, **config):
+        taskConfig = MakeCoaddTempExpTask.ConfigClass()
+        taskConfig.doUseManifest = True
+        taskConfig.doOverwrite = False
+        for name, value in config.items():
+            setattr(taskConfig, name, value)
+        return MakeCoaddTempExpTask(config=taskConfig)
+
+    def getWarpRef(self, visit):
+        return DummyDataRef(visit=visit, tract=0, patch="1,1")
+
+    def removeCompletedWarps(self, task, calExpRefList=None):
+        """Read the manifest and return it, the calexps left to warp and the visits of the warps skipped"""
+        manifest = task.readManifest(self.patchRef)
+        dataRefList = []
+        remainingRefList = task.removeCompletedWarps(manifest, self.patchRef,
+                                                     calExpRefList or self.calExpRefList, dataRefList)
+        return (manifest, [ref.dataId["ccd"] for ref in remainingRefList],
+                [ref.dataId["visit"] for ref in dataRefList])
+
+    def testRecordAndSkip(self):
+        """A recorded warp is skipped on the next run, unless its calexps change"""
+        task = self.makeTask()
+        manifest, remaining, skipped = self.removeCompletedWarps(task)
+        self.assertEqual(manifest["warps"], {})
+        self.assertEqual((remaining, skipped), ([1, 2, 3], []))
+        self.assertFalse(os.path.exists(manifest["filename"]))
+        task.recordWarpInManifest(manifest, self.getWarpRef(1), True)
+        self.assertTrue(os.path.exists(manifest["filename"]))
+
+        manifest, remaining, skipped = self.removeCompletedWarps(self.makeTask())
+        self.assertEqual(len(manifest["warps"]), 1)
+        self.assertEqual((remaining, skipped), ([3], [1]))
+
+        # A warp recorded with other calexps is made again
+        manifest, remaining, skipped = self.removeCompletedWarps(self.makeTask(), self.calExpRefList[:1])
+        self.assertEqual((remaining, skipped), ([1], []))
+
+    def testNotCreated(self):
+        """A warp recorded as not created is skipped, but not returned"""
+        task = self.makeTask()
+        manifest, remaining, skipped = self.removeCompletedWarps(task)
+        task.recordWarpInManifest(manifest, self.getWarpRef(2), False)
+        manifest, remaining, skipped = self.removeCompletedWarps(self.makeTask())
+        self.assertEqual((remaining, skipped), ([1, 2], []))
+
+    def testOverwrite(self):
+        """With doOverwrite, recorded warps are made again, and recorded again"""
+        task = self.makeTask()
+        manifest, remaining, skipped = self.removeCompletedWarps(task)
+        task.recordWarpInManifest(manifest, self.getWarpRef(1), True)
+        task = self.makeTask(doOverwrite=True)
+        manifest, remaining, skipped = self.removeCompletedWarps(task)
+        self.assertEqual((remaining, skipped), ([1, 2, 3], []))
+        self.assertEqual(len(manifest["pending"]), 2)
+
+    def testOtherConfig(self):
+        """A manifest written with another configuration, or that cannot be read, is ignored"""
+        task = self.makeTask()
+        manifest, remaining, skipped = self.removeCompletedWarps(task)
+        task.recordWarpInManifest(manifest, self.getWarpRef(1), True)
+        manifest, remaining, skipped = self.removeCompletedWarps(self.makeTask(bgSubtracted=False))
+        self.assertEqual((remaining, skipped), ([1, 2, 3], []))
+        # Fields that do not change the warps do not change the configuration key
+        manifest, remaining, skipped = self.removeCompletedWarps(self.makeTask(doCacheExistence=True))
+        self.assertEqual((remaining, skipped), ([3], [1]))
+
+        with open(manifest["filename"], "w") as manifestFile:
+            manifestFile.write("{truncated")
+        manifest, remaining, skipped = self.removeCompletedWarps(self.makeTask())
+        self.assertEqual((remaining, skipped), ([1, 2, 3], []))
+
+    def testRecordUnmadeWarps(self):
+        """Warps none of whose calexps are left to warp are recorded as not created"""
+        task = self.makeTask()
+        manifest, remaining, skipped = self.removeCompletedWarps(task)
+        # The calexp of visit 2 is missing
+        task.recordUnmadeWarpsInManifest(manifest, self.patchRef, self.calExpRefList[:2])
+        self.assertEqual(len(manifest["pending"]), 1)
+        manifest, remaining, skipped = self.removeCompletedWarps(self.makeTask())
+        self.assertEqual((remaining, skipped), ([1, 2], []))
+        self.assertEqual([entry["created"] for entry in manifest["warps"].values()], [False])
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
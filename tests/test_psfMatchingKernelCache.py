@@ -0,0 +1,142 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test the least-recently-used cache of PSF-matching kernels, and PSF-matching with a cached kernel
+"""
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.afw.coord import IcrsCoord
+from lsst.afw.detection import GaussianPsf
+from lsst.meas.algorithms import DoubleGaussianPsf
+from lsst.pipe.tasks.warpAndPsfMatch import PsfMatchingKernelCache, WarpAndPsfMatchTask
+
+
+class PsfMatchingKernelCacheTestCase(lsst.utils.tests.TestCase):
+
+    def testLeastRecentlyUsed(self):
+        cache = PsfMatchingKernelCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # "b" is now the least recently used
+        cache.put("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class CachedKernelTestCase(lsst.utils.tests.TestCase):
+    """Test that PSF-matching with a cached kernel gives the same warp as with the kernel just solved"""
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.tractWcs = afwImage.makeWcs(IcrsCoord(10*afwGeom.degrees, 45*afwGeom.degrees),
+                                         afwGeom.Point2D(0, 0), 5.0e-5, 0.0, 0.0, 5.0e-5)
+        # Two patches side by side, covered by one calexp
+        self.patchBBoxes = [afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(256, 512)),
+                            afwGeom.Box2I(afwGeom.Point2I(256, 0), afwGeom.Extent2I(256, 512))]
+        self.solveBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(512, 512))
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(640, 640))
+        center = self.tractWcs.pixelToSky(afwGeom.Point2D(256.0, 256.0)).toIcrs()
+        cd = 5.1e-5*np.array([[np.cos(0.05), -np.sin(0.05)], [np.sin(0.05), np.cos(0.05)]])
+        self.calExp = afwImage.ExposureF(bbox, afwImage.makeWcs(center, afwGeom.Point2D(320.0, 320.0),
+                                                                cd[0, 0], cd[0, 1], cd[1, 0], cd[1, 1]))
+        maskedImage = self.calExp.getMaskedImage()
+        shape = maskedImage.getImage().getArray().shape
+        maskedImage.getImage().getArray()[:] = np.random.normal(100.0, 10.0, shape)
+        maskedImage.getVariance().getArray()[:] = 100.0
+        self.calExp.setCalib(afwImage.Calib(1.0e12))
+        self.calExp.setPsf(GaussianPsf(21, 21, 1.5))
+        self.modelPsf = DoubleGaussianPsf(41, 41, 3.0, 6.0, 0.1)
+        config = WarpAndPsfMatchTask.ConfigClass()
+        config.warp.interpLength = 0
+        self.task = WarpAndPsfMatchTask(config=config)
+
+    def tearDown(self):
+        del self.calExp
+        del self.task
+
+    def runCached(self, patchBBox, kernelCache):
+        return self.task.run(self.calExp, wcs=self.tractWcs, modelPsf=self.modelPsf, maxBBox=patchBBox,
+                             makeDirect=True, makePsfMatched=True, kernelCache=kernelCache,
+                             cacheKey="calexp", solveBBox=self.solveBBox)
+
+    def assertWarpsAlmostEqual(self, exposure, expected, bbox):
+        """Assert that two warps have the same mask and almost the same pixels within bbox"""
+        subExposure = exposure.Factory(exposure, bbox, afwImage.PARENT)
+        subExpected = expected.Factory(expected, bbox, afwImage.PARENT)
+        np.testing.assert_array_equal(subExposure.getMaskedImage().getMask().getArray(),
+                                      subExpected.getMaskedImage().getMask().getArray())
+        for getPlane in ("getImage", "getVariance"):
+            array = getattr(subExposure.getMaskedImage(), getPlane)().getArray()
+            expectedArray = getattr(subExpected.getMaskedImage(), getPlane)().getArray()
+            np.testing.assert_array_equal(np.isfinite(array), np.isfinite(expectedArray))
+            good = np.isfinite(expectedArray)
+            self.assertGreater(good.sum(), 0)
+            # The convolution interpolates the spatially-varying kernel over a grid anchored to the warp
+            self.assertFloatsAlmostEqual(array[good], expectedArray[good], rtol=1e-5)
+
+    def testCachedKernel(self):
+        """A kernel solved for one patch and reused for the same patch gives the same PSF-matched warp"""
+        kernelCache = PsfMatchingKernelCache(2)
+        patchBBox = self.patchBBoxes[1]
+        solved = self.runCached(patchBBox, kernelCache)
+        self.assertIsNotNone(solved.psfMatched)
+        self.assertEqual(len(kernelCache), 1)
+        cached = self.runCached(patchBBox, kernelCache)
+        self.assertEqual(len(kernelCache), 1)
+        self.assertWarpsAlmostEqual(cached.psfMatched, solved.psfMatched, patchBBox)
+        self.assertEqual(cached.direct.getBBox(), solved.direct.getBBox())
+        np.testing.assert_array_equal(cached.direct.getMaskedImage().getImage().getArray(),
+                                      solved.direct.getMaskedImage().getImage().getArray())
+        np.testing.assert_array_equal(cached.psfMatched.getPsf().computeKernelImage().getArray(),
+                                      solved.psfMatched.getPsf().computeKernelImage().getArray())
+
+    def testKernelIndependentOfFirstPatch(self):
+        """The kernel solved over solveBBox does not depend on the patch for which it was first solved"""
+        firstCache = PsfMatchingKernelCache(1)
+        self.runCached(self.patchBBoxes[0], firstCache)
+        fromOtherPatch = self.runCached(self.patchBBoxes[1], firstCache)
+        fromSamePatch = self.runCached(self.patchBBoxes[1], PsfMatchingKernelCache(1))
+        self.assertWarpsAlmostEqual(fromOtherPatch.psfMatched, fromSamePatch.psfMatched, self.patchBBoxes[1])
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
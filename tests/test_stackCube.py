@@ -0,0 +1,141 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test stackCube against afwMath.statisticsStack
+"""
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.pipe.tasks.stackCube import stackCube
+
+
+class StackCubeTestCase(lsst.utils.tests.TestCase):
+    """Test that stackCube gives the results of statisticsStack"""
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(30, 20))
+        self.badMask = afwImage.Mask.getPlaneBitMask(["NO_DATA", "BAD"])
+        self.numInputs = 9
+        shape = (self.numInputs, self.bbox.getHeight(), self.bbox.getWidth())
+        self.imageCube = np.random.normal(100.0, 0.1, shape).astype(np.float32)
+        self.varianceCube = np.random.uniform(5.0, 15.0, shape).astype(np.float32)
+        self.maskCube = np.zeros(shape, dtype=afwImage.Mask(self.bbox).getArray().dtype)
+        # A strong outlier in one input, bad pixels in another, and a pixel with no good values
+        self.imageCube[3, 5, 5] = 1.0e4
+        self.maskCube[1, :, 10:15] = afwImage.Mask.getPlaneBitMask("BAD")
+        self.maskCube[:, 2, 2] = afwImage.Mask.getPlaneBitMask("NO_DATA")
+        self.maskCube[4, 7, :] |= afwImage.Mask.getPlaneBitMask("SAT")
+        self.weights = np.random.uniform(0.5, 2.0, self.numInputs)
+
+    def makeStatsCtrl(self):
+        statsCtrl = afwMath.StatisticsControl()
+        statsCtrl.setNumSigmaClip(3.0)
+        statsCtrl.setNumIter(2)
+        statsCtrl.setAndMask(self.badMask)
+        statsCtrl.setNanSafe(True)
+        statsCtrl.setWeighted(True)
+        statsCtrl.setCalcErrorFromInputVariance(True)
+        return statsCtrl
+
+    def statisticsStack(self, statistic):
+        maskedImageList = []
+        for i in range(self.numInputs):
+            maskedImage = afwImage.MaskedImageF(self.bbox)
+            maskedImage.getImage().getArray()[:] = self.imageCube[i]
+            maskedImage.getMask().getArray()[:] = self.maskCube[i]
+            maskedImage.getVariance().getArray()[:] = self.varianceCube[i]
+            maskedImageList.append(maskedImage)
+        return afwMath.statisticsStack(maskedImageList, afwMath.stringToStatisticsProperty(statistic),
+                                       self.makeStatsCtrl(), list(self.weights))
+
+    def stackCube(self, statistic, **kwargs):
+        return stackCube(self.imageCube, self.maskCube, self.varianceCube, self.weights, statistic,
+                         self.badMask, 3.0, 2, **kwargs)
+
+    def testMean(self):
+        expected = self.statisticsStack("MEAN")
+        image, mask, variance = self.stackCube("MEAN")
+        good = np.isfinite(expected.getImage().getArray())
+        self.assertFalse(good[2, 2])
+        self.assertTrue(np.isnan(image[2, 2]))
+        self.assertFloatsAlmostEqual(image[good], expected.getImage().getArray()[good], rtol=1e-6)
+        self.assertFloatsAlmostEqual(variance[good], expected.getVariance().getArray()[good], rtol=1e-5)
+
+    def testMedianAndMeanClip(self):
+        for statistic in ("MEDIAN", "MEANCLIP"):
+            expected = self.statisticsStack(statistic)
+            image = self.stackCube(statistic)[0]
+            good = np.isfinite(expected.getImage().getArray())
+            self.assertFloatsAlmostEqual(image[good], expected.getImage().getArray()[good], rtol=1e-5)
+        # The outlier is clipped by MEANCLIP
+        self.assertLess(abs(image[5, 5] - 100.0), 1.0)
+
+    def testInputsUnchanged(self):
+        """The cubes are not modified, so several statistics can be stacked from them"""
+        cubes = [cube.copy() for cube in (self.imageCube, self.maskCube, self.varianceCube)]
+        for statistic in ("MEAN", "MEDIAN", "MEANCLIP"):
+            self.stackCube(statistic)
+            for cube, original in zip((self.imageCube, self.maskCube, self.varianceCube), cubes):
+                np.testing.assert_array_equal(cube, original)
+
+    def testMedianEvenCount(self):
+        """The median of an even number of good values is the mean of the middle two"""
+        self.maskCube[0] |= afwImage.Mask.getPlaneBitMask("BAD")
+        expected = self.statisticsStack("MEDIAN")
+        image = self.stackCube("MEDIAN")[0]
+        good = np.isfinite(expected.getImage().getArray())
+        self.assertFloatsAlmostEqual(image[good], expected.getImage().getArray()[good], rtol=1e-5)
+
+    def testMask(self):
+        sat = afwImage.Mask.getPlaneBitMask("SAT")
+        noData = afwImage.Mask.getPlaneBitMask("NO_DATA")
+        mask = self.stackCube("MEAN", noGoodPixelsMask=noData)[1]
+        self.assertEqual(mask[2, 2], noData)
+        self.assertTrue(np.all(mask[7, :] & sat))
+        self.assertFalse(np.any(mask[8, :] & sat))
+        # SAT pixels that are rejected are propagated if their weight exceeds the threshold
+        self.maskCube[4, 7, :] |= afwImage.Mask.getPlaneBitMask("BAD")
+        fraction = self.weights[4]/self.weights.sum()
+        mask = self.stackCube("MEAN", maskPropagationThresholds={sat: 0.5*fraction})[1]
+        self.assertTrue(np.all(mask[7, :] & sat))
+        mask = self.stackCube("MEAN", maskPropagationThresholds={sat: 2.0*fraction})[1]
+        self.assertFalse(np.any(mask[7, :] & sat))
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,145 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Test WarpReader against the afw FITS reader
+"""
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from lsst.pipe.tasks.warpReader import WarpReader, readFitsHduLayout, writeCompressedWarp
+
+
+class WarpReaderTestCase(lsst.utils.tests.TestCase):
+    """Test that WarpReader reads the same pixels as the afw FITS reader"""
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(1000, 2000), afwGeom.Extent2I(150, 100))
+        self.exposure = afwImage.ExposureF(self.bbox)
+        maskedImage = self.exposure.getMaskedImage()
+        shape = maskedImage.getImage().getArray().shape
+        maskedImage.getImage().getArray()[:] = np.random.normal(0.0, 10.0, shape)
+        maskedImage.getImage().getArray()[10:20, 30:40] = np.nan
+        maskedImage.getMask().getArray()[10:20, 30:40] = afwImage.Mask.getPlaneBitMask("NO_DATA")
+        maskedImage.getVariance().getArray()[:] = np.random.uniform(50.0, 150.0, shape)
+        self.exposure.setCalib(afwImage.Calib(1e12))
+        self.exposure.getMetadata().set("TESTKEY", "a 'quoted' value")
+
+    def tearDown(self):
+        del self.exposure
+
+    def assertExposuresEqual(self, exposure, expected):
+        self.assertEqual(exposure.getBBox(), expected.getBBox())
+        for getPlane in ("getImage", "getMask", "getVariance"):
+            np.testing.assert_array_equal(getattr(exposure.getMaskedImage(), getPlane)().getArray(),
+                                          getattr(expected.getMaskedImage(), getPlane)().getArray())
+
+    def testReadFitsHduLayout(self):
+        with lsst.utils.tests.getTempFilePath(".fits") as filename:
+            self.exposure.writeFits(filename)
+            hduList = readFitsHduLayout(filename)
+            self.assertGreaterEqual(len(hduList), 4)
+            self.assertEqual(hduList[0].header["TESTKEY"], "a 'quoted' value")
+            for hdu, bitpix in zip(hduList[1:4], (-32, 32, -32)):
+                self.assertEqual(hdu.header["BITPIX"], bitpix)
+                self.assertEqual(hdu.header["NAXIS1"], self.bbox.getWidth())
+                self.assertEqual(hdu.header["NAXIS2"], self.bbox.getHeight())
+                self.assertEqual(hdu.dataOffset % 2880, 0)
+                self.assertEqual(hdu.dataSize, 4*self.bbox.getArea())
+            # Mask planes with names longer than 5 characters are written as HIERARCH cards
+            maskPlaneDict = afwImage.Mask.getMaskPlaneDict()
+            for plane in ("BAD", "DETECTED", "NO_DATA"):
+                self.assertEqual(hduList[2].header["MP_" + plane], maskPlaneDict[plane])
+
+    def testReadSubregion(self):
+        with lsst.utils.tests.getTempFilePath(".fits") as filename:
+            self.exposure.writeFits(filename)
+            reader = WarpReader(filename)
+            self.assertTrue(reader.isMapped())
+            self.assertEqual(reader.getBBox(), self.bbox)
+            subBBox = afwGeom.Box2I(afwGeom.Point2I(1020, 2005), afwGeom.Extent2I(40, 30))
+            expected = afwImage.ExposureF(filename, bbox=subBBox, origin=afwImage.PARENT)
+            exposure = reader.readSubregion(subBBox)
+            self.assertExposuresEqual(exposure, expected)
+            self.assertAlmostEqual(exposure.getCalib().getFluxMag0()[0], 1e12)
+            self.assertExposuresEqual(reader.read(), afwImage.ExposureF(filename))
+            with self.assertRaises(RuntimeError):
+                reader.readSubregion(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(10, 10)))
+
+    def testMaskPlaneMismatch(self):
+        """Test that a warp with a mask plane unknown to this process is not memory-mapped"""
+        afwImage.Mask.addMaskPlane("WARPREADER_TEST")
+        try:
+            exposure = afwImage.ExposureF(self.exposure, True)
+            exposure.getMaskedImage().getMask().getArray()[0:5, 0:5] |= \
+                afwImage.Mask.getPlaneBitMask("WARPREADER_TEST")
+            with lsst.utils.tests.getTempFilePath(".fits") as filename:
+                exposure.writeFits(filename)
+                afwImage.Mask.removeMaskPlane("WARPREADER_TEST")
+                reader = WarpReader(filename)
+                self.assertFalse(reader.isMapped())
+                self.assertEqual(reader.getBBox(), self.bbox)
+        finally:
+            if "WARPREADER_TEST" in afwImage.Mask.getMaskPlaneDict():
+                afwImage.Mask.removeMaskPlane("WARPREADER_TEST")
+
+    def testReadCompressed(self):
+        subBBox = afwGeom.Box2I(afwGeom.Point2I(1020, 2005), afwGeom.Extent2I(40, 30))
+        noData = self.exposure.getMaskedImage().getMask().getArray() != 0
+        for quantizeLevel in (0.0, 16.0):
+            exposure = self.exposure.clone()
+            with lsst.utils.tests.getTempFilePath(".fits") as filename:
+                writeCompressedWarp(exposure, filename, tileSize=32, quantizeLevel=quantizeLevel)
+                reader = WarpReader(filename)
+                self.assertFalse(reader.isMapped())
+                self.assertEqual(reader.getBBox(), self.bbox)
+                subregion = reader.readSubregion(subBBox)
+                self.assertEqual(subregion.getBBox(), subBBox)
+                warp = reader.read()
+            self.assertTrue(np.all(np.isnan(warp.getMaskedImage().getVariance().getArray()[noData])))
+            np.testing.assert_array_equal(warp.getMaskedImage().getMask().getArray(),
+                                          self.exposure.getMaskedImage().getMask().getArray())
+            for getPlane, sigma in (("getImage", 10.0), ("getVariance", 30.0)):
+                array = getattr(warp.getMaskedImage(), getPlane)().getArray()[~noData]
+                expected = getattr(self.exposure.getMaskedImage(), getPlane)().getArray()[~noData]
+                if quantizeLevel == 0:
+                    np.testing.assert_array_equal(array, expected)
+                else:
+                    self.assertLess(np.abs(array - expected).max(), sigma/quantizeLevel)
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+class MatchMemoryTestCase(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()